@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+""" Room broadcast fan-out: server CPU per broadcast """
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.server.room import GameRoom  # noqa: E402
+
+
+def make_payload(n_users: int, words_per_user: int) -> str:
+    users = [
+        {
+            'user_name': f'user{i}',
+            'user_id': i,
+            'score': words_per_user,
+            'guessed_words': [f'word{i}x{j}' for j in range(words_per_user)],
+        }
+        for i in range(n_users)
+    ]
+    return json.dumps({'tag': 'game-state', 'message': {'users': users}})
+
+
+def run_clients(port: int, n: int, expected: int, compression):
+    async def client():
+        uri = f'ws://127.0.0.1:{port}/'
+        async with websockets.connect(
+                uri, compression=compression, max_size=None) as ws:
+            for _ in range(expected):
+                await ws.recv()
+
+    async def main():
+        await asyncio.gather(*(client() for _ in range(n)))
+
+    asyncio.new_event_loop().run_until_complete(main())
+
+
+async def sequential_broadcast(room: GameRoom, data: str):
+    """ Previous behaviour: one socket at a time, encoded per socket """
+    for socks in room.users.values():
+        for sock in list(socks):
+            await sock.send(data)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Broadcast benchmark')
+    parser.add_argument('-n', '--sockets', type=int, default=50)
+    parser.add_argument('-b', '--broadcasts', type=int, default=200)
+    parser.add_argument('-w', '--words-per-user', type=int, default=20)
+    parser.add_argument('-c', '--compression', action='store_true')
+    parser.add_argument('-p', '--port', type=int, default=6690)
+    args = parser.parse_args()
+    compression = 'deflate' if args.compression else None
+
+    room = GameRoom('bench', emitter=None)
+    registered = asyncio.Event()
+
+    async def handler(ws, _path):
+        uid = len(room.users)
+        room.user_names[uid] = f'user{uid}'
+        room.users[uid].add(ws)
+        if len(room.users) == args.sockets:
+            registered.set()
+        await ws.wait_closed()
+
+    server = await websockets.serve(
+        handler, '127.0.0.1', args.port, compression=compression)
+    data = make_payload(args.sockets, args.words_per_user)
+    print(f'{args.sockets} sockets, payload {len(data)} bytes, '
+          f'compression {compression}')
+
+    variants = (
+        ('sequential send', sequential_broadcast),
+        ('room broadcast', GameRoom.broadcast),
+    )
+    proc = multiprocessing.Process(
+        target=run_clients,
+        args=(
+            args.port, args.sockets,
+            args.broadcasts * len(variants), compression,
+        ),
+    )
+    proc.start()
+    await registered.wait()
+
+    for name, broadcast in variants:
+        cpu, wall = time.process_time(), time.perf_counter()
+        for _ in range(args.broadcasts):
+            await broadcast(room, data)
+        cpu = time.process_time() - cpu
+        wall = time.perf_counter() - wall
+        print(f'{name:16s} cpu {cpu / args.broadcasts * 1000:8.3f}ms '
+              f'wall {wall / args.broadcasts * 1000:8.3f}ms per broadcast')
+
+    await asyncio.get_event_loop().run_in_executor(None, proc.join)
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Two clustered nodes against one redis: relay, kick and owner failover.
+
+Starts server.py twice with --cluster, creates a game on the first node
+(its owner) and joins players on both. Checks that state changes made on
+the follower reach every socket, that a kick closes a follower socket and
+that after the owner stops, its follower sockets are closed with 1012 and
+the game is taken over by the second node from the persisted state.
+Exits non-zero if a check fails.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+import aioredis
+import websockets
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from onliapa.persister.persister import Persister  # noqa: E402
+from onliapa.server.cluster import CLOSE_MOVED  # noqa: E402
+from onliapa.server.protocol import rmsg  # noqa: E402
+
+TIMEOUT = 5.0
+
+
+async def wait_listening(port: int, timeout: float):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+            continue
+        writer.close()
+        return
+
+
+async def recv_until(ws, tag: str) -> dict:
+    while True:
+        message = json.loads(await asyncio.wait_for(ws.recv(), TIMEOUT))
+        if message['tag'] == tag:
+            return message
+
+
+async def join(url: str, name: str):
+    ws = await websockets.connect(url)
+    await ws.send(rmsg('user-auth', {'user_name': name}))
+    await recv_until(ws, 'game-state')
+    return ws
+
+
+async def closed_code(ws) -> int:
+    """ Close code once the server closes the socket """
+    try:
+        while True:
+            await asyncio.wait_for(ws.recv(), TIMEOUT)
+    except websockets.ConnectionClosed as err:
+        return err.code
+
+
+async def run(
+        args,
+        nodes: List[subprocess.Popen],
+        errors: List[str],
+) -> str:
+    """ Run the checks, returns the id of the game created """
+    def check(ok: bool, what: str):
+        print(f'{"ok  " if ok else "FAIL"} {what}')
+        if not ok:
+            errors.append(what)
+
+    owner_url, follower_url = (f'ws://127.0.0.1:{p}/ws' for p in args.ports)
+    redis = await aioredis.create_redis(args.redis_url)
+    try:
+        async with websockets.connect(f'{owner_url}/new_game/') as ws:
+            await ws.send(rmsg('new-game', {
+                'game_name': 'cluster bench',
+                'round_length': 60,
+                'hat_words_per_user': 2,
+            }))
+            game_id = json.loads(await ws.recv())['message']
+        owner = await redis.get(f'game/{game_id}/owner', encoding='utf-8')
+        check(owner is not None, f'game {game_id} owned by node {owner}')
+
+        alice = await join(f'{owner_url}/game/{game_id}', 'alice')
+        bob = await join(f'{follower_url}/game/{game_id}', 'bob')
+        carol = await join(f'{follower_url}/game/{game_id}', 'carol')
+        admin = await websockets.connect(f'{follower_url}/admin/{game_id}')
+        await recv_until(admin, 'game-state')
+
+        # Relay: a follower message reaches the owner and every socket
+        await bob.send(rmsg('hat-add-words', {'words': ['apple', 'pear']}))
+        states = []
+        for ws in (alice, bob, carol, admin):
+            try:
+                states.append(await recv_until(ws, 'game-state'))
+            except asyncio.TimeoutError:
+                pass
+        check(len(states) == 4, f'state relayed to {len(states)}/4 sockets')
+
+        # Kick from the follower admin closes a follower socket
+        users = states[-1]['message']['users'] if states else []
+        carol_id = next(
+            (u['user_id'] for u in users if u['user_name'] == 'carol'), None)
+        await admin.send(rmsg('kick-user', {'user_id': carol_id}))
+        try:
+            await recv_until(alice, 'remove-user')
+            removed = True
+        except asyncio.TimeoutError:
+            removed = False
+        check(removed, 'kick announced on the owner node')
+        code = await closed_code(carol)
+        check(code == 1000, f'kicked follower socket closed ({code})')
+
+        # Failover: the owner stops, the follower node takes the game over
+        nodes[0].terminate()
+        nodes[0].wait()
+        code = await closed_code(bob)
+        check(code == CLOSE_MOVED,
+              f'follower socket closed after owner stop ({code})')
+        bob = await websockets.connect(f'{follower_url}/game/{game_id}')
+        await bob.send(rmsg('user-auth', {'user_name': 'bob'}))
+        state = await recv_until(bob, 'game-state')
+        new_owner = await redis.get(
+            f'game/{game_id}/owner', encoding='utf-8')
+        check(new_owner not in (None, owner),
+              f'game taken over by node {new_owner}')
+        names = sorted(u['user_name'] for u in state['message']['users'])
+        check(names == ['alice', 'bob'], f'persisted users {names}')
+        for ws in (alice, bob, admin):
+            await ws.close()
+        return game_id
+    finally:
+        redis.close()
+        await redis.wait_closed()
+
+
+async def main() -> bool:
+    parser = argparse.ArgumentParser(description='Two node cluster check')
+    parser.add_argument('-r', '--redis-url', default='redis://localhost')
+    parser.add_argument('-p', '--ports', type=int, nargs=2,
+                        default=[6631, 6632])
+    parser.add_argument('--lease', type=float, default=3.0,
+                        help='cluster lease, seconds')
+    parser.add_argument('--logs', metavar='DIR',
+                        help='write node logs there instead of discarding')
+    args = parser.parse_args()
+
+    nodes = []
+    for port in args.ports:
+        out = subprocess.DEVNULL
+        if args.logs:
+            out = open(os.path.join(args.logs, f'node{port}.log'), 'w')
+        nodes.append(subprocess.Popen(
+            [sys.executable, os.path.join(BACKEND, 'server.py'),
+             '-p', str(port), '-r', args.redis_url,
+             '--cluster', '--cluster-lease', str(args.lease)],
+            stdout=out, stderr=subprocess.STDOUT,
+        ))
+    errors = []
+    game_id = None
+    try:
+        for port in args.ports:
+            await wait_listening(port, 30)
+        game_id = await run(args, nodes, errors)
+    finally:
+        for node in nodes:
+            node.terminate()
+            node.wait()
+    pr = Persister(args.redis_url, health_check_interval=0)
+    await pr.del_game(game_id)
+    await pr.close()
+    return not errors
+
+
+if __name__ == '__main__':
+    ok = asyncio.get_event_loop().run_until_complete(main())
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Many clients joining a game that is not resident. Checks that a single
+load happens and that every socket lands in the same resident room, exits
+non-zero otherwise.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from functools import partial
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.persister.persister import Persister  # noqa: E402
+from onliapa.server import server  # noqa: E402
+from onliapa.server.protocol import rmsg  # noqa: E402
+from onliapa.server.room import rooms  # noqa: E402
+
+
+async def join(
+        uri: str,
+        i: int,
+        joined: list,
+        done: asyncio.Event,
+) -> float:
+    start = time.perf_counter()
+    async with websockets.connect(uri) as ws:
+        await ws.send(rmsg('user-auth', {'user_name': f'player{i}'}))
+        while json.loads(await ws.recv())['tag'] != 'game-state':
+            pass
+        elapsed = time.perf_counter() - start
+        joined.append(i)
+        await done.wait()
+    return elapsed
+
+
+async def main() -> bool:
+    parser = argparse.ArgumentParser(description='Cold game join stress')
+    parser.add_argument('-r', '--redis-url', default='redis://localhost')
+    parser.add_argument('-n', '--clients', type=int, default=500)
+    parser.add_argument('-p', '--port', type=int, default=6691)
+    args = parser.parse_args()
+
+    pr = Persister(args.redis_url, health_check_interval=0)
+    await pr.connect()
+    ws_server = await websockets.serve(
+        partial(server.serve, pr), '127.0.0.1', args.port)
+    base = f'ws://127.0.0.1:{args.port}/ws'
+
+    async with websockets.connect(f'{base}/new_game/') as ws:
+        await ws.send(rmsg('new-game', {
+            'game_name': 'cold join',
+            'round_length': 60,
+            'hat_words_per_user': 5,
+        }))
+        game_id = json.loads(await ws.recv())['message']
+    # Persist and drop it from memory so that the next join is cold
+    game = rooms[game_id]._emitter.instance
+    game._save_state()
+    await pr.flush()
+    del rooms[game_id]
+
+    joined = []
+    done = asyncio.Event()
+    joins = asyncio.gather(
+        *(join(f'{base}/game/{game_id}', i, joined, done)
+          for i in range(args.clients))
+    )
+    while len(joined) < args.clients and not joins.done():
+        await asyncio.sleep(0.1)
+    room = rooms[game_id]
+    sockets = sum(len(s) for s in room.users.values())
+    print(f'{args.clients} clients, load stats {server.load_stats}')
+    print(f'sockets in resident room: {sockets}')
+    errors = []
+    if server.load_stats['loads'] != 1:
+        errors.append(f'{server.load_stats["loads"]} loads, expected 1')
+    if sockets != args.clients:
+        errors.append(f'{sockets} sockets in the room, expected '
+                      f'{args.clients}')
+    done.set()
+    latencies = sorted(await joins)
+    print(f'time to game-state p50 {latencies[len(latencies) // 2]:.3f}s '
+          f'max {latencies[-1]:.3f}s')
+
+    ws_server.close()
+    await ws_server.wait_closed()
+    await pr.del_game(game_id)
+    await pr.close()
+    for error in errors:
+        print(f'FAIL: {error}')
+    return not errors
+
+
+if __name__ == '__main__':
+    ok = asyncio.get_event_loop().run_until_complete(main())
+    sys.exit(0 if ok else 1)
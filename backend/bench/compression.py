@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+permessage-deflate policies on a replayed game message stream: ratio and
+CPU time per message tag, to pick server.py --compression-* options.
+
+The stream is what a player socket receives during a round: a game-state
+or game-patch and a user-state per guessed word, as sent by the server.
+"""
+
+import argparse
+import itertools
+import os
+import sys
+import time
+from collections import defaultdict
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from websockets.frames import Frame, OP_TEXT  # noqa: E402
+
+from micro import SIZES, make_game  # noqa: E402
+from onliapa.server.compression import ThresholdDeflate, \
+    message_tag  # noqa: E402
+from onliapa.server.protocol import rmsg  # noqa: E402
+
+
+def stream(size: str, length: int):
+    """ Messages of `length` guessed words, fewer if the hat empties """
+    game = make_game(*SIZES[size])
+    asker = game.users[0]
+    messages = []
+    for _ in range(length):
+        if not len(game.hat):
+            break
+        word = game.hat.get()
+        game.hat.remove(word)
+        asker.score += 1
+        asker.add_guessed_word(word)
+        state = game._game_state('user-guessed', None)
+        messages.append(rmsg('game-state', state).encode())
+        messages.append(rmsg('game-patch', game._game_state_patch(state))
+                        .encode())
+        messages.append(rmsg('user-state', game._user_state(asker)).encode())
+    return messages
+
+
+def run(messages, window_bits: int, mem_level: int, min_size: int) -> dict:
+    ext = ThresholdDeflate(
+        False, False, 15, window_bits, {'memLevel': mem_level},
+        min_size=min_size,
+    )
+    stats = defaultdict(lambda: [0, 0, 0, 0.0])
+    for data in messages:
+        start = time.process_time()
+        frame = ext.encode(Frame(True, OP_TEXT, data))
+        elapsed = time.process_time() - start
+        tag_stats = stats[message_tag(data)]
+        tag_stats[0] += 1
+        tag_stats[1] += len(data)
+        tag_stats[2] += len(frame.data)
+        tag_stats[3] += elapsed
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compression policies')
+    parser.add_argument('-s', '--sizes', nargs='+', choices=list(SIZES),
+                        default=list(SIZES))
+    parser.add_argument('-n', '--length', type=int, default=50,
+                        help='guessed words replayed')
+    parser.add_argument('-w', '--window-bits', type=int, nargs='+',
+                        default=[9, 12, 15])
+    parser.add_argument('-m', '--mem-level', type=int, nargs='+',
+                        default=[1, 8])
+    parser.add_argument('-t', '--min-size', type=int, nargs='+',
+                        default=[0, 256])
+    args = parser.parse_args()
+
+    print(f'{"size":6s} {"wbits":>5s} {"mem":>3s} {"min":>5s} '
+          f'{"tag":12s} {"n":>5s} {"raw B":>9s} {"ratio":>7s} '
+          f'{"us/msg":>8s}')
+    for size in args.sizes:
+        messages = stream(size, args.length)
+        for window_bits, mem_level, min_size in itertools.product(
+                args.window_bits, args.mem_level, args.min_size):
+            stats = run(messages, window_bits, mem_level, min_size)
+            for tag, (n, raw, out, cpu) in sorted(stats.items()):
+                print(f'{size:6s} {window_bits:5d} {mem_level:3d} '
+                      f'{min_size:5d} {tag:12s} {n:5d} {raw // n:9d} '
+                      f'{out / raw:7.1%} {cpu / n * 1e6:8.1f}')
+
+
+if __name__ == '__main__':
+    main()
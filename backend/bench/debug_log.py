@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Room broadcast and user send overhead with debug logging off, on, queued
+and sampled. Sockets discard the payload, leaving the room's own cost.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.server.room import GameRoom, RelayedSocket  # noqa: E402
+from bench.broadcast import make_payload  # noqa: E402
+
+log = logging.getLogger('onliapa')
+
+
+class NullSocket(RelayedSocket):
+    def __init__(self, i: int):
+        self.remote_address = ('127.0.0.1', 10000 + i)
+
+    def post(self, payload):
+        pass
+
+
+def set_mode(mode: str, sink):
+    """ Configure the onliapa logger, returns a listener to stop or None """
+    for old in list(log.handlers):
+        log.removeHandler(old)
+    handler = logging.StreamHandler(sink)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s [%(module)s] %(levelname)s - %(message)s'))
+    log.setLevel(logging.INFO if mode == 'off' else logging.DEBUG)
+    if mode in ('off', 'on'):
+        log.addHandler(handler)
+        return None
+    from onliapa.server.logs import start_queue_logging
+    return start_queue_logging(
+        log, handler, debug_sample=100 if mode == 'sampled' else 1)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Debug logging cost')
+    parser.add_argument('-n', '--sockets', type=int, default=50)
+    parser.add_argument('-b', '--broadcasts', type=int, default=2000)
+    parser.add_argument('-w', '--words-per-user', type=int, default=20)
+    parser.add_argument('-m', '--modes', nargs='+',
+                        choices=('off', 'on', 'queue', 'sampled'),
+                        default=['off', 'on', 'queue', 'sampled'])
+    parser.add_argument('-o', '--output', default=os.devnull,
+                        help='log sink file')
+    args = parser.parse_args()
+
+    room = GameRoom('bench', emitter=None)
+    for uid in range(args.sockets):
+        room.user_names[uid] = f'user{uid}'
+        room.users[uid].add(NullSocket(uid))
+    data = make_payload(args.sockets, args.words_per_user)
+    print(f'{args.sockets} sockets, payload {len(data)} bytes')
+
+    with open(args.output, 'w') as sink:
+        for mode in args.modes:
+            listener = set_mode(mode, sink)
+            cpu = time.process_time()
+            for _ in range(args.broadcasts):
+                await room.broadcast(data)
+            broadcast = (time.process_time() - cpu) / args.broadcasts
+            cpu = time.process_time()
+            for i in range(args.broadcasts):
+                await room.user_send(i % args.sockets, data)
+            user_send = (time.process_time() - cpu) / args.broadcasts
+            if listener is not None:
+                listener.stop()
+            print(f'debug {mode:8s} broadcast {broadcast * 1e6:8.1f}us '
+                  f'user send {user_send * 1e6:8.1f}us cpu')
+        set_mode('off', sink)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
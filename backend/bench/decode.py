@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+""" Incoming message decode throughput, messages per second per core """
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.server import messages as msg  # noqa: E402
+
+
+def legacy_load(expected, kwargs):
+    """ Previous behaviour: new marshmallow Schema for every message """
+    schema = getattr(expected.t, 'Schema')()
+    return expected.t(**schema.load(kwargs))
+
+
+def compiled_load(expected, kwargs):
+    return expected(**kwargs)
+
+
+MESSAGES = (
+    ('hat-add-words', msg.HatAddWords,
+     {'words': [f'word{i}' for i in range(10)]}),
+    ('word-guessed', msg.Empty, {}),
+    ('admin-start-round', msg.AdminStartRound,
+     {'user_id_from': 123456, 'user_id_to': 654321}),
+)
+
+
+def bench(load, expected, raw: str, n: int) -> float:
+    start = time.process_time()
+    for _ in range(n):
+        decoded = json.loads(raw)
+        load(expected, decoded['message'])
+    return n / (time.process_time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode benchmark')
+    parser.add_argument('-n', type=int, default=50000)
+    args = parser.parse_args()
+
+    for tag, expected, message in MESSAGES:
+        raw = json.dumps({'tag': tag, 'message': message})
+        old = bench(legacy_load, expected, raw, args.n)
+        new = bench(compiled_load, expected, raw, args.n)
+        print(f'{tag:18s} schema per message {old:10.0f} msg/s, '
+              f'compiled {new:10.0f} msg/s')
+
+
+if __name__ == '__main__':
+    main()
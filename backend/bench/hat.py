@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+""" Hat draw and removal cost: set copy per draw vs indexed array """
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.game.game import Hat  # noqa: E402
+
+
+class SetHat(Hat):
+    """ Previous implementation """
+
+    def __init__(self):
+        super().__init__()
+        self._words = set()
+
+    def put(self, word: str):
+        self._words.add(word.lower())
+
+    def remove(self, word: str):
+        self._words.discard(word)
+
+    def get(self) -> str:
+        return random.choice(list(self._words))
+
+    def deserialize(self, state: dict):
+        self._words = set(state['words'])
+
+
+def bench(hat_cls, n_words: int, n_draws: int) -> float:
+    hat = hat_cls()
+    hat.deserialize({'words': [f'word{i}' for i in range(n_words)]})
+    start = time.perf_counter()
+    for _ in range(n_draws):
+        hat.remove(hat.get())
+    return (time.perf_counter() - start) / n_draws
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hat benchmark')
+    parser.add_argument('-d', '--draws', type=int, default=200)
+    parser.add_argument(
+        'sizes', type=int, nargs='*', default=[10000, 100000, 500000])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        old = bench(SetHat, size, args.draws)
+        new = bench(Hat, size, args.draws)
+        print(f'{size:7d} words: set {old * 1e6:10.2f}us '
+              f'indexed {new * 1e6:8.2f}us per get+remove')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+"""
+Full game lifecycle load: admins create games and run rounds, players join,
+fill the hat and guess words. Reports latency per message type, broadcast
+delivery skew and errors.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, Optional
+
+import websockets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.server.protocol import rmsg  # noqa: E402
+
+# Game states sent to a single socket, not broadcasts
+UNICAST_REASONS = ('connect', 'resync')
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.skews: List[float] = []
+        self.errors: Counter = Counter()
+        self.broadcasts = 0
+        self.games_done = 0
+        self.frames = 0
+        self.messages = 0
+
+    def merge(self, other: dict):
+        for tag, values in other['latencies'].items():
+            self.latencies[tag].extend(values)
+        self.skews.extend(other['skews'])
+        self.errors.update(other['errors'])
+        self.broadcasts += other['broadcasts']
+        self.games_done += other['games_done']
+        self.frames += other['frames']
+        self.messages += other['messages']
+
+    def dump(self) -> dict:
+        return {
+            'latencies': dict(self.latencies),
+            'skews': self.skews,
+            'errors': dict(self.errors),
+            'broadcasts': self.broadcasts,
+            'games_done': self.games_done,
+            'frames': self.frames,
+            'messages': self.messages,
+        }
+
+
+class GameTracker:
+    """ Arrival times of each broadcast (by seq) at the game sockets """
+
+    def __init__(self):
+        self.arrivals: Dict[int, List[float]] = {}
+
+    def arrival(self, seq: int, ts: float):
+        times = self.arrivals.get(seq)
+        if times is None:
+            self.arrivals[seq] = [ts, ts, 1]
+        else:
+            times[1] = ts
+            times[2] += 1
+
+    def collect(self, stats: Stats):
+        for first, last, n in self.arrivals.values():
+            if n > 1:
+                stats.skews.append(last - first)
+                stats.broadcasts += 1
+
+
+class Client:
+    """ Socket reading in background, requests wait for a matching reply """
+    TIMEOUT = 10.0
+
+    def __init__(self, ws, stats: Stats, game: Optional[GameTracker]):
+        self.ws = ws
+        self.stats = stats
+        self.game = game
+        self.user_id: Optional[int] = None
+        self.last_state: Optional[dict] = None
+        self._waiters: List[tuple] = []
+        self._reader = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls, uri: str, stats: Stats,
+                      game: Optional[GameTracker] = None) -> 'Client':
+        return cls(await websockets.connect(uri, max_size=None), stats, game)
+
+    async def _read(self):
+        try:
+            async for raw in self.ws:
+                now = time.perf_counter()
+                self.stats.frames += 1
+                message = json.loads(raw)
+                if message['tag'] == 'batch':
+                    for item in message['message']:
+                        self._received(item, now)
+                else:
+                    self._received(message, now)
+        except websockets.ConnectionClosed as err:
+            if err.code not in (1000, 1001):
+                self.stats.errors[f'closed-{err.code}'] += 1
+        finally:
+            for _, future in self._waiters:
+                if not future.done():
+                    future.set_exception(
+                        websockets.ConnectionClosed(1006, 'reader stopped'))
+
+    def _received(self, message: dict, now: float):
+        self.stats.messages += 1
+        tag = message['tag']
+        if 'error' in message:
+            self.stats.errors[tag] += 1
+        elif tag == 'game-state':
+            self.last_state = message['message']
+            if (
+                self.game is not None and
+                self.last_state['reason'] not in UNICAST_REASONS
+            ):
+                self.game.arrival(self.last_state['seq'], now)
+        for waiter in list(self._waiters):
+            predicate, future = waiter
+            if not future.done() and predicate(message):
+                future.set_result(message)
+                self._waiters.remove(waiter)
+
+    def expect(self, predicate: Callable[[dict], bool]) -> asyncio.Future:
+        future = asyncio.get_event_loop().create_future()
+        self._waiters.append((predicate, future))
+        return future
+
+    async def request(
+            self,
+            name: str,
+            tag: str,
+            message: dict,
+            until: Callable[[dict], bool],
+    ) -> Optional[dict]:
+        """ Send, wait for the reply (or an error) and record latency """
+        reply = self.expect(lambda m: 'error' in m or until(m))
+        start = time.perf_counter()
+        await self.ws.send(rmsg(tag, message))
+        try:
+            res = await asyncio.wait_for(reply, self.TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats.errors[f'timeout-{name}'] += 1
+            return None
+        if 'error' in res:
+            return None
+        self.stats.latencies[name].append(time.perf_counter() - start)
+        return res
+
+    async def close(self):
+        await self.ws.close()
+        await self._reader
+
+
+def state_is(reason: str = None, name: str = None):
+    def predicate(m: dict) -> bool:
+        return m['tag'] == 'game-state' and (
+            reason is None or m['message']['reason'] == reason
+        ) and (
+            name is None or m['message']['state_name'] == name
+        )
+    return predicate
+
+
+def has_put_words(user_id: int):
+    def predicate(m: dict) -> bool:
+        if m['tag'] != 'game-state':
+            return False
+        hat_fill = m['message']['state_hat_fill']
+        return hat_fill is not None and user_id in hat_fill['users']
+    return predicate
+
+
+async def join_player(base: str, game_id: str, i: int, stats: Stats,
+                      game: GameTracker, query: str = '') -> Client:
+    player = await Client.connect(
+        f'{base}/ws/game/{game_id}{query}', stats, game)
+    connected = player.expect(state_is('connect'))
+    res = await player.request(
+        'user-auth', 'user-auth', {'user_name': f'player{i}'},
+        until=lambda m: m['tag'] == 'auth-ok',
+    )
+    if res is None:
+        raise RuntimeError('auth failed')
+    player.user_id = res['message']['user_id']
+    await asyncio.wait_for(connected, Client.TIMEOUT)
+    return player
+
+
+async def play_round(args, admin: Client, asker: Client, answerer: Client):
+    finished = admin.expect(state_is('round-finished'))
+    res = await admin.request(
+        'admin-start-round', 'start-round',
+        {'user_id_from': asker.user_id, 'user_id_to': answerer.user_id},
+        until=state_is('round-start'),
+    )
+    if res is None:
+        finished.cancel()
+        return
+    deadline = time.monotonic() + args.round_length - args.guess_interval
+    while time.monotonic() < deadline and not finished.done():
+        await asyncio.sleep(args.guess_interval * random.uniform(0.5, 1.5))
+        words_left = asker.last_state['game_info']['hat_words_left']
+        # An empty hat ends the round early, keep it for the next rounds
+        if words_left <= 1 or finished.done():
+            break
+        await asker.request(
+            'word-guessed', 'word-guessed', {},
+            until=state_is('user-guessed'),
+        )
+    try:
+        await asyncio.wait_for(finished, args.round_length + Client.TIMEOUT)
+    except asyncio.TimeoutError:
+        admin.stats.errors['timeout-round-finished'] += 1
+
+
+async def run_game(args, i: int, stats: Stats):
+    base = args.url
+    game = GameTracker()
+    clients = []
+    try:
+        creator = await Client.connect(f'{base}/ws/new_game/', stats)
+        clients.append(creator)
+        res = await creator.request(
+            'new-game', 'new-game',
+            {
+                'game_name': f'load {i}',
+                'round_length': args.round_length,
+                'hat_words_per_user': args.words,
+            },
+            until=lambda m: m['tag'] == 'new-game-id',
+        )
+        if res is None:
+            return
+        game_id = res['message']
+        admin = await Client.connect(
+            f'{base}/ws/admin/{game_id}{args.query}', stats, game)
+        clients.append(admin)
+        await asyncio.wait_for(
+            admin.expect(state_is('connect')), Client.TIMEOUT)
+
+        players = []
+        for j in range(args.players):
+            players.append(await join_player(
+                base, game_id, j, stats, game, args.query))
+            clients.append(players[-1])
+            if args.join_interval:
+                await asyncio.sleep(args.join_interval)
+
+        await asyncio.gather(*(
+            player.request(
+                'hat-add-words', 'hat-add-words',
+                {'words': [f'w{i}x{player.user_id}x{k}'
+                           for k in range(args.words)]},
+                until=has_put_words(player.user_id),
+            )
+            for player in players
+        ))
+        res = await admin.request(
+            'admin-hat-complete', 'hat-complete', {'ignore_not_full': False},
+            until=state_is(name='standby'),
+        )
+        if res is None:
+            return
+
+        for r in range(args.rounds):
+            asker = players[r % len(players)]
+            answerer = players[(r + 1) % len(players)]
+            await play_round(args, admin, asker, answerer)
+        stats.games_done += 1
+    except (OSError, RuntimeError, asyncio.TimeoutError,
+            websockets.WebSocketException) as err:
+        stats.errors[f'game-{err.__class__.__name__}'] += 1
+    finally:
+        await asyncio.gather(
+            *(c.close() for c in clients), return_exceptions=True)
+        game.collect(stats)
+
+
+def run_process(args, first: int, count: int, results):
+    async def main():
+        stats = Stats()
+        tasks = []
+        for i in range(first, first + count):
+            tasks.append(asyncio.ensure_future(run_game(args, i, stats)))
+            await asyncio.sleep(1 / args.game_rate)
+        await asyncio.gather(*tasks)
+        results.put(stats.dump())
+
+    asyncio.new_event_loop().run_until_complete(main())
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def pick(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        'n': len(values),
+        'p50': pick(0.5),
+        'p95': pick(0.95),
+        'p99': pick(0.99),
+        'max': values[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Game lifecycle load')
+    parser.add_argument('-u', '--url', default='ws://127.0.0.1:6613')
+    parser.add_argument('-g', '--games', type=int, default=100)
+    parser.add_argument('-p', '--players', type=int, default=10,
+                        help='players per game')
+    parser.add_argument('-w', '--words', type=int, default=5,
+                        help='hat words per player')
+    parser.add_argument('-r', '--rounds', type=int, default=2,
+                        help='rounds per game')
+    parser.add_argument('--round-length', type=int, default=10,
+                        help='seconds, 10 at least')
+    parser.add_argument('--guess-interval', type=float, default=1.0,
+                        help='mean seconds between guessed words')
+    parser.add_argument('--game-rate', type=float, default=20,
+                        help='games started per second per process')
+    parser.add_argument('--join-interval', type=float, default=0,
+                        help='seconds between players joining a game')
+    parser.add_argument('-c', '--procs', type=int, default=1,
+                        help='client processes')
+    parser.add_argument('--batch', action='store_true',
+                        help='request batched frames (caps=batch)')
+    parser.add_argument('--json', action='store_true',
+                        help='machine readable output')
+    args = parser.parse_args()
+    args.query = '?caps=batch' if args.batch else ''
+
+    start = time.monotonic()
+    results = multiprocessing.Queue()
+    per_proc = -(-args.games // args.procs)
+    procs = []
+    for first in range(0, args.games, per_proc):
+        count = min(per_proc, args.games - first)
+        procs.append(multiprocessing.Process(
+            target=run_process, args=(args, first, count, results)))
+    for proc in procs:
+        proc.start()
+    stats = Stats()
+    for _ in procs:
+        stats.merge(results.get())
+    for proc in procs:
+        proc.join()
+    elapsed = time.monotonic() - start
+
+    report = {
+        'games': args.games,
+        'games_done': stats.games_done,
+        'sockets': args.games * (args.players + 1),
+        'elapsed': elapsed,
+        'latency': {
+            tag: percentiles(values)
+            for tag, values in sorted(stats.latencies.items())
+        },
+        'broadcast_skew': percentiles(stats.skews),
+        'broadcasts': stats.broadcasts,
+        'frames': stats.frames,
+        'messages': stats.messages,
+        'errors': dict(stats.errors),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f'{stats.games_done}/{args.games} games completed, '
+          f'{report["sockets"]} sockets, {elapsed:.1f}s')
+    print(f'{"message":20s} {"n":>7s} {"p50 ms":>9s} {"p95 ms":>9s} '
+          f'{"p99 ms":>9s} {"max ms":>9s}')
+    rows = list(report['latency'].items())
+    rows.append(('broadcast skew', report['broadcast_skew']))
+    for tag, p in rows:
+        if not p:
+            continue
+        print(f'{tag:20s} {p["n"]:7d} {p["p50"] * 1e3:9.1f} '
+              f'{p["p95"] * 1e3:9.1f} {p["p99"] * 1e3:9.1f} '
+              f'{p["max"] * 1e3:9.1f}')
+    print(f'{stats.messages} messages in {stats.frames} frames received')
+    print(f'errors: {report["errors"] or "none"}')
+
+
+if __name__ == '__main__':
+    main()
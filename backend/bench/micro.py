@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+Hot path microbenchmarks at small, medium and huge game sizes.
+
+Results are JSON: save one run as a baseline (--save) and compare later
+runs against it (--compare), slower cases beyond the threshold are
+reported as regressions and make the exit status non-zero.
+
+The reference baseline is bench/baselines/micro.json, the default file of
+both options. It records the machine, architecture and Python version it
+was taken on: compare against it on comparable hardware only, or save a
+local baseline first.
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, Iterator, Tuple
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+BASELINE = os.path.join(BACKEND, 'bench', 'baselines', 'micro.json')
+
+from onliapa.game.game import Game, GameUser, Hat, RoundState, \
+    Timer  # noqa: E402
+from onliapa.game.helpers import state_serialize, \
+    state_deserialize  # noqa: E402
+from onliapa.server import messages as msg  # noqa: E402
+from onliapa.server.auth import User  # noqa: E402
+from onliapa.server.protocol import rmsg, transcode  # noqa: E402
+
+# users, hat words per user
+SIZES = {
+    'small': (5, 5),
+    'medium': (20, 50),
+    'huge': (200, 1000),
+}
+
+Case = Tuple[str, Callable[[], object]]
+
+
+def make_game(n_users: int, words_per_user: int) -> Game:
+    """ Game in a round with half of the words guessed """
+    game = Game(
+        game_id='benchgam',
+        game_name='bench',
+        round_length=60,
+        hat_words_per_user=words_per_user,
+        state_saver=lambda dump: None,
+    )
+    for i in range(n_users):
+        game.users[i] = GameUser(User(i, f'user{i}'))
+        for j in range(words_per_user):
+            game.hat.put(f'слово{i}x{j}')
+    for i, word in enumerate(list(game.hat.serialize()['words'])[::2]):
+        game.hat.remove(word)
+        user = game.users[i % n_users]
+        user.score += 1
+        user.add_guessed_word(word)
+    if n_users > 1:
+        game._state = RoundState(
+            game.users[0], game.users[1], game.hat.get(),
+            Timer(time.time(), 60),
+        )
+    return game
+
+
+def stored_fields(game: Game) -> dict:
+    """ Full dump as Persister.load_game returns it """
+    dump = game._dump_state(full=True)
+    game._full_save = True
+    return {
+        'meta': dump['meta'],
+        'users': {str(k): v for k, v in dump['users'].items()},
+        'hat': dump['hat_added'],
+    }
+
+
+def protocol_cases(n_users: int, words_per_user: int) -> Iterator[Case]:
+    game = make_game(n_users, words_per_user)
+    state = game._game_state('user-guessed', None)
+    yield 'transcode', lambda: transcode(state)
+    yield 'rmsg', lambda: rmsg('game-state', state)
+
+    words = [f'word{i}' for i in range(words_per_user)]
+    raw = json.dumps({'tag': 'hat-add-words', 'message': {'words': words}})
+
+    def decode():
+        decoded = json.loads(raw)
+        return msg.HatAddWords(**decoded['message'])
+
+    yield 'decode.hat-add-words', decode
+
+
+def hat_cases(n_users: int, words_per_user: int) -> Iterator[Case]:
+    words = [f'слово{i}' for i in range(n_users * words_per_user)]
+    hat = Hat()
+    hat.deserialize({'words': words})
+
+    def put_remove():
+        hat.put('ЗаНоВо')
+        hat.remove('заново')
+
+    def get_remove_put():
+        word = hat.get()
+        hat.remove(word)
+        hat.put(word)
+
+    yield 'hat.put+remove', put_remove
+    yield 'hat.get+remove+put', get_remove_put
+
+
+def game_cases(n_users: int, words_per_user: int) -> Iterator[Case]:
+    game = make_game(n_users, words_per_user)
+    yield 'game._game_state_msg', \
+        lambda: game._game_state_msg('user-guessed', None)
+    yield 'game._game_state_payload', \
+        lambda: game._game_state_payload('connect')
+    yield 'game.serialize', game.serialize
+
+    fields = stored_fields(game)
+    yield 'game.load_state', \
+        lambda: Game.load_state(fields, state_saver=lambda dump: None)
+
+    snapshot = game.serialize()
+    blob = state_serialize(snapshot)
+    yield 'state_serialize', lambda: state_serialize(snapshot)
+    yield 'state_deserialize', lambda: state_deserialize(blob)
+
+
+GROUPS = (protocol_cases, hat_cases, game_cases)
+
+
+def measure(fn: Callable[[], object], budget: float,
+            repeats: int) -> Dict[str, float]:
+    """ Seconds per call: best and median of `repeats` timed batches """
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= budget / repeats / 2 or number >= 1 << 20:
+            break
+        number *= 2
+    runs = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        runs.append((time.perf_counter() - start) / number)
+    return {
+        'best': min(runs),
+        'median': statistics.median(runs),
+        'loops': number,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=BACKEND, stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def run(args) -> dict:
+    results = {}
+    for size in args.sizes:
+        for group in GROUPS:
+            for name, fn in group(*SIZES[size]):
+                key = f'{name}/{size}'
+                if args.filter and args.filter not in key:
+                    continue
+                results[key] = measure(fn, args.time, args.repeats)
+                if not args.json:
+                    print(f'{key:32s} {results[key]["best"] * 1e6:12.2f} us',
+                          file=sys.stderr)
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'arch': platform.machine(),
+        'cpus': os.cpu_count(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'results': results,
+    }
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> dict:
+    """ Relative change of the best time per case, positive is slower """
+    report = {'regressions': [], 'improvements': [], 'cases': {}}
+    for key, result in current['results'].items():
+        base = baseline['results'].get(key)
+        if base is None:
+            continue
+        change = result['best'] / base['best'] - 1
+        report['cases'][key] = change
+        if change > threshold:
+            report['regressions'].append(key)
+        elif change < -threshold:
+            report['improvements'].append(key)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hot path microbenchmarks')
+    parser.add_argument('-t', '--time', type=float, default=0.5,
+                        help='seconds per case')
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    parser.add_argument('-s', '--sizes', nargs='+', choices=list(SIZES),
+                        default=list(SIZES))
+    parser.add_argument('-k', '--filter', help='run cases containing this')
+    parser.add_argument('--save', metavar='FILE', nargs='?', const=BASELINE,
+                        help='store results as a baseline (default file '
+                             'bench/baselines/micro.json)')
+    parser.add_argument('--compare', metavar='FILE', nargs='?',
+                        const=BASELINE,
+                        help='report changes against a baseline (default '
+                             'file bench/baselines/micro.json)')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative slowdown reported as regression')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    args = parser.parse_args()
+
+    current = run(args)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)),
+                    exist_ok=True)
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    report = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        report = compare(baseline, current, args.threshold)
+        current['baseline'] = {
+            'commit': baseline.get('commit'),
+            'time': baseline.get('time'),
+        }
+        current['comparison'] = report
+
+    if args.json:
+        print(json.dumps(current, indent=2, sort_keys=True))
+    elif report is not None:
+        print(f'Against baseline {baseline.get("commit")} '
+              f'({baseline.get("time")}), threshold {args.threshold:.0%}')
+        for key, change in report['cases'].items():
+            if key in report['regressions']:
+                mark = 'REGRESSION'
+            elif key in report['improvements']:
+                mark = 'improved'
+            else:
+                mark = ''
+            print(f'{key:32s} {change:+8.1%} {mark}')
+    if report is not None and report['regressions']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
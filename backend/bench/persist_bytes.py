@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+""" Bytes written per round: full state blob vs field-level changes """
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.game.game import Game, GameUser  # noqa: E402
+from onliapa.game.helpers import state_serialize  # noqa: E402
+from onliapa.server.auth import User  # noqa: E402
+
+
+def changes_size(changes: dict) -> int:
+    return (
+        len(changes['meta']) +
+        sum(len(v) for v in changes['users'].values()) +
+        sum(len(w) for w in changes['hat_added']) +
+        sum(len(w) for w in changes['hat_removed'])
+    )
+
+
+def make_game(n_users: int, words_per_user: int) -> Game:
+    game = Game(
+        game_id='benchgam',
+        game_name='bench',
+        round_length=60,
+        hat_words_per_user=words_per_user,
+        state_saver=lambda dump: None,
+    )
+    for i in range(n_users):
+        game.users[i] = GameUser(User(i, f'user{i}'))
+        for j in range(words_per_user):
+            game.hat.put(f'word{i}x{j}')
+    # Initial full save
+    game._dump_state()
+    return game
+
+
+def play_round(game: Game, user_id: int, guesses: int):
+    user = game.users[user_id]
+    for _ in range(min(guesses, len(game.hat))):
+        word = game.hat.get()
+        game.hat.remove(word)
+        user.score += 1
+        user.add_guessed_word(word)
+    game._changed_users.add(user_id)
+    game.round_num += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Persisted bytes per round')
+    parser.add_argument('-r', '--rounds', type=int, default=20)
+    parser.add_argument('-g', '--guesses', type=int, default=10)
+    args = parser.parse_args()
+
+    for n_users, words_per_user in ((10, 10), (50, 100), (200, 1000)):
+        game = make_game(n_users, words_per_user)
+        blob = fields = 0
+        for i in range(args.rounds):
+            play_round(game, i % n_users, args.guesses)
+            blob += len(state_serialize(game.serialize()))
+            fields += changes_size(game._dump_state())
+        print(f'{n_users:4d} users x {words_per_user:4d} words: '
+              f'blob {blob // args.rounds:9d} B/round, '
+              f'fields {fields // args.rounds:6d} B/round')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+""" Save/load throughput: pool per call vs shared persister pool """
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import aioredis
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.persister.persister import Persister  # noqa: E402
+
+
+class PoolPerCallPersister(Persister):
+    """ Previous behaviour: a new pool on every call, never closed """
+
+    async def _redis(self):
+        return await aioredis.create_redis_pool(self.redis_url)
+
+
+async def run(pr: Persister, n: int, concurrency: int, state: str):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        async with sem:
+            await pr.save_game(f'bench{i % concurrency}', state)
+            await pr.load_game(f'bench{i % concurrency}')
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    return time.perf_counter() - start
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Persister benchmark')
+    parser.add_argument('-r', '--redis-url', default='redis://localhost')
+    parser.add_argument('-n', type=int, default=2000, help='save+load pairs')
+    parser.add_argument('-c', '--concurrency', type=int, default=50)
+    parser.add_argument('-s', '--state-size', type=int, default=4096)
+    args = parser.parse_args()
+
+    state = 'x' * args.state_size
+    # Keep the per-call variant smaller, it leaks sockets
+    n_old = min(args.n, 500)
+    old = PoolPerCallPersister(args.redis_url, health_check_interval=0)
+    elapsed = await run(old, n_old, args.concurrency, state)
+    print(f'pool per call: {n_old / elapsed:10.1f} save+load/s')
+
+    new = Persister(
+        args.redis_url,
+        pool_maxsize=args.concurrency,
+        health_check_interval=0,
+    )
+    await new.connect()
+    elapsed = await run(new, args.n, args.concurrency, state)
+    print(f'shared pool:   {args.n / elapsed:10.1f} save+load/s')
+    print(f'pool stats: {new.stats()}')
+    for i in range(args.concurrency):
+        await new.del_game(f'bench{i}')
+    await new.close()
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
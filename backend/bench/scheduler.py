@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+""" Round timers: shared scheduler heap vs a sleeping task per round """
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.server.scheduler import Scheduler  # noqa: E402
+
+
+async def run_scheduler(delays, cancel_every: int):
+    loop = asyncio.get_event_loop()
+    sched = Scheduler()
+    lateness = []
+    done = asyncio.Event()
+    expected = sum(1 for i in range(len(delays)) if i % cancel_every)
+
+    def callback(deadline: float):
+        async def fire():
+            lateness.append(loop.time() - deadline)
+            if len(lateness) == expected:
+                done.set()
+        return fire
+
+    cpu = time.process_time()
+    for i, delay in enumerate(delays):
+        sched.schedule(str(i), delay, callback(loop.time() + delay))
+    for i in range(0, len(delays), cancel_every):
+        sched.cancel(str(i))
+    setup = time.process_time() - cpu
+    await done.wait()
+    return setup, time.process_time() - cpu, lateness
+
+
+async def run_tasks(delays, cancel_every: int):
+    loop = asyncio.get_event_loop()
+    lateness = []
+    done = asyncio.Event()
+    expected = sum(1 for i in range(len(delays)) if i % cancel_every)
+
+    async def round_timer(delay: float):
+        deadline = loop.time() + delay
+        await asyncio.sleep(delay)
+        lateness.append(loop.time() - deadline)
+        if len(lateness) == expected:
+            done.set()
+
+    cpu = time.process_time()
+    tasks = [asyncio.ensure_future(round_timer(d)) for d in delays]
+    for task in tasks[::cancel_every]:
+        task.cancel()
+    setup = time.process_time() - cpu
+    await done.wait()
+    return setup, time.process_time() - cpu, lateness
+
+
+def pct(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Round timer benchmark')
+    parser.add_argument('-n', '--rounds', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('-s', '--spread', type=float, default=3.0,
+                        help='deadlines spread over seconds')
+    parser.add_argument('-c', '--cancel-every', type=int, default=5,
+                        help='cancel one of N rounds (early finish)')
+    args = parser.parse_args()
+
+    for n in args.rounds:
+        delays = [random.uniform(0.5, args.spread) for _ in range(n)]
+        for name, run in (('scheduler', run_scheduler),
+                          ('task/round', run_tasks)):
+            setup, cpu, late = await run(delays, args.cancel_every)
+            print(f'{n:7d} rounds {name:10s} setup {setup * 1e3:8.1f}ms '
+                  f'total cpu {cpu * 1e3:8.1f}ms  lateness p50 '
+                  f'{pct(late, 0.5) * 1e3:6.2f}ms p99 '
+                  f'{pct(late, 0.99) * 1e3:6.2f}ms')
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+""" Server throughput with 1..N worker processes (server.py --workers) """
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+
+import websockets
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from onliapa.server.protocol import rmsg  # noqa: E402
+
+
+async def wait_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.1)
+
+
+async def create_games(base: str, n: int) -> list:
+    games = []
+    for i in range(n):
+        async with websockets.connect(f'{base}/new_game/') as ws:
+            await ws.send(rmsg('new-game', {
+                'game_name': f'game{i}',
+                'round_length': 60,
+                'hat_words_per_user': 5,
+            }))
+            games.append(json.loads(await ws.recv())['message'])
+    return games
+
+
+def run_clients(base: str, games: list, players: int, duration: float,
+                results):
+    """ Closed loop: each player requests a game state resync and waits """
+    async def player(game_id: str, i: int) -> int:
+        done = 0
+        async with websockets.connect(f'{base}/game/{game_id}') as ws:
+            await ws.send(rmsg('user-auth', {'user_name': f'player{i}'}))
+            while json.loads(await ws.recv())['tag'] != 'game-state':
+                pass
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                await ws.send(rmsg('resync', {}))
+                while json.loads(await ws.recv())['tag'] != 'game-state':
+                    pass
+                done += 1
+        return done
+
+    async def main():
+        counts = await asyncio.gather(*(
+            player(game_id, i)
+            for game_id in games
+            for i in range(players)
+        ))
+        results.put(sum(counts))
+
+    asyncio.new_event_loop().run_until_complete(main())
+
+
+async def measure(args, workers: int) -> float:
+    port = args.port
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND, 'server.py'),
+         '-p', str(port), '-r', args.redis_url, '-w', str(workers),
+         '--room-idle-timeout', '0'],
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        await wait_port(port)
+        base = f'ws://127.0.0.1:{port}/ws'
+        games = await create_games(base, args.games)
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=run_clients,
+                args=(base, games[i::args.client_procs], args.players,
+                      args.time, results),
+            )
+            for i in range(args.client_procs)
+        ]
+        for proc in procs:
+            proc.start()
+        total = sum(results.get() for _ in procs)
+        for proc in procs:
+            proc.join()
+        return total / args.time
+    finally:
+        server.terminate()
+        server.wait()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Sharded server throughput')
+    parser.add_argument('-r', '--redis-url', default='redis://localhost')
+    parser.add_argument('-p', '--port', type=int, default=6692)
+    parser.add_argument('-w', '--workers', type=int, nargs='+',
+                        default=[1, 2, 4])
+    parser.add_argument('-g', '--games', type=int, default=40)
+    parser.add_argument('-n', '--players', type=int, default=10,
+                        help='players per game')
+    parser.add_argument('-c', '--client-procs', type=int, default=4)
+    parser.add_argument('-t', '--time', type=float, default=5.0)
+    args = parser.parse_args()
+
+    print(f'{os.cpu_count()} CPUs, {args.games} games x {args.players} '
+          f'players, {args.client_procs} client processes')
+    base_rate = None
+    for workers in args.workers:
+        rate = await measure(args, workers)
+        base_rate = base_rate or rate
+        print(f'{workers:3d} workers: {rate:9.0f} resyncs/s '
+              f'({rate / base_rate:.2f}x)')
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
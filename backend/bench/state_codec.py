@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+""" State codec: binary snapshot vs legacy base64(zlib(json)), size and speed """
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from onliapa.game.game import Game, GameUser  # noqa: E402
+from onliapa.game.helpers import state_serialize, state_deserialize, \
+    user_serialize, user_deserialize  # noqa: E402
+from onliapa.server.auth import User  # noqa: E402
+
+
+def legacy_serialize(state: dict) -> str:
+    return base64.b64encode(zlib.compress(json.dumps(state).encode())).decode()
+
+
+def make_state(n_users: int, words_per_user: int) -> dict:
+    game = Game(
+        game_id='benchgam',
+        game_name='bench',
+        round_length=60,
+        hat_words_per_user=words_per_user,
+        state_saver=lambda dump: None,
+    )
+    for i in range(n_users):
+        game.users[i] = GameUser(User(i, f'user{i}'))
+        for j in range(words_per_user):
+            game.hat.put(f'слово{i}x{j}')
+    # Half of the words guessed
+    for i, word in enumerate(list(game.hat.serialize()['words'])[::2]):
+        game.hat.remove(word)
+        user = game.users[i % n_users]
+        user.score += 1
+        user.add_guessed_word(word)
+    return game.serialize()
+
+
+def timeit(fn, arg, budget: float) -> float:
+    n = 0
+    start = time.perf_counter()
+    while True:
+        fn(arg)
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= budget:
+            return elapsed / n
+
+
+def main():
+    parser = argparse.ArgumentParser(description='State codec benchmark')
+    parser.add_argument('-t', '--time', type=float, default=1.0,
+                        help='seconds per measurement')
+    args = parser.parse_args()
+
+    for n_users, words_per_user in ((10, 10), (50, 100), (200, 1000)):
+        state = make_state(n_users, words_per_user)
+        print(f'{n_users} users x {words_per_user} words')
+        for name, ser in (('legacy', legacy_serialize),
+                          ('binary', state_serialize)):
+            blob = ser(state)
+            assert state_deserialize(blob)['hat'] == state['hat']
+            enc = timeit(ser, state, args.time)
+            dec = timeit(state_deserialize, blob, args.time)
+            print(f'  snapshot {name:6s} {len(blob):9d} B  '
+                  f'encode {enc * 1e3:8.3f} ms  decode {dec * 1e3:8.3f} ms')
+        user = next(iter(state['users'].values()))
+        for name, ser, de in (
+                ('json', lambda u: json.dumps(u).encode(), json.loads),
+                ('binary', user_serialize, user_deserialize),
+        ):
+            record = ser(user)
+            enc = timeit(ser, user, args.time / 4)
+            dec = timeit(de, record, args.time / 4)
+            print(f'  user rec {name:6s} {len(record):9d} B  '
+                  f'encode {enc * 1e6:8.1f} us  decode {dec * 1e6:8.1f} us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+"""
+Time to first game state after a restart, with and without warm start.
+
+Stores games in redis, then for each mode starts server.py, waits until it
+accepts connections and connects an admin to every game at once. Reports
+the time from process start until the port accepts and the latency from
+connecting to the first game state.
+"""
+
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from typing import List
+
+import websockets
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+
+from onliapa.game.game import Game, GameUser  # noqa: E402
+from onliapa.persister.persister import Persister  # noqa: E402
+from onliapa.server.auth import User  # noqa: E402
+from onliapa.server.server import GAME_ID_LETTERS  # noqa: E402
+
+# Bench games are told apart from real ones by their id prefix
+PREFIX = 'wrm'
+
+
+def game_ids(n: int) -> List[str]:
+    width = 8 - len(PREFIX)
+    ids = []
+    for i in range(n):
+        digits = ''
+        for _ in range(width):
+            i, d = divmod(i, len(GAME_ID_LETTERS))
+            digits += GAME_ID_LETTERS[d]
+        ids.append(PREFIX + digits)
+    return ids
+
+
+async def store_games(redis_url: str, ids: List[str], users: int,
+                      words: int):
+    pr = Persister(redis_url, health_check_interval=0)
+    await pr.connect()
+    batch = {}
+    for game_id in ids:
+        game = Game(
+            game_id=game_id,
+            game_name=f'warm {game_id}',
+            round_length=60,
+            hat_words_per_user=words,
+            state_saver=lambda dump: None,
+        )
+        for i in range(users):
+            game.users[i] = GameUser(User(i, f'user{i}'))
+            for j in range(words):
+                game.hat.put(f'слово{i}x{j}')
+        batch[game_id] = game._dump_state(full=True)
+        if len(batch) == 100:
+            await pr.save_games(batch)
+            batch = {}
+    if batch:
+        await pr.save_games(batch)
+    await pr.close()
+
+
+async def delete_games(redis_url: str, ids: List[str]):
+    pr = Persister(redis_url, health_check_interval=0)
+    await pr.connect()
+    for game_id in ids:
+        await pr.del_game(game_id)
+    await pr.close()
+
+
+async def wait_listening(port: int, timeout: float) -> float:
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.005)
+            continue
+        writer.close()
+        return time.monotonic()
+
+
+async def first_state(url: str) -> float:
+    start = time.monotonic()
+    async with websockets.connect(url, max_size=None) as ws:
+        while True:
+            raw = await ws.recv()
+            if '"game-state"' in raw:
+                return time.monotonic() - start
+
+
+def pct(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_mode(args, ids: List[str], warm: bool):
+    cmd = [sys.executable, os.path.join(BACKEND, 'server.py'),
+           '-p', str(args.port), '-r', args.redis_url]
+    if warm:
+        cmd += ['--warm-games', str(len(ids)),
+                '--warm-budget', str(args.budget)]
+    started = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    try:
+        listening = await wait_listening(args.port, 30) - started
+        begin = time.monotonic()
+        latencies = await asyncio.gather(*(
+            first_state(f'ws://127.0.0.1:{args.port}/ws/admin/{game_id}')
+            for game_id in ids
+        ))
+        total = time.monotonic() - begin
+    finally:
+        proc.terminate()
+        proc.wait()
+    name = 'warm' if warm else 'cold'
+    print(f'{name}: listening after {listening * 1e3:8.1f}ms, all states '
+          f'after {(listening + total) * 1e3:8.1f}ms, first state p50 '
+          f'{pct(latencies, 0.5) * 1e3:7.1f}ms p99 '
+          f'{pct(latencies, 0.99) * 1e3:7.1f}ms max '
+          f'{max(latencies) * 1e3:7.1f}ms')
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Warm start benchmark')
+    parser.add_argument('-g', '--games', type=int, default=500)
+    parser.add_argument('-u', '--users', type=int, default=10,
+                        help='users per game')
+    parser.add_argument('-w', '--words', type=int, default=10,
+                        help='hat words per user')
+    parser.add_argument('-p', '--port', type=int, default=6623)
+    parser.add_argument('-r', '--redis-url', default='redis://localhost')
+    parser.add_argument('--budget', type=float, default=10.0,
+                        help='warm start budget, seconds')
+    args = parser.parse_args()
+
+    ids = game_ids(args.games)
+    await store_games(args.redis_url, ids, args.users, args.words)
+    try:
+        for warm in (False, True):
+            await run_mode(args, ids, warm)
+    finally:
+        await delete_games(args.redis_url, ids)
+
+
+if __name__ == '__main__':
+    asyncio.get_event_loop().run_until_complete(main())
@@ -1,40 +1,70 @@
-import asyncio
 import logging
 import random
 import time
 from collections import defaultdict
-from typing import Set, Dict, Union, Optional, List, Tuple, Callable, Awaitable
+from functools import partial
+from typing import Set, Dict, Union, Optional, List, Tuple, Callable
 
 from websockets import WebSocketServerProtocol
 
-from onliapa.game.helpers import state_serialize, state_deserialize
+from onliapa.game.helpers import state_deserialize, meta_serialize, \
+    meta_deserialize, user_serialize, user_deserialize
 from onliapa.server.auth import User
 from onliapa.server import messages as msg
-from onliapa.server.protocol import rmsg, rerr
-from onliapa.server.room import GameRoom, EventEmitter, EventHandler
+from onliapa.server.protocol import rmsg, rerr, transcode, Payload
+from onliapa.server.room import GameRoom, EventEmitter, EventHandler, rooms
+from onliapa.server.scheduler import scheduler
 
 log = logging.getLogger('onliapa.game')
 
+# Socket capability: receives game-patch instead of full game-state
+CAP_DELTAS = 'deltas'
+
 
 class StateChangeFailed(Exception):
     pass
 
 
 class Hat:
+    """ Word array plus word -> index map, O(1) put, get and remove """
+
     def __init__(self):
-        self._words: Set[str] = set()
+        self._words: List[str] = []
+        self._index: Dict[str, int] = {}
+        # Changes since the last clear_changes()
+        self._added: Set[str] = set()
+        self._removed: Set[str] = set()
 
     def put(self, word: str):
-        self._words.add(word.lower())
+        word = word.lower()
+        if word not in self._index:
+            self._index[word] = len(self._words)
+            self._words.append(word)
+            self._added.add(word)
+            self._removed.discard(word)
 
     def remove(self, word: str):
         try:
-            self._words.remove(word)
+            idx = self._index.pop(word)
         except KeyError:
-            pass
+            return
+        self._removed.add(word)
+        self._added.discard(word)
+        last = self._words.pop()
+        if idx < len(self._words):
+            self._words[idx] = last
+            self._index[last] = idx
 
     def get(self) -> str:
-        return random.choice(list(self._words))
+        return random.choice(self._words)
+
+    def changes(self) -> Tuple[List[str], List[str]]:
+        """ Words added and removed since the last clear_changes() """
+        return list(self._added), list(self._removed)
+
+    def clear_changes(self):
+        self._added = set()
+        self._removed = set()
 
     def serialize(self):
         return {
@@ -42,7 +72,14 @@ class Hat:
         }
 
     def deserialize(self, state: dict):
-        self._words = set(state['words'])
+        self._words = []
+        self._index = {}
+        self._added = set()
+        self._removed = set()
+        for word in state['words']:
+            if word not in self._index:
+                self._index[word] = len(self._words)
+                self._words.append(word)
 
     def __len__(self):
         return len(self._words)
@@ -159,6 +196,9 @@ class GameState:
     def to_message(self):
         raise NotImplementedError()
 
+    def serialize(self) -> dict:
+        return {}
+
     def __str__(self):
         return self.name
 
@@ -176,6 +216,15 @@ class HatFillState(GameState):
     def to_message(self):
         return {'state_hat_fill': msg.StateHatFill(users=list(self.users))}
 
+    def serialize(self) -> dict:
+        return {'users': list(self.users)}
+
+    @classmethod
+    def deserialize(cls, state: dict) -> 'HatFillState':
+        res = cls()
+        res.users = set(state['users'])
+        return res
+
 
 class GameStandbyState(GameState):
     """ Game is on standby """
@@ -213,6 +262,31 @@ class RoundState(GameState):
             ),
         }
 
+    def serialize(self) -> dict:
+        return {
+            'user_from': self.user_from.user.user_id,
+            'user_to': self.user_to.user.user_id,
+            'word': self.word,
+            'start': self.timer.start,
+            'length': self.timer.length,
+            'guessed_words': self.guessed_words,
+        }
+
+    @classmethod
+    def deserialize(
+            cls,
+            state: dict,
+            users: Dict[int, GameUser],
+    ) -> 'RoundState':
+        res = cls(
+            users[state['user_from']],
+            users[state['user_to']],
+            state['word'],
+            Timer(state['start'], state['length']),
+        )
+        res.guessed_words = state['guessed_words']
+        return res
+
 
 game_handler = EventHandler()
 TState = Union[HatFillState, GameStandbyState, RoundState]
@@ -226,6 +300,7 @@ class Game:
 
     room: GameRoom
     round_num: int
+    state_seq: int
     hat: Hat
     users: Dict[int, GameUser]
     _state: TState
@@ -236,21 +311,30 @@ class Game:
         game_name: str,
         round_length: int,
         hat_words_per_user: int,
-        state_saver: Callable[[str], Awaitable[None]],
+        state_saver: Callable[[Callable[[bool], dict]], None],
     ):
         self.game_id = game_id
         self.game_name = game_name
         self.round_length = round_length
         self.hat_words_per_user = hat_words_per_user
 
-        emitter = EventEmitter(game_handler, self)
-        self.room = GameRoom(game_id, emitter)
+        self._emitter = EventEmitter(game_handler, self)
+        self.room = GameRoom(game_id, self._emitter)
 
         self.round_num = 0
         self.hat = Hat()
         self.users = dict()
         self._state = HatFillState()
         self._state_saver = state_saver
+        self.state_seq = 0
+        self._last_state: Optional[Tuple[dict, Dict[int, dict]]] = None
+        # Mutation version and encoded snapshots of it, see _touch()
+        self.version = 0
+        self._snapshots: Dict[tuple, Payload] = {}
+        # Persistence journal, see _dump_state()
+        self._full_save = True
+        self._changed_users: Set[int] = set()
+        self._removed_users: Set[int] = set()
 
     @property
     def state(self) -> TState:
@@ -266,19 +350,25 @@ class Game:
     def _warning(self, message):
         log.warning(f'Game {self.game_id}: {message}')
 
-    async def _send_user_state(
-        self,
-        user: GameUser,
-        sock: Optional[WebSocketServerProtocol] = None
-    ):
+    @staticmethod
+    def _user_state(user: GameUser) -> msg.UserState:
         state_dict = dict(
             state_name=user.state.name,
             state_asking=None,
             state_answering=None,
         )
         state_dict.update(user.state.to_message())
-        message = rmsg('user-state', msg.UserState(**state_dict))
-        return await self.room.user_send(user.user.user_id, message, sock=sock)
+        return msg.UserState(**state_dict)
+
+    async def _send_user_state(
+        self,
+        user: GameUser,
+        sock: Optional[WebSocketServerProtocol] = None,
+        hold: bool = True,
+    ):
+        message = rmsg('user-state', self._user_state(user))
+        return await self.room.user_send(
+            user.user.user_id, message, sock=sock, hold=hold)
 
     def to_message(self) -> msg.GameInfo:
         return msg.GameInfo(
@@ -290,7 +380,7 @@ class Game:
             hat_words_left=len(self.hat),
         )
 
-    def _game_state_msg(self, reason, appendix) -> str:
+    def _game_state(self, reason, appendix) -> msg.GameState:
         state_dict = dict(
             state_name=self.state.name,
             users=list(u.to_message() for u in self.users.values()),
@@ -299,13 +389,79 @@ class Game:
             state_hat_fill=None,
             state_round=None,
             game_info=self.to_message(),
+            seq=self.state_seq,
         )
         state_dict.update(self.state.to_message())
-        return rmsg('game-state', msg.GameState(**state_dict))
+        return msg.GameState(**state_dict)
+
+    def _touch(self):
+        """
+        Invalidate cached snapshots. Called by every game-state broadcast,
+        which follows the mutations it shows, and by mutations not followed
+        by one (users joining and kicked).
+        """
+        self.version += 1
+        self._snapshots.clear()
+
+    def _game_state_msg(self, reason, appendix) -> str:
+        return rmsg('game-state', self._game_state(reason, appendix))
+
+    def _game_state_payload(self, reason) -> Payload:
+        """
+        Encoded game state without appendix, shared by the sockets
+        (re)connecting at the same version. Round time left is part of the
+        key, it changes without mutations.
+        """
+        time_left = (
+            int(self.state.timer.time_left)
+            if isinstance(self.state, RoundState) else None
+        )
+        key = (self.version, self.state_seq, reason, time_left)
+        payload = self._snapshots.get(key)
+        if payload is None:
+            if len(self._snapshots) > 8:
+                self._snapshots.clear()
+            payload = self._snapshots[key] = \
+                Payload(self._game_state_msg(reason, None))
+        return payload
+
+    def _game_state_patch(self, state: msg.GameState) -> msg.GamePatch:
+        """ Diff state against the last broadcast one and remember it """
+        current = transcode(state)
+        users = {u['user_id']: u for u in current.pop('users')}
+        for key in ('reason', 'appendix', 'seq'):
+            del current[key]
+        last, last_users = self._last_state or ({}, {})
+        self._last_state = current, users
+        return msg.GamePatch(
+            seq=state.seq,
+            reason=state.reason,
+            appendix=state.appendix,
+            changes={
+                k: v for k, v in current.items()
+                if k not in last or last[k] != v
+            },
+            users=[u for k, u in users.items() if last_users.get(k) != u],
+            users_removed=[k for k in last_users if k not in users],
+        )
 
     async def _broadcast_game_state(self, reason=None, appendix=None):
-        message = self._game_state_msg(reason=reason, appendix=appendix)
-        await self.room.broadcast(message)
+        self._touch()
+        self.state_seq += 1
+        state = self._game_state(reason=reason, appendix=appendix)
+        if not self.room.any_capable(CAP_DELTAS):
+            # Next patch is against nothing, i.e. complete
+            self._last_state = None
+            await self.room.broadcast(rmsg('game-state', state))
+            return
+        patch = rmsg('game-patch', self._game_state_patch(state))
+        if self.room.all_capable(CAP_DELTAS):
+            await self.room.broadcast(patch)
+        else:
+            await self.room.broadcast(
+                rmsg('game-state', state),
+                variants={CAP_DELTAS: patch},
+            )
 
     async def _send_game_state(
             self,
@@ -314,19 +470,27 @@ class Game:
             appendix=None,
             sock: Optional[WebSocketServerProtocol] = None
     ):
-        message = self._game_state_msg(reason=reason, appendix=appendix)
+        if appendix is None:
+            message = self._game_state_payload(reason)
+        else:
+            message = self._game_state_msg(reason=reason, appendix=appendix)
         if user is None:
             await self.room.admin_send(message, sock=sock)
         else:
             await self.room.user_send(user.user.user_id, message, sock=sock)
 
     @game_handler.handler('join')
-    async def event_join(self, data: Tuple[User, WebSocketServerProtocol]):
-        user, sock = data
+    async def event_join(
+            self,
+            data: Tuple[User, WebSocketServerProtocol, bool],
+    ):
+        user, sock, resumed = data
         if user.user_id not in self.users:
             # Create new game user
             game_user = GameUser(user)
             self.users[user.user_id] = game_user
+            self._changed_users.add(user.user_id)
+            self._touch()
             self._info(f'User {game_user} {user.user_id} joined')
 
             # Broadcast user joined game
@@ -334,14 +498,42 @@ class Game:
             await self.room.broadcast(rmsg('new-user', message))
         else:
             game_user = self.users[user.user_id]
+        if resumed:
+            # Auth, user and game state in one frame
+            message = rmsg('resume-ok', msg.ResumeOk(
+                auth=user.auth_ok(self.game_id),
+                user_state=self._user_state(game_user),
+                game_state=self._game_state('connect', None),
+            ))
+            await self.room.user_send(user.user_id, message, sock=sock)
+            return
         # Send user and game state to user
         await self._send_user_state(game_user, sock=sock)
         await self._send_game_state(game_user, 'connect', sock=sock)
 
+    @game_handler.handler('flush')
+    async def event_flush(self, _):
+        self._save_state()
+
     @game_handler.handler('admin-join')
     async def event_admin_join(self, sock):
         await self._send_game_state(None, 'connect', sock=sock)
 
+    @game_handler.message_handler('resync', msg.Resync)
+    async def msg_resync(self, message: msg.Resync, user: User,
+                         ws: WebSocketServerProtocol):
+        if user.user_id not in self.users:
+            return
+        self.room.set_capability(ws, CAP_DELTAS, message.deltas)
+        await self._send_game_state(self.users[user.user_id], 'resync',
+                                    sock=ws)
+
+    @game_handler.message_handler('admin-resync', msg.Resync)
+    async def msg_admin_resync(self, message: msg.Resync,
+                               ws: WebSocketServerProtocol):
+        self.room.set_capability(ws, CAP_DELTAS, message.deltas)
+        await self._send_game_state(None, 'resync', sock=ws)
+
     @game_handler.message_handler('admin-kick-user', msg.UserId)
     async def event_kick_user(self, message: msg.UserId,
                               ws: WebSocketServerProtocol):
@@ -354,6 +546,9 @@ class Game:
             log.info(f'Wrong user {message.user_id} kick requested by admin')
             return
         del self.users[user_id]
+        self._touch()
+        self._changed_users.discard(user_id)
+        self._removed_users.add(user_id)
         broadcast_msg = msg.UserId(user_id=user_id)
         await self.room.broadcast(rmsg('remove-user', broadcast_msg))
         await self.room.kick(user_id)
@@ -418,7 +613,7 @@ class Game:
 
         self._info('Hat completed. Changing state')
         await self._change_state(GameStandbyState())
-        await self._save_state()
+        self._save_state()
 
     @game_handler.message_handler('hat-add-words', msg.HatAddWords)
     async def msg_hat_add_words(self, message: msg.HatAddWords, user: User,
@@ -494,10 +689,12 @@ class Game:
         )
         self._info(f'Admin starts round {round_num}: {user_from} -> {user_to}')
 
+        # User states are not held for batching, the round needs both
+        # users reachable
         try:
             # Update answering state
             user_to.state = UserStateAnswering(round_timer, user_from)
-            res = await self._send_user_state(user_to)
+            res = await self._send_user_state(user_to, hold=False)
             if not res:
                 reply = rerr(
                     'unavailable-user',
@@ -509,7 +706,7 @@ class Game:
 
             # Update asking state
             user_from.state = UserStateAsking(round_timer, word, user_from)
-            res = await self._send_user_state(user_from)
+            res = await self._send_user_state(user_from, hold=False)
             if not res:
                 reply = rerr(
                     'unavailable-user',
@@ -525,10 +722,10 @@ class Game:
                 raise
             return
 
-        # Start task to update state in timeout
         self.round_num = round_num
-        self.state.start_ts = time.time()
-        await asyncio.create_task(self.await_stop_round())
+        self._touch()
+        self._schedule_round_end()
+        self._save_state()
 
     @game_handler.message_handler('word-guessed', msg.Empty)
     async def msg_word_guessed(self, message: msg.Empty, user: User,
@@ -556,10 +753,12 @@ class Game:
         self._info(f'User {user}: user {self.state.user_to} scored')
         self.state.user_to.score += 1
         self.state.user_to.add_guessed_word(self.state.word)
+        self._changed_users.add(self.state.user_to.user.user_id)
 
         # Remove word
         self.hat.remove(self.state.word)
         self.state.guessed_words.append(self.state.word)
+        self._save_state()
 
         # Broadcast
         msg_user_to = self.state.user_to.to_message()
@@ -583,18 +782,36 @@ class Game:
 
     async def _stop_round(self, reason='timeout'):
         self._info(f'Finishing the round {self.round_num}, {reason}')
+        scheduler.cancel(self.game_id)
         old_state = self.state
         await self._change_state(GameStandbyState(), 'round-finished')
         old_state.user_from.state = UserStateStandby()
         old_state.user_to.state = UserStateStandby()
         await self._send_user_state(old_state.user_from)
         await self._send_user_state(old_state.user_to)
-        await self._save_state()
+        self._save_state()
+
+    def _schedule_round_end(self):
+        """ Finish the current round at its timer deadline """
+        scheduler.schedule(
+            self.game_id,
+            self.state.timer.time_left,
+            partial(self._round_timeout, self.state),
+        )
 
-    async def await_stop_round(self):
-        await asyncio.sleep(self.round_length)
-        assert isinstance(self.state, RoundState)
-        await self._stop_round()
+    async def _round_timeout(self, state: RoundState):
+        if rooms.get(self.game_id) is not self.room:
+            # Evicted or moved to another node, the game finishes the round
+            # from its persisted deadline when loaded again
+            self._info(f'Round {self.round_num} timeout of unloaded game')
+            return
+        # Handled in order with the game messages
+        self._emitter.post('round-timeout', state)
+
+    @game_handler.handler('round-timeout')
+    async def event_round_timeout(self, state: RoundState):
+        if self.state is state:
+            await self._stop_round()
 
     def serialize(self):
         return {
@@ -605,20 +822,101 @@ class Game:
             'round_num': self.round_num,
             'hat': self.hat.serialize(),
             'users': {k: v.serialize() for k, v in self.users.items()},
+            'state': dict(name=self.state.name, **self.state.serialize()),
+        }
+
+    def _meta(self) -> dict:
+        return {
+            'game_id': self.game_id,
+            'game_name': self.game_name,
+            'round_length': self.round_length,
+            'hat_words_per_user': self.hat_words_per_user,
+            'round_num': self.round_num,
+            'state': dict(name=self.state.name, **self.state.serialize()),
+            'users': list(self.users),
         }
 
-    async def _save_state(self):
+    def _dump_state(self, full: bool = False) -> dict:
+        """
+        Changes since the previous dump: game metadata, changed and removed
+        users, words added to and removed from the hat. `full` (or a new or
+        migrated game) dumps everything, replacing the stored state.
+        """
+        full = full or self._full_save
+        if full:
+            users = self.users.keys()
+            removed = []
+            hat_added, hat_removed = self.hat.serialize()['words'], []
+        else:
+            users = self._changed_users
+            removed = list(self._removed_users)
+            hat_added, hat_removed = self.hat.changes()
+        changes = {
+            'full': full,
+            'meta': meta_serialize(self._meta()),
+            'users': {
+                k: user_serialize(self.users[k].serialize()) for k in users
+            },
+            'users_removed': removed,
+            'hat_added': hat_added,
+            'hat_removed': hat_removed,
+        }
+        # Journal is kept until serialization succeeded
+        self.hat.clear_changes()
+        self._full_save = False
+        self._changed_users = set()
+        self._removed_users = set()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'State changes to save {changes}')
+        return changes
+
+    def _resume_round(self, round_state: dict):
+        """
+        Restore a round in progress, finished by the scheduler when its
+        deadline passed. Rounds saved without their state are dropped.
+        """
+        try:
+            state = RoundState.deserialize(round_state, self.users)
+        except KeyError:
+            self._warning('Dropping the round of unknown state')
+            self._state = GameStandbyState()
+            return
+        self._state = state
+        state.user_to.state = UserStateAnswering(state.timer, state.user_from)
+        state.user_from.state = UserStateAsking(
+            state.timer, state.word, state.user_from)
+        self._info(f'Resuming round {self.round_num}, '
+                   f'{state.timer.time_left:.0f}s left')
+        self._schedule_round_end()
+
+    def _save_state(self):
+        """ Mark state dirty, the saver dumps and writes it later """
         self._info('Saving game state')
-        raw_state = self.serialize()
-        log.debug(f'Raw state to save {raw_state}')
-        state = state_serialize(raw_state)
-        await self._state_saver(state)
+        self._state_saver(self._dump_state)
 
     @classmethod
-    def load_state(cls, raw_state: str,
-                   state_saver: Callable[[str], Awaitable[None]]):
-        state = state_deserialize(raw_state)
-        log.debug(f'Loading game state {state}')
+    def load_state(cls, raw_state: Union[bytes, str, dict],
+                   state_saver: Callable[[Callable[[bool], dict]], None]):
+        """
+        Load from persister fields (meta, users, hat), or from a legacy
+        single blob, which is migrated by saving the game in full.
+        """
+        legacy = isinstance(raw_state, (bytes, str))
+        if legacy:
+            state = state_deserialize(raw_state)
+        else:
+            meta = meta_deserialize(raw_state['meta'])
+            users = {
+                int(k): user_deserialize(v)
+                for k, v in raw_state['users'].items()
+            }
+            state = dict(
+                meta,
+                hat={'words': raw_state['hat']},
+                users={k: users[k] for k in meta['users']},
+            )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f'Loading game state {state}')
         game = cls(
             game_id=state['game_id'],
             game_name=state['game_name'],
@@ -633,5 +931,15 @@ class Game:
             for k, v in state['users'].items()
         }
         game.room.user_names = {k: v.user.name for k, v in game.users.items()}
-        game._state = GameStandbyState()
+        game_state = state.get('state', {})
+        if game_state.get('name') == HatFillState.name:
+            game._state = HatFillState.deserialize(game_state)
+        elif game_state.get('name') == RoundState.name:
+            game._resume_round(game_state)
+        else:
+            game._state = GameStandbyState()
+        if legacy:
+            game._save_state()
+        else:
+            game._full_save = False
         return game
@@ -1,11 +1,179 @@
+""" Game state codecs """
+import base64
 import json
+import struct
 import zlib
-import base64
+from itertools import accumulate
+from typing import List, Tuple, Union
+
+# Binary snapshot: magic, version, flags, body
+SNAPSHOT_MAGIC = b'OLP'
+SNAPSHOT_VERSION = 1
+FLAG_ZLIB = 0x01
+# Bodies above it are compressed
+COMPRESS_THRESHOLD = 1024
+# Prefix of binary field values
+FIELD_VERSION = b'\x01'
+
+_U32 = struct.Struct('<I')
+_HEADER = struct.Struct('<3sBB')
+_USER = struct.Struct('<qI')
+_META = struct.Struct('<III')
+
+
+def _pack_str(value: str) -> bytes:
+    # Client text may hold lone surrogates, JSON decoding lets them through
+    data = value.encode('utf-8', 'surrogatepass')
+    return _U32.pack(len(data)) + data
+
+
+def _unpack_str(data: bytes, pos: int) -> Tuple[str, int]:
+    length, = _U32.unpack_from(data, pos)
+    pos += _U32.size
+    return (
+        data[pos: pos + length].decode('utf-8', 'surrogatepass'),
+        pos + length,
+    )
+
+
+def _pack_words(words: List[str]) -> bytes:
+    """ Count, lengths in characters (u16 or u32), concatenated words """
+    lengths = list(map(len, words))
+    code = 'H' if max(lengths, default=0) < 0x10000 else 'I'
+    return struct.pack(
+        f'<Ic{len(lengths)}{code}',
+        len(lengths),
+        code.encode(),
+        *lengths,
+    ) + _pack_str(''.join(words))
+
+
+def _unpack_words(data: bytes, pos: int) -> Tuple[List[str], int]:
+    count, code = struct.unpack_from('<Ic', data, pos)
+    pos += 5
+    fmt = f'<{count}{code.decode()}'
+    lengths = struct.unpack_from(fmt, data, pos)
+    pos += struct.calcsize(fmt)
+    text, pos = _unpack_str(data, pos)
+    return [
+        text[end - length: end]
+        for end, length in zip(accumulate(lengths), lengths)
+    ], pos
+
+
+def _pack_user(user: dict) -> bytes:
+    return (
+        _USER.pack(user['user']['user_id'], user['score']) +
+        _pack_str(user['user']['name']) +
+        _pack_words(user['guessed_words'])
+    )
+
+
+def _unpack_user(data: bytes, pos: int) -> Tuple[dict, int]:
+    user_id, score = _USER.unpack_from(data, pos)
+    name, pos = _unpack_str(data, pos + _USER.size)
+    guessed_words, pos = _unpack_words(data, pos)
+    return {
+        'user': {'user_id': user_id, 'name': name},
+        'score': score,
+        'guessed_words': guessed_words,
+    }, pos
+
+
+def _pack_meta(meta: dict, user_ids: List[int]) -> bytes:
+    return (
+        _pack_str(meta['game_id']) +
+        _pack_str(meta['game_name']) +
+        _META.pack(
+            meta['round_length'],
+            meta['hat_words_per_user'],
+            meta['round_num'],
+        ) +
+        struct.pack(f'<I{len(user_ids)}q', len(user_ids), *user_ids) +
+        _pack_str(json.dumps(meta.get('state', {})))
+    )
+
+
+def _unpack_meta(data: bytes, pos: int) -> Tuple[dict, int]:
+    game_id, pos = _unpack_str(data, pos)
+    game_name, pos = _unpack_str(data, pos)
+    round_length, hat_words_per_user, round_num = _META.unpack_from(data, pos)
+    pos += _META.size
+    count, = _U32.unpack_from(data, pos)
+    pos += _U32.size
+    users = list(struct.unpack_from(f'<{count}q', data, pos))
+    pos += 8 * count
+    state, pos = _unpack_str(data, pos)
+    return {
+        'game_id': game_id,
+        'game_name': game_name,
+        'round_length': round_length,
+        'hat_words_per_user': hat_words_per_user,
+        'round_num': round_num,
+        'state': json.loads(state),
+        'users': users,
+    }, pos
+
+
+def state_serialize(state: dict) -> bytes:
+    """
+    Versioned binary snapshot of Game.serialize() output. Used by bench/
+    only, games are stored per field (meta_serialize(), user_serialize())
+    and single blobs are only read, see state_deserialize().
+    """
+    users = state['users']
+    body = b''.join((
+        _pack_meta(state, [int(k) for k in users]),
+        _pack_words(state['hat']['words']),
+        *(_pack_user(u) for u in users.values()),
+    ))
+    flags = 0
+    if len(body) > COMPRESS_THRESHOLD:
+        body = zlib.compress(body)
+        flags |= FLAG_ZLIB
+    return _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags) + body
+
+
+def state_deserialize(state: Union[bytes, str]) -> dict:
+    """ Binary snapshot or legacy base64(zlib(json)) string """
+    if isinstance(state, str):
+        state = state.encode()
+    if not state.startswith(SNAPSHOT_MAGIC):
+        return json.loads(zlib.decompress(base64.b64decode(state)))
+    _, version, flags = _HEADER.unpack_from(state)
+    if version > SNAPSHOT_VERSION:
+        raise ValueError(f'Unknown snapshot version {version}')
+    body = state[_HEADER.size:]
+    if flags & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    res, pos = _unpack_meta(body, 0)
+    res['hat'] = {}
+    res['hat']['words'], pos = _unpack_words(body, pos)
+    users = {}
+    for user_id in res.pop('users'):
+        users[user_id], pos = _unpack_user(body, pos)
+    res['users'] = users
+    return res
+
+
+def meta_serialize(meta: dict) -> bytes:
+    return FIELD_VERSION + _pack_meta(meta, meta['users'])
+
+
+def _check_field(value: bytes):
+    if value[:1] != FIELD_VERSION:
+        raise ValueError(f'Unknown field version {value[:1]!r}')
+
+
+def meta_deserialize(value: bytes) -> dict:
+    _check_field(value)
+    return _unpack_meta(value, 1)[0]
 
 
-def state_serialize(state) -> str:
-    return base64.b64encode(zlib.compress(json.dumps(state).encode())).decode()
+def user_serialize(user: dict) -> bytes:
+    return FIELD_VERSION + _pack_user(user)
 
 
-def state_deserialize(state) -> dict:
-    return json.loads(zlib.decompress(base64.b64decode(state.encode())))
+def user_deserialize(value: bytes) -> dict:
+    _check_field(value)
+    return _unpack_user(value, 1)[0]
@@ -1,6 +1,16 @@
 """ Persister """
+import asyncio
+import logging
+import time
+from functools import partial
+from typing import Optional, Callable, Dict, List, Set, Tuple, Union
+
 import aioredis
 
+from onliapa.server import metrics
+
+log = logging.getLogger('onliapa.persister')
+
 
 class PersisterError(Exception):
     pass
@@ -16,41 +26,437 @@ class CommunicationError(PersisterError):
 
 class Persister:
     RECORD_TTL = 3600 * 24 * 60
+    # Sorted set game key -> last save time, see recent_games()
+    ACTIVE_KEY = 'games/active'
 
-    def __init__(self, redis_url: str):
+    def __init__(
+            self,
+            redis_url: str,
+            pool_minsize: int = 1,
+            pool_maxsize: int = 10,
+            health_check_interval: float = 30,
+            save_debounce: float = 1.0,
+            save_batch_size: int = 100,
+    ):
         self.redis_url = redis_url
+        self.pool_minsize = pool_minsize
+        self.pool_maxsize = pool_maxsize
+        self.health_check_interval = health_check_interval
+        self.save_debounce = save_debounce
+        self.save_batch_size = save_batch_size
+        self._pool: Optional[aioredis.Redis] = None
+        # Concurrent lazy connects must create a single pool
+        self._connect_lock = asyncio.Lock()
+        self._health_task: Optional[asyncio.Task] = None
+        # Write-behind: key -> state dump, digest of the last written state
+        self._dirty: Dict[str, Callable[[], str]] = {}
+        self._written: Dict[str, int] = {}
+        # Unloaded games whose pending save must not be remembered
+        self._unloaded: Set[str] = set()
+        self._dirty_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._writer_task: Optional[asyncio.Task] = None
+        self.save_stats = {
+            'marked': 0,
+            'written': 0,
+            'unchanged': 0,
+            'batches': 0,
+            'errors': 0,
+        }
+        self.healthy = False
+        self.last_ping_latency: Optional[float] = None
+
+    async def connect(self):
+        """ Create the shared connection pool and start health checks """
+        async with self._connect_lock:
+            if self._pool is not None:
+                return
+            try:
+                self._pool = await aioredis.create_redis_pool(
+                    self.redis_url,
+                    minsize=self.pool_minsize,
+                    maxsize=self.pool_maxsize,
+                )
+            except (aioredis.errors.RedisError, OSError) as err:
+                raise CommunicationError(f'{err.__class__}: {err}') from err
+            if self.health_check_interval:
+                self._health_task = asyncio.create_task(self._health_check())
+            self._writer_task = asyncio.create_task(self._write_behind())
+
+    async def close(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            try:
+                await self._writer_task
+            except asyncio.CancelledError:
+                pass
+            self._writer_task = None
+        if self._pool is not None:
+            await self.flush()
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+        self.healthy = False
 
-    async def _redis(self):
-        return await aioredis.create_redis_pool(self.redis_url)
+    async def _redis(self) -> aioredis.Redis:
+        if self._pool is None:
+            await self.connect()
+        return self._pool
+
+    async def _health_check(self):
+        while True:
+            await asyncio.sleep(self.health_check_interval)
+            try:
+                await self.ping()
+            except CommunicationError as err:
+                log.error(f'Redis health check failed: {err}')
+            else:
+                log.debug(f'Redis health check ok, pool {self.stats()}')
+
+    def stats(self) -> dict:
+        pool = self._pool.connection if self._pool is not None else None
+        return {
+            'minsize': self.pool_minsize,
+            'maxsize': self.pool_maxsize,
+            'size': pool.size if pool is not None else 0,
+            'free': pool.freesize if pool is not None else 0,
+            'healthy': self.healthy,
+            'last_ping_latency': self.last_ping_latency,
+        }
 
     async def ping(self):
         try:
             redis = await self._redis()
+            start = time.monotonic()
             await redis.ping()
-        except aioredis.errors.RedisError as err:
-            raise CommunicationError(f'{err.__class__}: {err}')
+            self.last_ping_latency = time.monotonic() - start
+            metrics.REDIS_LATENCY.observe('ping', self.last_ping_latency)
+            self.healthy = True
+        except (aioredis.errors.RedisError, OSError) as err:
+            metrics.REDIS_ERRORS.inc('ping')
+            self.healthy = False
+            raise CommunicationError(f'{err.__class__}: {err}') from err
+
+    @staticmethod
+    def _keys(key: str) -> Tuple[str, str, str]:
+        """ Game state hash (meta and users), hat set, legacy blob """
+        return f'game/{key}/state', f'game/{key}/hat', f'game/{key}'
+
+    async def load_game(self, key: str) -> Union[bytes, dict]:
+        """
+        Load game fields in one round trip: {'meta', 'users', 'hat'} with
+        raw field values, or the legacy single blob if the game was not
+        migrated yet.
+        """
+        # Pending or in-flight write-behind save must land first
+        if key in self._dirty or self._flush_lock.locked():
+            await self.flush(key)
+        state_key, hat_key, legacy_key = self._keys(key)
+        redis = await self._redis()
+        try:
+            with metrics.REDIS_LATENCY.time('load'):
+                pipe = redis.pipeline()
+                pipe.hgetall(state_key)
+                pipe.smembers(hat_key)
+                pipe.get(legacy_key)
+                fields, hat, legacy = await pipe.execute()
+        except (aioredis.errors.RedisError, OSError) as err:
+            metrics.REDIS_ERRORS.inc('load')
+            raise CommunicationError(err) from err
+        state = self._loaded(key, fields, hat, legacy)
+        if state is None:
+            raise GameDoesNotExist()
+        return state
+
+    @staticmethod
+    def _loaded(
+            key: str,
+            fields: dict,
+            hat: set,
+            legacy: Optional[bytes],
+    ) -> Optional[Union[bytes, dict]]:
+        """ Loaded game state, None if missing or incomplete """
+        meta = fields.pop(b'meta', None)
+        if fields and meta is None:
+            # Partial or external write, or keys expired out of step
+            log.warning(f'Game {key} state has no meta field, ignoring it')
+        if meta is not None:
+            return {
+                'meta': meta,
+                'users': {k[2:].decode(): v for k, v in fields.items()},
+                'hat': {
+                    word.decode('utf-8', 'surrogatepass') for word in hat
+                },
+            }
+        return legacy or None
+
+    async def recent_games(self, limit: int) -> List[str]:
+        """ Keys of the last `limit` saved games, most recent first """
+        try:
+            redis = await self._redis()
+            with metrics.REDIS_LATENCY.time('recent'):
+                keys = await redis.zrevrangebyscore(
+                    self.ACTIVE_KEY,
+                    min=time.time() - self.RECORD_TTL,
+                    offset=0,
+                    count=limit,
+                    encoding='utf-8',
+                )
+        except (aioredis.errors.RedisError, OSError) as err:
+            metrics.REDIS_ERRORS.inc('recent')
+            raise CommunicationError(err) from err
+        return keys
 
-    async def load_game(self, key: str) -> str:
+    async def load_games(
+            self,
+            keys: List[str],
+    ) -> Dict[str, Union[bytes, dict]]:
+        """
+        Bulk load_game() in one round trip: pipelined hashes and hats and
+        a MGET of the legacy blobs. Missing games are left out.
+        """
+        if not keys:
+            return {}
         redis = await self._redis()
         try:
-            res = await redis.get(f'game/{key}', encoding='utf-8')
-            if res:
-                return res
+            with metrics.REDIS_LATENCY.time('load_many'):
+                pipe = redis.pipeline()
+                for key in keys:
+                    state_key, hat_key, _ = self._keys(key)
+                    pipe.hgetall(state_key)
+                    pipe.smembers(hat_key)
+                pipe.mget(*(self._keys(key)[2] for key in keys))
+                results = await pipe.execute()
+        except (aioredis.errors.RedisError, OSError) as err:
+            metrics.REDIS_ERRORS.inc('load_many')
+            raise CommunicationError(err) from err
+        legacy = results.pop()
+        states = {}
+        for i, key in enumerate(keys):
+            state = self._loaded(
+                key, results[2 * i], results[2 * i + 1], legacy[i])
+            if state is not None:
+                states[key] = state
+        return states
+
+    def save_game_deferred(self, key: str, dump: Callable[[bool], dict]):
+        """
+        Schedule a write-behind save. Saves of the same key within the
+        debounce window are coalesced, `dump` is called once at write time
+        and returns the changes since its previous call (everything if its
+        argument is true), see save_games().
+        """
+        self._dirty[key] = dump
+        self._unloaded.discard(key)
+        self.save_stats['marked'] += 1
+        self._dirty_event.set()
+
+    async def _write_behind(self):
+        while True:
+            await self._dirty_event.wait()
+            await asyncio.sleep(self.save_debounce)
+            self._dirty_event.clear()
+            # Shielded, close() waits for an interrupted flush to finish
+            try:
+                await asyncio.shield(self.flush())
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('Error writing game states')
+                self.save_stats['errors'] += 1
+
+    def forget(self, key: str):
+        """
+        Drop the bookkeeping of a game unloaded from memory. A pending save
+        is still written.
+        """
+        self._written.pop(key, None)
+        if key in self._dirty or self._flush_lock.locked():
+            self._unloaded.add(key)
+
+    def _unchanged(self, key: str, changes: dict) -> bool:
+        return (
+            not changes['full'] and
+            not changes['users'] and
+            not changes['users_removed'] and
+            not changes['hat_added'] and
+            not changes['hat_removed'] and
+            self._written.get(key) == hash(changes['meta'])
+        )
+
+    async def flush(self, key: Optional[str] = None):
+        """ Write pending saves now, all of them or the one of `key` """
+        async with self._flush_lock:
+            if key is None:
+                keys = list(self._dirty)
+            elif key in self._dirty:
+                keys = [key]
+            else:
+                return
+            states = {}
+            dumps = {}
+            for k in keys:
+                dump = dumps[k] = self._dirty.pop(k)
+                try:
+                    changes = dump(False)
+                except Exception:
+                    log.exception(f'Error dumping game {k} state')
+                    self.save_stats['errors'] += 1
+                    self._retry(k, dumps)
+                    continue
+                if self._unchanged(k, changes):
+                    self.save_stats['unchanged'] += 1
+                    continue
+                states[k] = changes
+            items = list(states.items())
+            for i in range(0, len(items), self.save_batch_size):
+                batch = dict(items[i: i + self.save_batch_size])
+                try:
+                    await self.save_games(batch)
+                except CommunicationError as err:
+                    log.error(f'Error saving {len(batch)} games: {err}')
+                    self.save_stats['errors'] += 1
+                    for k in batch:
+                        self._retry(k, dumps)
+                    continue
+                except Exception:
+                    log.exception(f'Error saving {len(batch)} games')
+                else:
+                    self._saved(batch)
+                    continue
+                # One bad state fails the transaction, save one by one
+                await self._save_each(batch, dumps)
+            self._unloaded.intersection_update(self._dirty)
+
+    async def _save_each(self, batch: Dict[str, dict], dumps: dict):
+        for k, changes in batch.items():
+            try:
+                await self.save_games({k: changes})
+            except CommunicationError as err:
+                log.error(f'Error saving game {k}: {err}')
+            except Exception:
+                log.exception(f'Error saving game {k}')
             else:
-                raise GameDoesNotExist()
-        except aioredis.errors.RedisError as err:
+                self._saved({k: changes})
+                continue
+            self.save_stats['errors'] += 1
+            self._retry(k, dumps)
+
+    def _saved(self, batch: Dict[str, dict]):
+        self.save_stats['batches'] += 1
+        self.save_stats['written'] += len(batch)
+        for k, changes in batch.items():
+            if k in self._unloaded:
+                self._unloaded.discard(k)
+            else:
+                self._written[k] = hash(changes['meta'])
+        log.debug(f'Written {len(batch)} game states')
+
+    def _retry(self, key: str, dumps: dict):
+        """ Changes taken by a failed save are lost, retry in full """
+        dump = self._dirty.get(key, dumps[key])
+        if getattr(dump, 'func', None) is not self._dump_full:
+            dump = partial(self._dump_full, dump)
+        self._dirty[key] = dump
+        self._dirty_event.set()
+
+    @staticmethod
+    def _dump_full(dump: Callable[[bool], dict], _full: bool) -> dict:
+        return dump(True)
+
+    @staticmethod
+    def _encode(words: List[str]) -> List[bytes]:
+        # Hat words may hold lone surrogates, see game.helpers._pack_str()
+        return [word.encode('utf-8', 'surrogatepass') for word in words]
+
+    async def save_games(self, states: Dict[str, dict]):
+        """
+        Apply game changes in one transaction. Changes are
+        {
+            'full': replace everything stored,
+            'meta': game metadata,
+            'users': {user_id: user record} changed users,
+            'users_removed': [user_id],
+            'hat_added': [word],
+            'hat_removed': [word],
+        }
+        """
+        try:
+            redis = await self._redis()
+            tr = redis.multi_exec()
+            now = time.time()
+            active = []
+            for key, changes in states.items():
+                active.extend((now, key))
+                state_key, hat_key, legacy_key = self._keys(key)
+                if changes['full']:
+                    tr.delete(state_key, hat_key, legacy_key)
+                fields = {f'u:{k}': v for k, v in changes['users'].items()}
+                fields['meta'] = changes['meta']
+                tr.hmset_dict(state_key, fields)
+                if changes['users_removed']:
+                    tr.hdel(
+                        state_key,
+                        *(f'u:{k}' for k in changes['users_removed']),
+                    )
+                # Encoded here, failing once the transaction is being sent
+                # leaves a half written command on the connection
+                if changes['hat_added']:
+                    tr.sadd(hat_key, *self._encode(changes['hat_added']))
+                if changes['hat_removed']:
+                    tr.srem(hat_key, *self._encode(changes['hat_removed']))
+                tr.expire(state_key, self.RECORD_TTL)
+                tr.expire(hat_key, self.RECORD_TTL)
+            if active:
+                tr.zadd(self.ACTIVE_KEY, *active)
+                tr.zremrangebyscore(
+                    self.ACTIVE_KEY, max=now - self.RECORD_TTL)
+            with metrics.REDIS_LATENCY.time('save'):
+                await tr.execute()
+        except (aioredis.errors.RedisError, OSError) as err:
+            metrics.REDIS_ERRORS.inc('save')
             raise CommunicationError(err) from err
 
-    async def save_game(self, key: str, state: str):
+    async def save_game(self, key: str, state: Union[bytes, str]):
+        """
+        Save a single blob state (snapshot or legacy format). Used by
+        bench/ only, games are saved by save_games() and blobs are only
+        read back as legacy state.
+        """
         try:
             redis = await self._redis()
-            await redis.setex(f'game/{key}', self.RECORD_TTL, state)
-        except aioredis.errors.RedisError as err:
+            with metrics.REDIS_LATENCY.time('save_blob'):
+                tr = redis.multi_exec()
+                tr.setex(f'game/{key}', self.RECORD_TTL, state)
+                tr.zadd(self.ACTIVE_KEY, time.time(), key)
+                await tr.execute()
+        except (aioredis.errors.RedisError, OSError) as err:
+            metrics.REDIS_ERRORS.inc('save_blob')
             raise CommunicationError(err) from err
 
+    def discard(self, key: str):
+        """ Drop the pending save of a game, as if it was never marked """
+        self._dirty.pop(key, None)
+        self._written.pop(key, None)
+        self._unloaded.discard(key)
+
     async def del_game(self, key: str):
+        self.discard(key)
         try:
             redis = await self._redis()
-            await redis.delete(f'game/{key}')
-        except aioredis.errors.RedisError as err:
+            with metrics.REDIS_LATENCY.time('delete'):
+                tr = redis.multi_exec()
+                tr.delete(*self._keys(key))
+                tr.zrem(self.ACTIVE_KEY, key)
+                await tr.execute()
+        except (aioredis.errors.RedisError, OSError) as err:
+            metrics.REDIS_ERRORS.inc('delete')
             raise CommunicationError(err) from err
@@ -1,16 +1,28 @@
+import hashlib
+import hmac
 import logging
-from typing import Optional
+import os
+import time
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from typing import Optional, Tuple
 from zlib import adler32
 
 from websockets import WebSocketServerProtocol
 
 from onliapa.server.errors import ProtocolError
 from onliapa.server import messages as msg
-from onliapa.server.helpers import remote_addr
-from onliapa.server.protocol import recv, rerr, rmsg
+from onliapa.server.helpers import query_param, remote_addr
+from onliapa.server.protocol import DecodeError, decode, recv, rerr, rmsg
 
 log = logging.getLogger('onliapa.server.auth')
 
+# Resume token signing key, must be shared by every process and node
+# serving the game for tokens to survive restarts and reconnects elsewhere
+RESUME_SECRET = os.urandom(32)
+# Resume token lifetime, seconds
+RESUME_TTL = 3600 * 24
+
 
 class User:
     user_id: int
@@ -39,22 +51,85 @@ class User:
     def to_msg(self):
         return msg.AuthUser(user_id=self.user_id, user_name=self.name)
 
+    def auth_ok(self, game_id: str) -> msg.AuthOk:
+        return msg.AuthOk(
+            user_id=self.user_id,
+            user_name=self.name,
+            resume_token=resume_token(self, game_id),
+        )
+
 
-async def auth(websocket: WebSocketServerProtocol) -> Optional[User]:
-    ip = remote_addr(websocket)
+def _b64(data: bytes) -> str:
+    return urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def _sign(game_id: str, body: str) -> str:
+    digest = hmac.new(
+        RESUME_SECRET, f'{game_id}.{body}'.encode(), hashlib.sha256,
+    ).digest()
+    return _b64(digest[:18])
+
+
+def resume_token(user: User, game_id: str) -> str:
+    """ Signed `name.expires.signature` token valid for one game """
+    body = f'{_b64(user.name.encode())}.{int(time.time()) + RESUME_TTL}'
+    return f'{body}.{_sign(game_id, body)}'
+
+
+def resume_user(token: str, game_id: str) -> Optional[User]:
+    """ User of a valid resume token for the game """
     try:
-        tag, message = await recv(websocket, msg.AuthRequest)
-    except ProtocolError as err:
-        log.info(f'Remote socket {ip} failed to authenticate: {err}')
+        name, expires, signature = token.split('.')
+        if int(expires) < time.time():
+            return None
+        if not hmac.compare_digest(
+            signature, _sign(game_id, f'{name}.{expires}'),
+        ):
+            return None
+        user_name = urlsafe_b64decode(name + '=' * (-len(name) % 4)).decode()
+    except (ValueError, Base64Error, UnicodeDecodeError):
         return None
+    return User(adler32(user_name.encode()), user_name)
+
+
+async def auth(
+        websocket: WebSocketServerProtocol,
+        game_id: str,
+) -> Tuple[Optional[User], bool]:
+    """
+    Authenticate by a `user-auth` name, answered with `auth-ok` carrying a
+    resume token, or by a resume token, passed as the `resume` URL
+    parameter or in a `user-resume` first frame. Resumed sessions get no
+    `auth-ok`, it is sent in the joined game `resume-ok` frame. Returns
+    the user (None on failure) and whether the session was resumed.
+    """
+    ip = remote_addr(websocket)
+    token = query_param(websocket, 'resume')
+    while True:
+        if token is not None:
+            user = resume_user(token, game_id)
+            if user is not None:
+                log.info(f'Connection {ip} resumed session of {user}')
+                return user, True
+            log.info(f'Connection {ip} sent an invalid resume token')
+            await websocket.send(rerr('resume-error', 'Invalid token'))
+        try:
+            tag, data = await recv(websocket)
+            if tag != 'user-resume':
+                message = decode(msg.AuthRequest, data)
+                break
+            token = decode(msg.AuthResume, data).token
+        except (ProtocolError, DecodeError) as err:
+            log.info(f'Remote socket {ip} failed to authenticate: {err}')
+            return None, False
     user_name = message.user_name
     if user_name == 'admin':
         await websocket.send(rerr('auth-error', f'wrong name {user_name}'))
-        return None
+        return None, False
 
     user_id = adler32(user_name.encode())
     user = User(user_id, user_name)
-    await websocket.send(rmsg('auth-ok', user.to_msg()))
+    await websocket.send(rmsg('auth-ok', user.auth_ok(game_id)))
     log.info(f'Connection {ip} authenticated as {user}')
 
-    return user
+    return user, False
@@ -0,0 +1,653 @@
+"""
+Clustered rooms.
+
+A game is owned by the node holding its lease in Redis. Sockets connected
+to other (follower) nodes are relayed through Redis pub/sub: followers
+forward socket events to the owner node channel, the owner posts frames
+for them to the game room channel. Posts are batched to one publish per
+channel and loop iteration, so a broadcast costs about one publish
+whatever the number of follower sockets.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from functools import partial
+from itertools import chain
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Set, \
+    Union
+
+import aioredis
+from websockets import WebSocketServerProtocol
+
+from onliapa.persister.persister import CommunicationError, GameDoesNotExist
+from onliapa.server.auth import User
+from onliapa.server.protocol import Payload, rerr
+from onliapa.server.room import GameRoom, RelayedSocket, rooms
+
+log = logging.getLogger('onliapa.server.cluster')
+
+# Close code of sockets whose game moved to another node, clients reconnect
+CLOSE_MOVED = 1012
+
+_RENEW = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+_RELEASE = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def _owner_key(game_id: str) -> str:
+    return f'game/{game_id}/owner'
+
+
+def _alive_key(node_id: str) -> str:
+    return f'node/{node_id}/alive'
+
+
+def _node_channel(node_id: str) -> str:
+    return f'node/{node_id}'
+
+
+def _room_channel(game_id: str) -> str:
+    return f'room/{game_id}'
+
+
+class RemoteSocket(RelayedSocket):
+    """ Owner side stand-in for a socket connected to a follower node """
+
+    def __init__(
+            self,
+            cluster: 'Cluster',
+            game_id: str,
+            sock_id: str,
+            user: Optional[User],
+    ):
+        self.cluster = cluster
+        self.game_id = game_id
+        self.sock_id = sock_id
+        self.node = sock_id.rsplit('/', 1)[0]
+        self.user = user
+        self.remote_address = (self.node, sock_id)
+        self.room: Optional[GameRoom] = None
+        # Follower events, handled in order
+        self.inbox: Deque[dict] = deque()
+        self.busy = False
+
+    def post(self, payload: Payload):
+        self.cluster.post(self.game_id, self.sock_id, payload)
+
+    async def close(self, code: int = 1000, reason: str = ''):
+        self.cluster.post_close(self.game_id, self.sock_id, code, reason)
+
+
+class FollowerRoom(GameRoom):
+    """ Local sockets of a game owned by another node """
+
+    def __init__(self, cluster: 'Cluster', game_id: str, owner: str):
+        super().__init__(game_id, emitter=None)
+        self.cluster = cluster
+        self.owner = owner
+        self.socks: Dict[str, WebSocketServerProtocol] = {}
+        self.sock_ids: Dict[WebSocketServerProtocol, str] = {}
+        self._deliveries: Deque[List[dict]] = deque()
+        self._delivering = False
+
+    def _register(self, websocket: WebSocketServerProtocol) -> str:
+        sock_id = self.cluster.new_sock_id()
+        self.socks[sock_id] = websocket
+        self.sock_ids[websocket] = sock_id
+        return sock_id
+
+    def _unregister(self, websocket: WebSocketServerProtocol) -> str:
+        sock_id = self.sock_ids.pop(websocket)
+        del self.socks[sock_id]
+        return sock_id
+
+    def _forward(self, event: dict):
+        self.cluster.forward(self.owner, self.game_id, event)
+
+    async def user_joined(
+            self,
+            user: User,
+            websocket: WebSocketServerProtocol,
+            resumed: bool = False,
+    ):
+        self.users[user.user_id].add(websocket)
+        self.user_names[user.user_id] = user.name
+        self._sock_joined()
+        self._forward({
+            'e': 'join',
+            's': self._register(websocket),
+            'u': user.serialize(),
+            'r': resumed,
+            'c': sorted(self.capabilities.get(websocket, ())),
+        })
+
+    async def user_left(
+            self,
+            user: User,
+            websocket: WebSocketServerProtocol,
+    ):
+        self.users[user.user_id].discard(websocket)
+        self._forget_sock(websocket)
+        self._forward({'e': 'leave', 's': self._unregister(websocket)})
+
+    async def user_message(
+            self,
+            user: User,
+            websocket: WebSocketServerProtocol,
+            tag: str,
+            data: Union[dict, str],
+    ):
+        self._forward({
+            'e': 'msg',
+            's': self.sock_ids[websocket],
+            't': tag,
+            'd': data,
+        })
+
+    async def admin_joined(self, websocket: WebSocketServerProtocol):
+        self.admin.add(websocket)
+        self._sock_joined()
+        self._forward({
+            'e': 'join',
+            's': self._register(websocket),
+            'c': sorted(self.capabilities.get(websocket, ())),
+        })
+
+    async def admin_left(self, websocket: WebSocketServerProtocol):
+        self.admin.discard(websocket)
+        self._forget_sock(websocket)
+        self._forward({'e': 'leave', 's': self._unregister(websocket)})
+
+    async def admin_message(
+            self,
+            websocket: WebSocketServerProtocol,
+            tag: str,
+            data: Union[dict, str],
+    ):
+        self._forward({
+            'e': 'msg',
+            's': self.sock_ids[websocket],
+            't': tag,
+            'd': data,
+        })
+
+    def close_all(self, code: int = CLOSE_MOVED, reason: str = 'game moved'):
+        for sock in list(self.socks.values()):
+            asyncio.ensure_future(sock.close(code, reason))
+
+    def deliver(self, events: List[dict]):
+        """ Apply owner events in order """
+        self._deliveries.append(events)
+        if not self._delivering:
+            asyncio.ensure_future(self._deliver())
+
+    async def _deliver(self):
+        self._delivering = True
+        try:
+            while self._deliveries:
+                for event in self._deliveries.popleft():
+                    try:
+                        await self._apply(event)
+                    except Exception:
+                        log.exception(f'Error applying game {self.game_id} '
+                                      f'event')
+        finally:
+            self._delivering = False
+
+    async def _apply(self, event: dict):
+        if 'f' in event:
+            socks = [self.socks[s] for s in event['s'] if s in self.socks]
+            if socks:
+                await self._send_many(socks, event['f'])
+        elif 'c' in event:
+            sock = self.socks.get(event['c'])
+            if sock is not None:
+                asyncio.ensure_future(
+                    sock.close(event['code'], event['reason']))
+        elif 'x' in event:
+            self._info(f'Owner node {self.owner} dropped the game')
+            self.close_all()
+
+
+class Cluster:
+    """
+    Node of a cluster sharing games through Redis.
+
+    `load_room` returns the resident room of a game, loading it if needed.
+    `discard_save` drops the pending write-behind save of a game.
+    Leases last `lease_ttl` seconds and are renewed every third of it,
+    nodes missing heartbeats for as long lose their relayed sockets.
+
+    A node losing a lease discards the game's pending save and stops saving
+    it, a save already being written may still land after the new owner
+    loaded the game.
+    """
+
+    def __init__(
+            self,
+            redis_url: str,
+            load_room: Callable[[str], Awaitable[GameRoom]],
+            discard_save: Optional[Callable[[str], None]] = None,
+            lease_ttl: float = 10.0,
+            node_id: Optional[str] = None,
+    ):
+        self.redis_url = redis_url
+        self.node_id = node_id or uuid.uuid4().hex[:12]
+        self.lease_ttl = lease_ttl
+        self._lease_ms = int(lease_ttl * 1000)
+        self._load_room = load_room
+        self._discard_save = discard_save
+        # Commands, publishing (one connection keeps the order), pub/sub
+        self._redis: Optional[aioredis.Redis] = None
+        self._pub: Optional[aioredis.Redis] = None
+        self._sub: Optional[aioredis.Redis] = None
+        self._subscriptions: Dict[str, asyncio.Future] = {}
+        self._task: Optional[asyncio.Task] = None
+        # Owned games, the ones found not resident on the last pass
+        self.owned: Set[str] = set()
+        self._unused: Set[str] = set()
+        self.followers: Dict[str, FollowerRoom] = {}
+        self.remotes: Dict[str, RemoteSocket] = {}
+        self._outbox: Dict[str, List[dict]] = {}
+        self._flush_scheduled = False
+        self._sock_seq = 0
+        self.stats = {
+            'published': 0,
+            'posted': 0,
+            'forwarded': 0,
+            'received': 0,
+            'lost_leases': 0,
+        }
+
+    async def connect(self):
+        try:
+            self._redis = await aioredis.create_redis_pool(self.redis_url)
+            self._pub = await aioredis.create_redis(self.redis_url)
+            self._sub = await aioredis.create_redis(self.redis_url)
+            await self._subscribe(
+                _node_channel(self.node_id), self._on_node_message)
+            await self._heartbeat()
+        except (aioredis.errors.RedisError, OSError) as err:
+            raise CommunicationError(f'{err.__class__}: {err}') from err
+        self._task = asyncio.ensure_future(self._maintain())
+        log.info(f'Cluster node {self.node_id} connected')
+
+    async def close(self):
+        """ Release owned games, their followers reconnect elsewhere """
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for game_id in self.owned:
+            self._queue(_room_channel(game_id), {'x': 1})
+        self._flush()
+        try:
+            for game_id in list(self.owned):
+                await self.release(game_id)
+            await self._redis.delete(_alive_key(self.node_id))
+        except (CommunicationError, aioredis.errors.RedisError) as err:
+            log.error(f'Error releasing cluster leases: {err}')
+        for conn in (self._sub, self._pub, self._redis):
+            if conn is not None:
+                conn.close()
+                await conn.wait_closed()
+
+    def new_sock_id(self) -> str:
+        self._sock_seq += 1
+        return f'{self.node_id}/{self._sock_seq}'
+
+    # Leases
+
+    async def claim(self, game_id: str) -> Optional[str]:
+        """ Acquire the game lease, None if owned, else the owner node """
+        if game_id in self.owned:
+            return None
+        key = _owner_key(game_id)
+        try:
+            for _ in range(3):
+                if await self._redis.set(
+                        key, self.node_id,
+                        pexpire=self._lease_ms,
+                        exist=self._redis.SET_IF_NOT_EXIST,
+                ):
+                    owner = self.node_id
+                else:
+                    owner = await self._redis.get(key, encoding='utf-8')
+                if owner == self.node_id:
+                    self.owned.add(game_id)
+                    self._unused.discard(game_id)
+                    log.info(f'Acquired game {game_id} lease')
+                    return None
+                if owner is not None:
+                    return owner
+        except aioredis.errors.RedisError as err:
+            raise CommunicationError(err) from err
+        raise CommunicationError(f'Failed to claim game {game_id} lease')
+
+    async def release(self, game_id: str):
+        self.owned.discard(game_id)
+        self._unused.discard(game_id)
+        try:
+            await self._redis.eval(
+                _RELEASE, keys=[_owner_key(game_id)], args=[self.node_id])
+        except aioredis.errors.RedisError as err:
+            raise CommunicationError(err) from err
+        log.info(f'Released game {game_id} lease')
+
+    async def _drop(self, game_id: str):
+        """ Lease lost, another node may own the game already """
+        self.owned.discard(game_id)
+        self.stats['lost_leases'] += 1
+        log.error(f'Lost game {game_id} lease, dropping it')
+        # The new owner's state must not be overwritten
+        if self._discard_save is not None:
+            self._discard_save(game_id)
+        room = rooms.get(game_id)
+        if room is not None:
+            del rooms[game_id]
+            for sock in chain(room.admin, *room.users.values()):
+                if not isinstance(sock, RelayedSocket):
+                    asyncio.ensure_future(
+                        sock.close(CLOSE_MOVED, 'game moved'))
+        for sock_id, sock in list(self.remotes.items()):
+            if sock.game_id == game_id:
+                del self.remotes[sock_id]
+        self._queue(_room_channel(game_id), {'x': 1})
+
+    # Pub/sub
+
+    async def _subscribe(self, name: str, handler: Callable[[list], None]):
+        subscription = self._subscriptions.get(name)
+        if subscription is None:
+            subscription = asyncio.ensure_future(self._sub.subscribe(name))
+            self._subscriptions[name] = subscription
+            try:
+                channel, = await subscription
+            except Exception:
+                self._subscriptions.pop(name, None)
+                raise
+            asyncio.ensure_future(self._read(channel, handler))
+        else:
+            await subscription
+
+    async def _unsubscribe(self, name: str):
+        if self._subscriptions.pop(name, None) is not None:
+            await self._sub.unsubscribe(name)
+
+    async def _read(self, channel: aioredis.Channel, handler):
+        while await channel.wait_message():
+            raw = await channel.get()
+            self.stats['received'] += 1
+            try:
+                handler(json.loads(raw))
+            except Exception:
+                log.exception(f'Error handling {channel.name} message')
+
+    def _outbox_for(self, channel: str) -> List[dict]:
+        """ Events to publish on the channel at the end of the iteration """
+        events = self._outbox.get(channel)
+        if events is None:
+            events = self._outbox[channel] = []
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                asyncio.get_event_loop().call_soon(self._flush)
+        return events
+
+    def _queue(self, channel: str, event: dict):
+        self._outbox_for(channel).append(event)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        outbox, self._outbox = self._outbox, {}
+        for channel, events in outbox.items():
+            for event in events:
+                payload = event.pop('p', None)
+                if payload is not None:
+                    event['f'] = payload.text
+            self._publish(channel, events)
+
+    def _publish(self, channel: str, events: List[dict]):
+        if self._pub is None or self._pub.closed:
+            log.warning(f'Dropped {len(events)} events to {channel}, '
+                        f'not connected')
+            return
+        self.stats['published'] += 1
+        try:
+            future = self._pub.publish(channel, json.dumps(events))
+        except aioredis.errors.RedisError as err:
+            log.error(f'Error publishing to {channel}: {err}')
+            return
+        future.add_done_callback(partial(self._published, channel))
+
+    @staticmethod
+    def _published(channel: str, future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error(f'Error publishing to {channel}: {future.exception()}')
+
+    def post(self, game_id: str, sock_id: str, payload: Payload):
+        """ Queue a frame to a follower socket, merged with the same one """
+        self.stats['posted'] += 1
+        events = self._outbox_for(_room_channel(game_id))
+        if events and events[-1].get('p') is payload:
+            events[-1]['s'].append(sock_id)
+        else:
+            events.append({'p': payload, 's': [sock_id]})
+
+    def post_close(self, game_id: str, sock_id: str, code: int, reason: str):
+        self._queue(
+            _room_channel(game_id),
+            {'c': sock_id, 'code': code, 'reason': reason},
+        )
+
+    def forward(self, owner: str, game_id: str, event: dict):
+        """ Queue a follower socket event to the owner """
+        self.stats['forwarded'] += 1
+        event['g'] = game_id
+        self._queue(_node_channel(owner), event)
+
+    # Owner side
+
+    def _on_node_message(self, events: List[dict]):
+        for event in events:
+            sock_id = event['s']
+            if event['e'] == 'join':
+                user = User.deserialize(event['u']) if 'u' in event else None
+                sock = RemoteSocket(self, event['g'], sock_id, user)
+                self.remotes[sock_id] = sock
+            else:
+                sock = self.remotes.get(sock_id)
+                if sock is None:
+                    continue
+            sock.inbox.append(event)
+            if not sock.busy:
+                asyncio.ensure_future(self._drain(sock))
+
+    async def _drain(self, sock: RemoteSocket):
+        sock.busy = True
+        try:
+            while sock.inbox:
+                event = sock.inbox.popleft()
+                try:
+                    await self._handle(sock, event)
+                except Exception:
+                    log.exception(f'Error handling game {sock.game_id} '
+                                  f'remote socket event')
+        finally:
+            sock.busy = False
+
+    def _detach(self, sock: RemoteSocket, code: int, reason: str):
+        self.remotes.pop(sock.sock_id, None)
+        self.post_close(sock.game_id, sock.sock_id, code, reason)
+
+    async def _handle(self, sock: RemoteSocket, event: dict):
+        game_id = sock.game_id
+        kind = event['e']
+        if game_id not in self.owned:
+            self._detach(sock, CLOSE_MOVED, 'game moved')
+            return
+        if kind == 'join':
+            try:
+                room = await self._load_room(game_id)
+            except GameDoesNotExist:
+                self.post(game_id, sock.sock_id,
+                          Payload(rerr('wrong-game', 'Wrong game')))
+                self._detach(sock, 1000, '')
+                await self.release(game_id)
+                return
+            except CommunicationError as err:
+                log.error(f'Error loading game {game_id}: {err}')
+                self._detach(sock, 1011, 'internal error')
+                return
+            sock.room = room
+            for cap in event.get('c', ()):
+                room.set_capability(sock, cap)
+            if sock.user is not None:
+                await room.user_joined(sock.user, sock, event.get('r', False))
+            else:
+                await room.admin_joined(sock)
+        elif sock.room is None:
+            return
+        elif kind == 'msg':
+            if sock.user is not None:
+                await sock.room.user_message(
+                    sock.user, sock, event['t'], event['d'])
+            else:
+                await sock.room.admin_message(sock, event['t'], event['d'])
+        elif kind == 'leave':
+            self.remotes.pop(sock.sock_id, None)
+            await self._leave(sock)
+
+    @staticmethod
+    async def _leave(sock: RemoteSocket):
+        if sock.user is not None:
+            await sock.room.user_left(sock.user, sock)
+        else:
+            await sock.room.admin_left(sock)
+
+    # Follower side
+
+    def _on_room_message(self, game_id: str, events: List[dict]):
+        room = self.followers.get(game_id)
+        if room is not None:
+            room.deliver(events)
+
+    async def serve_remote(
+            self,
+            ws: WebSocketServerProtocol,
+            game_id: str,
+            owner: str,
+            admin: bool,
+    ):
+        """ Serve a socket of a game owned by another node """
+        room = self.followers.get(game_id)
+        if room is None or room.owner != owner:
+            if room is not None:
+                room.close_all()
+            room = FollowerRoom(self, game_id, owner)
+            self.followers[game_id] = room
+        # Owner frames to the socket must not be missed. Counted as
+        # connecting meanwhile, _check_followers() must not drop the room
+        room.connecting += 1
+        room._sock_joined()
+        try:
+            await self._subscribe(
+                _room_channel(game_id),
+                partial(self._on_room_message, game_id),
+            )
+        finally:
+            room.connecting -= 1
+            room._sock_left()
+        if admin:
+            await room.serve_admin(ws)
+        else:
+            await room.serve_user(ws)
+
+    # Maintenance
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self._heartbeat()
+                await self._renew_leases()
+                await self._check_followers()
+                await self._check_remote_nodes()
+            except (CommunicationError, aioredis.errors.RedisError) as err:
+                log.error(f'Cluster maintenance failed: {err}')
+            except Exception:
+                log.exception('Cluster maintenance failed')
+
+    async def _heartbeat(self):
+        await self._redis.set(
+            _alive_key(self.node_id), 1, pexpire=self._lease_ms)
+
+    async def _renew_leases(self):
+        # Evicted games are released on the second pass, a game may be
+        # claimed and still loading on the first one
+        unused = {g for g in self.owned if g not in rooms}
+        for game_id in unused & self._unused:
+            await self.release(game_id)
+        self._unused = unused - self._unused
+        owned = list(self.owned)
+        if not owned:
+            return
+        pipe = self._redis.pipeline()
+        for game_id in owned:
+            pipe.eval(
+                _RENEW,
+                keys=[_owner_key(game_id)],
+                args=[self.node_id, self._lease_ms],
+            )
+        for game_id, renewed in zip(owned, await pipe.execute()):
+            if not renewed and game_id in self.owned:
+                await self._drop(game_id)
+
+    async def _check_followers(self):
+        now = time.monotonic()
+        for game_id, room in list(self.followers.items()):
+            if (
+                room.is_idle() and
+                room.idle_since is not None and
+                now - room.idle_since >= self.lease_ttl
+            ):
+                del self.followers[game_id]
+                await self._unsubscribe(_room_channel(game_id))
+        game_ids = list(self.followers)
+        if not game_ids:
+            return
+        pipe = self._redis.pipeline()
+        for game_id in game_ids:
+            pipe.get(_owner_key(game_id), encoding='utf-8')
+        for game_id, owner in zip(game_ids, await pipe.execute()):
+            room = self.followers.get(game_id)
+            if room is not None and owner != room.owner:
+                room._info(f'Owner moved from {room.owner} to {owner}')
+                room.close_all()
+
+    async def _check_remote_nodes(self):
+        nodes = list({sock.node for sock in self.remotes.values()})
+        if not nodes:
+            return
+        pipe = self._redis.pipeline()
+        for node in nodes:
+            pipe.exists(_alive_key(node))
+        dead = {
+            node for node, alive in zip(nodes, await pipe.execute())
+            if not alive
+        }
+        for sock in [s for s in self.remotes.values() if s.node in dead]:
+            log.info(f'Node {sock.node} is gone, detaching {sock.sock_id}')
+            del self.remotes[sock.sock_id]
+            if sock.room is not None:
+                await self._leave(sock)
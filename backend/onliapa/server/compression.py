@@ -0,0 +1,120 @@
+"""
+permessage-deflate policy: window bits, memory level and a size threshold
+below which messages are sent uncompressed.
+
+Compression ratio and time are accounted per message tag in metrics.
+"""
+import re
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import PerMessageDeflate, \
+    ServerPerMessageDeflateFactory
+from websockets.frames import CTRL_OPCODES, OP_CONT, Frame
+from websockets.typing import ExtensionParameter
+
+from onliapa.server import metrics
+
+# Leading tag of protocol.rmsg() and rerr() output, any JSON backend
+_TAG = re.compile(rb'\{"tag": ?"([a-z-]{1,32})"')
+
+
+def message_tag(data: bytes) -> str:
+    match = _TAG.match(data)
+    return match.group(1).decode() if match else 'other'
+
+
+class ThresholdDeflate(PerMessageDeflate):
+    """ PerMessageDeflate sending messages under `min_size` bytes as is """
+
+    def __init__(self, *args, min_size: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+        # First frame of the message being sent was left uncompressed
+        self._skip_cont = False
+
+    def encode(self, frame: Frame) -> Frame:
+        if frame.opcode in CTRL_OPCODES:
+            return frame
+        if frame.opcode == OP_CONT:
+            if self._skip_cont:
+                self._skip_cont = not frame.fin
+                return frame
+            return super().encode(frame)
+        tag = message_tag(frame.data)
+        if len(frame.data) < self.min_size:
+            # rsv1 unset: the peer reads it as an uncompressed message
+            self._skip_cont = not frame.fin
+            metrics.COMPRESS_SKIPPED.inc(tag)
+            return frame
+        start = time.process_time()
+        encoded = super().encode(frame)
+        metrics.COMPRESS_SECONDS.inc(tag, time.process_time() - start)
+        metrics.COMPRESS_IN_BYTES.inc(tag, len(frame.data))
+        metrics.COMPRESS_OUT_BYTES.inc(tag, len(encoded.data))
+        return encoded
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    """ Server side negotiation of ThresholdDeflate """
+
+    def __init__(self, *args, min_size: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def process_request_params(
+            self,
+            params: Sequence[ExtensionParameter],
+            accepted_extensions: Sequence[Extension],
+    ) -> Tuple[List[ExtensionParameter], ThresholdDeflate]:
+        response, ext = super().process_request_params(
+            params, accepted_extensions)
+        return response, ThresholdDeflate(
+            ext.remote_no_context_takeover,
+            ext.local_no_context_takeover,
+            ext.remote_max_window_bits,
+            ext.local_max_window_bits,
+            ext.compress_settings,
+            min_size=self.min_size,
+        )
+
+
+def serve_options(
+        enabled: bool = True,
+        window_bits: Optional[int] = None,
+        mem_level: Optional[int] = None,
+        min_size: int = 0,
+) -> Dict[str, Any]:
+    """ websockets.serve() keyword arguments for the policy """
+    if not enabled:
+        return {'compression': None}
+    settings = {'memLevel': mem_level} if mem_level is not None else None
+    return {
+        'compression': None,
+        'extensions': [ThresholdDeflateFactory(
+            server_max_window_bits=window_bits,
+            compress_settings=settings,
+            min_size=min_size,
+        )],
+    }
+
+
+def report() -> Dict[str, dict]:
+    """ Per tag: messages skipped, bytes in and out, ratio, seconds """
+    tags = (
+        set(metrics.COMPRESS_IN_BYTES.values) |
+        set(metrics.COMPRESS_SKIPPED.values)
+    )
+    result = {}
+    for tag in sorted(tags):
+        raw = metrics.COMPRESS_IN_BYTES.values.get(tag, 0)
+        out = metrics.COMPRESS_OUT_BYTES.values.get(tag, 0)
+        result[tag] = {
+            'skipped': metrics.COMPRESS_SKIPPED.values.get(tag, 0),
+            'bytes_in': raw,
+            'bytes_out': out,
+            'ratio': out / raw if raw else None,
+            'seconds': metrics.COMPRESS_SECONDS.values.get(tag, 0),
+        }
+    return result
@@ -1,4 +1,7 @@
 """ Helpers """
+from typing import Optional
+from urllib.parse import parse_qs, urlsplit
+
 from websockets import WebSocketServerProtocol
 
 fwd_permitted = True
@@ -21,3 +24,9 @@ def remote_addr(ws: WebSocketServerProtocol):
         pass
 
     return ':'.join(map(str, ws.remote_address))
+
+
+def query_param(ws: WebSocketServerProtocol, name: str) -> Optional[str]:
+    """ Connection URL query parameter """
+    values = parse_qs(urlsplit(getattr(ws, 'path', '')).query).get(name)
+    return values[0] if values else None
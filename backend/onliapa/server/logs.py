@@ -0,0 +1,63 @@
+"""
+Non-blocking log output.
+
+Records are put on a queue by the event loop thread and formatted and
+written by a QueueListener thread. Debug records can be sampled per call
+site, see DebugSampler.
+"""
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Tuple
+
+
+class LocalQueueHandler(QueueHandler):
+    """
+    Queue handler for a listener of the same process: only the message is
+    rendered by the caller (its arguments may change later), formatting
+    and exception rendering are left to the listener thread.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class DebugSampler(logging.Filter):
+    """ Pass one of `rate` debug records of each call site """
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self._seen: Dict[Tuple[str, int], int] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        site = (record.pathname, record.lineno)
+        seen = self._seen.get(site, 0)
+        self._seen[site] = seen + 1
+        return seen % self.rate == 0
+
+
+def start_queue_logging(
+        logger: logging.Logger,
+        handler: logging.Handler,
+        debug_sample: int = 1,
+) -> QueueListener:
+    """
+    Replace the logger handlers with a queue to a background thread writing
+    to `handler`. Must be called again in forked processes, the listener
+    thread is not inherited. Stop the returned listener to flush.
+    """
+    records = queue.SimpleQueue()
+    queue_handler = LocalQueueHandler(records)
+    if debug_sample > 1:
+        queue_handler.addFilter(DebugSampler(debug_sample))
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(queue_handler)
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    return listener
@@ -14,6 +14,14 @@ class AuthRequest(NamedTuple):
     user_name: str
 
 
+@message_type
+class AuthResume(NamedTuple):
+    class Schema(Schema):
+        token = fields.String(required=True)
+
+    token: str
+
+
 @message_type
 class UserId(NamedTuple):
     class Schema(Schema):
@@ -62,6 +70,13 @@ class AuthUser(NamedTuple):
     user_id: int
 
 
+@message_type
+class AuthOk(NamedTuple):
+    user_name: str
+    user_id: int
+    resume_token: str
+
+
 @message_type
 class User(NamedTuple):
     user_name: str
@@ -137,6 +152,25 @@ class GameState(NamedTuple):
     users: List[User]
     reason: Optional[str]
     appendix: Any
+    seq: int
+
+
+@message_type
+class GamePatch(NamedTuple):
+    seq: int
+    reason: Optional[str]
+    appendix: Any
+    changes: dict
+    users: List[dict]
+    users_removed: List[int]
+
+
+@message_type
+class Resync(NamedTuple):
+    class Schema(Schema):
+        deltas = fields.Boolean(missing=False)
+
+    deltas: bool
 
 
 @message_type
@@ -149,3 +183,11 @@ class UserState(NamedTuple):
 @message_type
 class HatFillEnd(NamedTuple):
     ignore_not_full: bool
+
+
+@message_type
+class ResumeOk(NamedTuple):
+    """ Auth, user state and game state of a resumed session at once """
+    auth: AuthOk
+    user_state: UserState
+    game_state: GameState
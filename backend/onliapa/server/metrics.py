@@ -0,0 +1,272 @@
+"""
+Process metrics in Prometheus text format.
+
+Histograms and counters are updated inline by the hot paths (one dict
+lookup and a bisect per observation), gauges are callbacks evaluated only
+when scraped. serve() exposes them over HTTP on a separate local port.
+"""
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Union
+
+log = logging.getLogger('onliapa.server.metrics')
+
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+    2.5, 5.0, 10.0,
+)
+SIZE_BUCKETS = tuple(64 * 4 ** i for i in range(9))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+Value = Union[int, float]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(label: Optional[str], value: str, extra: str = '') -> str:
+    parts = [f'{label}="{_escape(value)}"'] if label else []
+    if extra:
+        parts.append(extra)
+    return '{' + ','.join(parts) + '}' if parts else ''
+
+
+class Metric:
+    kind = ''
+
+    def __init__(self, name: str, help_: str, label: Optional[str] = None):
+        self.name = name
+        self.help = help_
+        self.label = label
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.kind}']
+
+    def render(self) -> List[str]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_: str, label: Optional[str] = None):
+        super().__init__(name, help_, label)
+        self._values: Dict[str, Value] = {}
+
+    def inc(self, label_value: str = '', amount: Value = 1):
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    @property
+    def values(self) -> Dict[str, Value]:
+        return dict(self._values)
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f'{self.name}{_labels(self.label, k)} {v}'
+            for k, v in sorted(self._values.items())
+        ]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            help_: str,
+            label: Optional[str] = None,
+            buckets=LATENCY_BUCKETS,
+    ):
+        super().__init__(name, help_, label)
+        self.buckets = tuple(buckets)
+        # label value -> [count per bucket and +Inf, sum]
+        self._values: Dict[str, list] = {}
+
+    def observe(self, label_value: str, value: Value):
+        series = self._values.get(label_value)
+        if series is None:
+            series = self._values[label_value] = \
+                [[0] * (len(self.buckets) + 1), 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, label_value: str = '') -> 'Timer':
+        return Timer(self, label_value)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = _labels(self.label, key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = _labels(self.label, key)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return lines
+
+
+class Timer:
+    """ Context manager observing the elapsed time of its block """
+    __slots__ = ('histogram', 'label_value', 'start')
+
+    def __init__(self, histogram: Histogram, label_value: str):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(
+            self.label_value, time.perf_counter() - self.start)
+
+
+class Callback(Metric):
+    """
+    Gauge or counter read from the application state at scrape time.
+    `fn` returns a value, or a dict label value -> value.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            help_: str,
+            fn: Callable[[], Union[Value, Dict[str, Value]]],
+            label: Optional[str] = None,
+            kind: str = 'gauge',
+    ):
+        super().__init__(name, help_, label)
+        self.fn = fn
+        self.kind = kind
+
+    def render(self) -> List[str]:
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {'': values}
+        return self.header() + [
+            f'{self.name}{_labels(self.label, str(k))} {v}'
+            for k, v in values.items() if v is not None
+        ]
+
+
+_registry: Dict[str, Metric] = {}
+
+
+def register(metric: Metric) -> Metric:
+    _registry[metric.name] = metric
+    return metric
+
+
+def gauge(name: str, help_: str, fn, label: Optional[str] = None,
+          kind: str = 'gauge') -> Metric:
+    return register(Callback(name, help_, fn, label, kind))
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry.values():
+        try:
+            lines.extend(metric.render())
+        except Exception:
+            log.exception(f'Error collecting metric {metric.name}')
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_LATENCY = register(Histogram(
+    'onliapa_handler_seconds',
+    'Game event and message handler duration',
+    label='tag',
+))
+BROADCAST_DURATION = register(Histogram(
+    'onliapa_broadcast_seconds',
+    'Room broadcast duration until every socket is written',
+))
+BROADCAST_BYTES = register(Histogram(
+    'onliapa_broadcast_bytes',
+    'Room broadcast payload size',
+    buckets=SIZE_BUCKETS,
+))
+BROADCAST_SOCKETS = register(Histogram(
+    'onliapa_broadcast_sockets',
+    'Sockets per room broadcast',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500),
+))
+MAILBOX_WAIT = register(Histogram(
+    'onliapa_mailbox_wait_seconds',
+    'Game event time in the mailbox before handling',
+))
+MAILBOX_FULL = register(Counter(
+    'onliapa_mailbox_full_total',
+    'Messages arriving at a full game mailbox',
+    label='action',
+))
+BATCHED_MESSAGES = register(Counter(
+    'onliapa_batched_messages_total',
+    'Messages coalesced into batch frames, and the frames',
+    label='kind',
+))
+COMPRESS_IN_BYTES = register(Counter(
+    'onliapa_compress_in_bytes_total',
+    'Outgoing message bytes before permessage-deflate',
+    label='tag',
+))
+COMPRESS_OUT_BYTES = register(Counter(
+    'onliapa_compress_out_bytes_total',
+    'Outgoing message bytes after permessage-deflate',
+    label='tag',
+))
+COMPRESS_SECONDS = register(Counter(
+    'onliapa_compress_seconds_total',
+    'CPU time spent compressing outgoing messages',
+    label='tag',
+))
+COMPRESS_SKIPPED = register(Counter(
+    'onliapa_compress_skipped_total',
+    'Outgoing messages sent uncompressed, under the size threshold',
+    label='tag',
+))
+REDIS_LATENCY = register(Histogram(
+    'onliapa_redis_seconds',
+    'Redis call duration',
+    label='op',
+))
+REDIS_ERRORS = register(Counter(
+    'onliapa_redis_errors_total',
+    'Failed Redis calls',
+    label='op',
+))
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        method, path, _ = request.split(b'\r\n', 1)[0].split(b' ', 2)
+        if method == b'GET' and path.split(b'?')[0] == b'/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: {CONTENT_TYPE}\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+            asyncio.LimitOverrunError, ValueError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(host: str, port: int) -> asyncio.AbstractServer:
+    """ Serve GET /metrics """
+    return await asyncio.start_server(_handle, host, port)
@@ -1,9 +1,14 @@
 import json
 import logging
-from typing import Type, Optional, Union, TypeVar, Tuple
+from typing import Type, Optional, Union, TypeVar, Tuple, Callable, Any, \
+    Dict, List
 
-from marshmallow import ValidationError, Schema
+import websockets
+from marshmallow import ValidationError, Schema, fields, validate, \
+    missing as missing_
 from websockets import WebSocketServerProtocol
+from websockets.frames import Frame, OP_TEXT
+from websockets.legacy.protocol import State
 
 from onliapa.server.errors import BaseError, ProtocolError, RemoteError
 from onliapa.server.helpers import remote_addr
@@ -11,12 +16,21 @@ from onliapa.server.helpers import remote_addr
 T = TypeVar('T')
 log = logging.getLogger('onliapa.server.protocol')
 
+# NamedTuple class -> generated encoder, filled by @message_type
+_encoders: Dict[type, Callable[[Any], Any]] = {}
+# write_payload() and send_payload() drive protocol internals of the
+# pinned websockets release, any other one goes through send()
+FAST_WRITE = websockets.__version__ == '9.1'
+
 
 def transcode(value, _level=0):
     if _level > 100:
         raise RecursionError(f'Level {_level} reached with {value}')
     _level += 1
     if isinstance(value, tuple) and hasattr(value, '_asdict'):
+        encoder = _encoders.get(type(value))
+        if encoder is not None:
+            return encoder(value)
         return transcode(getattr(value, '_asdict')(), _level)
     if isinstance(value, dict):
         return {k: transcode(v, _level) for k, v in value.items()}
@@ -26,12 +40,86 @@ def transcode(value, _level=0):
         return value
 
 
+_PRIMITIVES = (str, int, float, bool, type(None))
+
+
+def encode(value):
+    """ Same result as transcode, using generated encoders when possible """
+    encoder = _encoders.get(type(value))
+    if encoder is not None:
+        return encoder(value)
+    return transcode(value)
+
+
+def _encode_list(value):
+    if type(value) is list:
+        return [encode(v) for v in value]
+    return encode(value)
+
+
+def _is_primitive(annotation) -> bool:
+    """ Whether json.dumps encodes values of the type as transcode does """
+    if annotation in _PRIMITIVES:
+        return True
+    origin = getattr(annotation, '__origin__', None)
+    if origin in (Union, list, tuple, List, Tuple):
+        return all(_is_primitive(a) for a in annotation.__args__)
+    return False
+
+
+def _compile_encoder(t) -> Callable[[Any], dict]:
+    """ Generate `lambda v: {field: encoded v[i], ...}` for NamedTuple t """
+    annotations = getattr(t, '__annotations__', {})
+    items = []
+    for i, name in enumerate(t._fields):
+        annotation = annotations.get(name, Any)
+        if _is_primitive(annotation):
+            expr = f'v[{i}]'
+        elif getattr(annotation, '__origin__', None) in (list, List):
+            expr = f'_encode_list(v[{i}])'
+        else:
+            expr = f'_encode(v[{i}])'
+        items.append(f'{name!r}: {expr}')
+    source = f'def encode_{t.__name__}(v):\n' \
+             f'    return {{{", ".join(items)}}}\n'
+    namespace = {'_encode': encode, '_encode_list': _encode_list}
+    exec(source, namespace)
+    return namespace[f'encode_{t.__name__}']
+
+
+json_dumps: Callable[[Any], str] = json.dumps
+
+
+def set_json_backend(name: str):
+    """
+    Select JSON serializer for outgoing messages. `json` output is byte
+    compatible with previous versions, `orjson` is faster but compact
+    (no spaces after separators, non-ASCII characters not escaped).
+    """
+    global json_dumps
+    if name == 'json':
+        json_dumps = json.dumps
+    elif name == 'orjson':
+        import orjson
+
+        def json_dumps(obj):
+            return orjson.dumps(obj).decode()
+    else:
+        raise ValueError(f'Unknown JSON backend {name}')
+
+
 def rmsg(tag, message) -> str:
-    return json.dumps({'tag': tag, 'message': transcode(message)})
+    return json_dumps({'tag': tag, 'message': encode(message)})
+
+
+def rbatch(payloads: List['Payload']) -> str:
+    """ Messages in one frame, without decoding them again """
+    return '{"tag": "batch", "message": [' + \
+        ', '.join(p.text for p in payloads) + ']}'
 
 
 def rerr(tag, message='', data=None) -> str:
-    return json.dumps(
+    return json_dumps(
         {
             'tag': tag,
             'error': message,
@@ -40,6 +128,78 @@ def rerr(tag, message='', data=None) -> str:
     )
 
 
+class Payload:
+    """ Outgoing text message, encoded once and sent to many sockets """
+    __slots__ = ('text', 'data', '_frame')
+
+    def __init__(self, text: str):
+        self.text = text
+        self.data = text.encode()
+        self._frame: Optional[bytes] = None
+
+    @property
+    def frame(self) -> bytes:
+        """ Serialized server side text frame without extensions """
+        if self._frame is None:
+            self._frame = Frame(True, OP_TEXT, self.data).serialize(mask=False)
+        return self._frame
+
+    def __str__(self):
+        return self.text
+
+
+def _frame_for(websocket: WebSocketServerProtocol, payload: Payload) -> bytes:
+    if websocket.extensions:
+        # Per-socket compression context, can't be shared
+        return Frame(True, OP_TEXT, payload.data).serialize(
+            mask=False,
+            extensions=websocket.extensions,
+        )
+    return payload.frame
+
+
+def write_payload(
+        websocket: WebSocketServerProtocol,
+        payload: Payload,
+) -> bool:
+    """
+    Write pre-encoded payload without yielding to the loop.
+
+    Returns False without writing if the socket is not open or applies
+    backpressure, in which case send_payload() must be used.
+    """
+    if (
+        not FAST_WRITE or
+        websocket.state is not State.OPEN or
+        websocket._paused or
+        websocket.transfer_data_task.done()
+    ):
+        return False
+    websocket.transport.write(_frame_for(websocket, payload))
+    return True
+
+
+async def send_payload(websocket: WebSocketServerProtocol, payload: Payload):
+    """
+    Send pre-encoded payload.
+
+    Mirrors WebSocketCommonProtocol.write_frame of websockets 9, using the
+    shared encoded frame for sockets without extensions.
+    """
+    if not FAST_WRITE:
+        # Still encoded once, the text is shared
+        await websocket.send(payload.text)
+        return
+    await websocket.ensure_open()
+    websocket.transport.write(_frame_for(websocket, payload))
+    try:
+        async with websocket._drain_lock:
+            await websocket._drain()
+    except ConnectionError:
+        websocket.fail_connection()
+        await websocket.ensure_open()
+
+
 def trunc(s: str, ln: int = 100):
     if len(s) > ln:
         return f'{s[: ln]}...'
@@ -60,6 +220,14 @@ async def recv_d(
     return res
 
 
+def decode(expected: Type[T], message: Union[dict, str]) -> T:
+    """ Validated message of a received packet """
+    try:
+        return expected(**message)
+    except (TypeError, ValueError, ValidationError) as err:
+        raise DecodeError(f'{expected}: {err}')
+
+
 async def recv(
         websocket: WebSocketServerProtocol,
         expected: Optional[Type[T]] = None,
@@ -86,33 +254,125 @@ async def recv(
         else:
             raise DecodeError('No error or message in data')
         if expected is not None:
-            try:
-                decoded = expected(**message)
-            except (TypeError, ValueError, ValidationError) as err:
-                raise DecodeError(f'{expected}: {err}')
-            return tag, decoded
+            return tag, decode(expected, message)
         else:
             if not isinstance(message, (dict, str)):
                 raise DecodeError(f'Wrong message type {type(message)}')
             return tag, message
     except DecodeError as err:
-        trunc(data)
-        log.debug(
-            f'Error decoding remote packet {data}'
-            f'from {remote_addr(websocket)}: {err}',
-        )
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(
+                f'Error decoding remote packet {trunc(str(data))} '
+                f'from {remote_addr(websocket)}: {err}',
+            )
         raise ProtocolError(err, data)
 
 
+def _validator_check(validator) -> Optional[Callable[[Any], bool]]:
+    if type(validator) is validate.Length:
+        lo, hi, eq = validator.min, validator.max, validator.equal
+        if eq is not None:
+            return lambda v: len(v) == eq
+        return lambda v: (
+            (lo is None or len(v) >= lo) and (hi is None or len(v) <= hi)
+        )
+    if type(validator) is validate.Range:
+        lo, hi = validator.min, validator.max
+        lo_inc, hi_inc = validator.min_inclusive, validator.max_inclusive
+        return lambda v: (
+            (lo is None or (v >= lo if lo_inc else v > lo)) and
+            (hi is None or (v <= hi if hi_inc else v < hi))
+        )
+    return None
+
+
+def _field_check(field) -> Optional[Callable[[Any], bool]]:
+    """
+    Check accepting only values that marshmallow would load unchanged.
+    None if the field is not supported by the fast path.
+    """
+    if field.data_key is not None or field.attribute is not None:
+        return None
+    if type(field) is fields.String:
+        def type_check(v):
+            return type(v) is str
+    elif type(field) is fields.Integer:
+        def type_check(v):
+            return type(v) is int
+    elif type(field) is fields.Boolean:
+        def type_check(v):
+            return v is True or v is False
+    elif type(field) is fields.List:
+        inner = _field_check(field.inner)
+        if inner is None:
+            return None
+
+        def type_check(v):
+            return type(v) is list and all(map(inner, v))
+    else:
+        return None
+    checks = [_validator_check(v) for v in field.validators]
+    if None in checks:
+        return None
+    if not checks:
+        return type_check
+    if len(checks) == 1:
+        check = checks[0]
+        return lambda v: type_check(v) and check(v)
+    return lambda v: type_check(v) and all(check(v) for check in checks)
+
+
+def _compile_validator(t, schema: Schema) -> Optional[Callable]:
+    """
+    Build fast loader for the schema, returns t instance or None when the
+    data must go through marshmallow (coercion or error message).
+    """
+    checks = {}
+    defaults = {}
+    for name, field in schema.fields.items():
+        check = _field_check(field)
+        if check is None:
+            return None
+        checks[name] = check
+        if field.missing is not missing_ and not callable(field.missing):
+            defaults[name] = field.missing
+    n_fields = len(checks)
+
+    def load(kwargs: dict):
+        for name, value in kwargs.items():
+            check = checks.get(name)
+            if check is None or not check(value):
+                return None
+        if len(kwargs) != n_fields:
+            if not defaults:
+                return None
+            kwargs = {**defaults, **kwargs}
+            if len(kwargs) != n_fields:
+                return None
+        return t(**kwargs)
+
+    return load
+
+
 class MessageType:
     def __init__(self, t):
         self.t = t
         self.name = t.__name__
+        self.schema: Optional[Schema] = None
+        self._fast_load = None
+        if hasattr(t, 'Schema'):
+            self.schema = getattr(t, 'Schema')()
+            self._fast_load = _compile_validator(t, self.schema)
+        self.encode = _compile_encoder(t)
+        _encoders[t] = self.encode
 
     def __call__(self, **kwargs):
-        if hasattr(self.t, 'Schema'):
-            schema: Schema = getattr(self.t, 'Schema')()
-            data = schema.load(kwargs)
+        if self._fast_load is not None:
+            res = self._fast_load(kwargs)
+            if res is not None:
+                return res
+        if self.schema is not None:
+            data = self.schema.load(kwargs)
         else:
             data = kwargs
         return self.t(**data)
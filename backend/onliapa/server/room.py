@@ -1,20 +1,29 @@
+import asyncio
 import logging
-from collections import defaultdict
+import time
+from collections import defaultdict, deque, OrderedDict
 from itertools import chain
 from typing import Dict, Optional, Callable, Awaitable, TypeVar, Type, Any, \
-    Set, Iterable, Tuple
+    Set, Iterable, Tuple, Union, Deque, List
 
 from marshmallow import ValidationError
 from websockets import WebSocketServerProtocol, ConnectionClosed
 
+from onliapa.server import metrics
 from onliapa.server.auth import auth, User
 from onliapa.server.errors import ProtocolError, RemoteError
-from onliapa.server.helpers import remote_addr
-from onliapa.server.protocol import recv, trunc, rerr
+from onliapa.server.helpers import query_param, remote_addr
+from onliapa.server.protocol import recv, trunc, rerr, rbatch, Payload, \
+    send_payload, write_payload
 
 log = logging.getLogger('onliapa.server.room')
 T = TypeVar('T')
 
+# Socket capability: messages of one handled event arrive in a batch frame
+CAP_BATCH = 'batch'
+# Capabilities a socket may request in the `caps` URL parameter
+URL_CAPABILITIES = {CAP_BATCH}
+
 
 class EventHandler:
     def __init__(self):
@@ -57,10 +66,11 @@ class EventHandler:
         except (ValueError, TypeError, ValidationError) as err:
             log.warning(f'Failed to parse {message} message: {err}')
             return
-        if user is None:
-            await callback(instance, parsed, socket)
-        else:
-            await callback(instance, parsed, user, socket)
+        with metrics.HANDLER_LATENCY.time(message):
+            if user is None:
+                await callback(instance, parsed, socket)
+            else:
+                await callback(instance, parsed, user, socket)
 
     def handler(self, event: str):
         def decorate(outer: Callable[[Any, Any], Awaitable[None]]):
@@ -73,20 +83,132 @@ class EventHandler:
         self._subscriptions[event].append(callback)
 
     async def emit(self, instance, event, data):
-        for callback in self._subscriptions[event]:
-            await callback(instance, data)
+        if event == 'message':
+            # Timed per message tag by _on_message
+            for callback in self._subscriptions[event]:
+                await callback(instance, data)
+            return
+        with metrics.HANDLER_LATENCY.time(event):
+            for callback in self._subscriptions[event]:
+                await callback(instance, data)
 
 
 class EventEmitter:
+    """
+    Mailbox of a handler instance, making it an actor: events are handled
+    in order, one at a time, by a task running while the mailbox is not
+    empty. Producers only enqueue.
+
+    Messages are bounded by MAILBOX_SIZE: emit() waits for space, offer()
+    refuses (sheds) instead. Lifecycle events are posted past the bound,
+    they must not be lost.
+    """
+    MAILBOX_SIZE = 256
+    # Drop client messages when the mailbox is full instead of waiting
+    SHED = False
+
     def __init__(self, handler: EventHandler, instance):
         self.instance = instance
         self.handler = handler
+        # event, data, enqueue time, future of call() or None
+        self._mailbox: Deque[tuple] = deque()
+        self._busy = False
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        # Room batching the frames sent by each handled event
+        self.room: Optional['GameRoom'] = None
+
+    def __len__(self):
+        return len(self._mailbox)
+
+    def post(self, event, data):
+        """ Enqueue regardless of the bound """
+        self._mailbox.append((event, data, time.monotonic(), None))
+        if not self._busy:
+            self._busy = True
+            asyncio.ensure_future(self._run())
 
     async def emit(self, event, data):
-        await self.handler.emit(self.instance, event, data)
+        """ Enqueue, waiting while the mailbox is full """
+        if len(self._mailbox) >= self.MAILBOX_SIZE:
+            metrics.MAILBOX_FULL.inc('waited')
+            while len(self._mailbox) >= self.MAILBOX_SIZE:
+                self._not_full.clear()
+                await self._not_full.wait()
+        self.post(event, data)
+
+    def offer(self, event, data) -> bool:
+        """ Enqueue unless the mailbox is full """
+        if len(self._mailbox) >= self.MAILBOX_SIZE:
+            metrics.MAILBOX_FULL.inc('shed')
+            return False
+        self.post(event, data)
+        return True
+
+    async def call(self, event, data):
+        """
+        Enqueue and wait until handled, raising the handler error. Must not
+        be used by handlers of the same instance.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._mailbox.append((event, data, time.monotonic(), future))
+        if not self._busy:
+            self._busy = True
+            asyncio.ensure_future(self._run())
+        await future
+
+    async def _run(self):
+        mailbox = self._mailbox
+        try:
+            while mailbox:
+                event, data, queued_at, future = mailbox.popleft()
+                if len(mailbox) < self.MAILBOX_SIZE:
+                    self._not_full.set()
+                metrics.MAILBOX_WAIT.observe('', time.monotonic() - queued_at)
+                room = self.room
+                if room is not None:
+                    room.hold()
+                try:
+                    await self.handler.emit(self.instance, event, data)
+                except Exception as err:
+                    error = err
+                else:
+                    error = None
+                if room is not None:
+                    await room.release()
+                if error is not None:
+                    if future is not None:
+                        future.set_exception(error)
+                    else:
+                        log.error(f'Error handling event {event}',
+                                  exc_info=error)
+                elif future is not None:
+                    future.set_result(None)
+        finally:
+            self._busy = False
+
+
+class RelayedSocket:
+    """
+    Socket connected to another node. Sends are posted to that node, see
+    cluster.RemoteSocket.
+    """
+    remote_address: Tuple[str, str]
+    request_headers: dict = {}
+
+    def post(self, payload: Payload):
+        raise NotImplementedError()
+
+    async def close(self, code: int = 1000, reason: str = ''):
+        raise NotImplementedError()
 
 
 class GameRoom:
+    # Per-socket send deadline, seconds
+    SEND_TIMEOUT = 5.0
+    # Consecutive missed deadlines before the socket is evicted
+    SEND_MAX_MISSES = 3
+
     users: Dict[int, Set[WebSocketServerProtocol]]
     admin: Set[WebSocketServerProtocol]
     game_id: str
@@ -104,6 +226,17 @@ class GameRoom:
             self.admin.add(admin)
         self.game_id = game_id
         self._emitter = emitter
+        self._send_misses: Dict[WebSocketServerProtocol, int] = {}
+        self.capabilities: Dict[WebSocketServerProtocol, Set[str]] = {}
+        # Frames to batch capable sockets while an event is handled
+        self._outbox: Optional[
+            Dict[WebSocketServerProtocol, List[Payload]]] = None
+        # Sockets in serve_user() not joined yet (authenticating)
+        self.connecting = 0
+        # New rooms are made for a connecting socket, see unattended()
+        self.idle_since: Optional[float] = None
+        if emitter is not None:
+            emitter.room = self
 
     @staticmethod
     def _wsfmt(ws: WebSocketServerProtocol):
@@ -115,13 +248,83 @@ class GameRoom:
     def _debug(self, message):
         log.debug(f'Game {self.game_id}: {message}')
 
+    @staticmethod
+    def _debug_on() -> bool:
+        """ Guard for debug messages costly to format """
+        return log.isEnabledFor(logging.DEBUG)
+
+    def is_idle(self) -> bool:
+        """ No connected sockets """
+        return (
+            not self.connecting and
+            not self.admin and
+            not any(self.users.values())
+        )
+
+    def unattended(self):
+        """ Start the idle clock of a room no socket is connecting to """
+        self._sock_left()
+
+    def _sock_joined(self):
+        self.idle_since = None
+
+    def _sock_left(self):
+        if self.is_idle():
+            self.idle_since = time.monotonic()
+
+    async def flush(self):
+        """ Ask the game to persist its state """
+        await self._emitter.call('flush', None)
+
+    def set_capability(
+            self,
+            sock: WebSocketServerProtocol,
+            capability: str,
+            enabled: bool = True,
+    ):
+        caps = self.capabilities.setdefault(sock, set())
+        if enabled:
+            caps.add(capability)
+        else:
+            caps.discard(capability)
+
+    def set_url_capabilities(self, sock: WebSocketServerProtocol):
+        """ Capabilities requested as `?caps=a,b` in the socket URL """
+        caps = query_param(sock, 'caps')
+        for cap in caps.split(',') if caps else ():
+            if cap in URL_CAPABILITIES:
+                self.set_capability(sock, cap)
+
+    def any_capable(self, capability: str) -> bool:
+        """ Whether a connected socket has the capability """
+        return any(
+            capability in self.capabilities.get(sock, ())
+            for sock in chain(self.admin, *self.users.values())
+        )
+
+    def all_capable(self, capability: str) -> bool:
+        """ Whether every connected socket has the capability """
+        return all(
+            capability in self.capabilities.get(sock, ())
+            for sock in chain(self.admin, *self.users.values())
+        )
+
     async def serve_user(self, websocket: WebSocketServerProtocol):
-        user = await auth(websocket)
+        # Counted while authenticating, the room must not be evicted
+        self.connecting += 1
+        self._sock_joined()
+        user = None
+        try:
+            user, resumed = await auth(websocket, self.game_id)
+            if user is not None:
+                self.set_url_capabilities(websocket)
+                await self.user_joined(user, websocket, resumed)
+        finally:
+            self.connecting -= 1
+            if user is None:
+                self._sock_left()
         if user is None:
             return
-        self.users[user.user_id].add(websocket)
-        self.user_names[user.user_id] = user.name
-        await self._emitter.emit('join', (user, websocket))
         while True:
             try:
                 tag, data = await recv(websocket)
@@ -132,15 +335,13 @@ class GameRoom:
                 self._info(f'Remote error from user {user}: {err}')
                 continue
             except ConnectionClosed:
-                self.users[user.user_id].remove(websocket)
-                await self._emitter.emit('leave', user)
+                await self.user_left(user, websocket)
                 raise
-            self._debug(f'Received message {tag} from {user}: {trunc(data)}')
-            await self._emitter.emit('message', (tag, data, user, websocket))
+            await self.user_message(user, websocket, tag, data)
 
     async def serve_admin(self, websocket: WebSocketServerProtocol):
-        self.admin.add(websocket)
-        await self._emitter.emit('admin-join', websocket)
+        self.set_url_capabilities(websocket)
+        await self.admin_joined(websocket)
         while True:
             try:
                 tag, data = await recv(websocket)
@@ -151,96 +352,453 @@ class GameRoom:
                 self._info(f'Remote error from admin: {err}')
                 continue
             except ConnectionClosed:
-                self.admin.remove(websocket)
-                await self._emitter.emit('admin-leave', None)
+                await self.admin_left(websocket)
                 raise
-            await self._emitter.emit(
-                'message',
-                (f'admin-{tag}', data, None, websocket),
-            )
+            await self.admin_message(websocket, tag, data)
 
-    async def broadcast(self, data: str, with_admin: bool = True):
-        _d = trunc(data)
-        self._debug(f'Broadcasting message {_d}')
-        all_users = (
-            chain(self.users.items(), (('admin', self.admin),))
-            if with_admin and self.admin is not None else self.users.items()
-        )
-        for uid, socks in all_users:
-            user_name = 'admin' if uid == 'admin' else self.user_names[uid]
-            self._debug(f'Broadcast to {user_name} message {_d}')
-            socks_ = list(socks)
-            for sock in socks_:
-                try:
-                    await sock.send(data)
-                except ConnectionClosed:
-                    pass
+    def _forget_sock(self, websocket: WebSocketServerProtocol):
+        self._send_misses.pop(websocket, None)
+        self.capabilities.pop(websocket, None)
+        self._sock_left()
+
+    # Socket lifecycle, also driven by the cluster for sockets of other nodes
 
-    async def _send_to_socks(
+    async def user_joined(
+            self,
+            user: User,
+            websocket: WebSocketServerProtocol,
+            resumed: bool = False,
+    ):
+        self.users[user.user_id].add(websocket)
+        self.user_names[user.user_id] = user.name
+        self._sock_joined()
+        self._emitter.post('join', (user, websocket, resumed))
+
+    async def user_left(
+            self,
+            user: User,
+            websocket: WebSocketServerProtocol,
+    ):
+        self.users[user.user_id].discard(websocket)
+        self._forget_sock(websocket)
+        self._emitter.post('leave', user)
+
+    async def user_message(
+            self,
+            user: User,
+            websocket: WebSocketServerProtocol,
+            tag: str,
+            data: Union[dict, str],
+    ):
+        if self._debug_on():
+            self._debug(f'Received message {tag} from {user}: '
+                        f'{trunc(str(data))}')
+        await self._enqueue_message((tag, data, user, websocket))
+
+    async def admin_joined(self, websocket: WebSocketServerProtocol):
+        self.admin.add(websocket)
+        self._sock_joined()
+        self._emitter.post('admin-join', websocket)
+
+    async def admin_left(self, websocket: WebSocketServerProtocol):
+        self.admin.discard(websocket)
+        self._forget_sock(websocket)
+        self._emitter.post('admin-leave', None)
+
+    async def admin_message(
+            self,
+            websocket: WebSocketServerProtocol,
+            tag: str,
+            data: Union[dict, str],
+    ):
+        await self._enqueue_message((f'admin-{tag}', data, None, websocket))
+
+    async def _enqueue_message(self, message: tuple):
+        """
+        Wait for mailbox space (backpressure, the socket is not read
+        meanwhile) or drop the message and tell the sender if shedding
+        """
+        if not self._emitter.SHED:
+            await self._emitter.emit('message', message)
+        elif not self._emitter.offer('message', message):
+            tag, _, _, websocket = message
+            self._info(f'Mailbox full, dropped message {tag}')
+            await self._send(websocket, rerr('busy', 'Game is busy'))
+
+    @property
+    def queued(self) -> int:
+        """ Events waiting in the game mailbox """
+        return len(self._emitter) if self._emitter is not None else 0
+
+    async def _evict(self, sock: WebSocketServerProtocol):
+        self._info(f'Evicting slow socket {self._wsfmt(sock)}')
+        try:
+            await sock.close(1008, 'too slow')
+        except ConnectionClosed:
+            pass
+
+    async def _send(
+            self,
+            sock: WebSocketServerProtocol,
+            data: Union[str, Payload],
+    ) -> bool:
+        """ Send with deadline, evict sockets missing it repeatedly """
+        if not isinstance(data, Payload):
+            data = Payload(data)
+        if isinstance(sock, RelayedSocket):
+            sock.post(data)
+            return True
+        try:
+            await asyncio.wait_for(send_payload(sock, data), self.SEND_TIMEOUT)
+        except ConnectionClosed:
+            self._send_misses.pop(sock, None)
+            return False
+        except asyncio.TimeoutError:
+            misses = self._send_misses.get(sock, 0) + 1
+            self._debug(f'Send timeout to {self._wsfmt(sock)} ({misses})')
+            if misses >= self.SEND_MAX_MISSES:
+                self._send_misses.pop(sock, None)
+                asyncio.create_task(self._evict(sock))
+            else:
+                self._send_misses[sock] = misses
+            return False
+        self._send_misses.pop(sock, None)
+        return True
+
+    async def _send_many(
             self,
-            dbg_info: str,
             socks: Iterable[WebSocketServerProtocol],
+            data: Union[str, Payload],
+            hold: bool = True,
+    ) -> Dict[WebSocketServerProtocol, bool]:
+        """
+        Send to sockets concurrently, only waiting on backpressure. Batch
+        capable sockets get it on release() while an event is handled,
+        unless `hold` is false.
+        """
+        payload = data if isinstance(data, Payload) else Payload(data)
+        outbox = self._outbox if hold else None
+        results = {}
+        pending = []
+        for sock in socks:
+            if (
+                outbox is not None and
+                CAP_BATCH in self.capabilities.get(sock, ())
+            ):
+                outbox.setdefault(sock, []).append(payload)
+                results[sock] = True
+            elif isinstance(sock, RelayedSocket):
+                sock.post(payload)
+                results[sock] = True
+            elif write_payload(sock, payload):
+                results[sock] = True
+                if self._send_misses:
+                    self._send_misses.pop(sock, None)
+            else:
+                pending.append(sock)
+        if pending:
+            sent = await asyncio.gather(
+                *(self._send(sock, payload) for sock in pending)
+            )
+            results.update(zip(pending, sent))
+        return results
+
+    def hold(self):
+        """ Collect frames to batch capable sockets until release() """
+        self._outbox = {}
+
+    async def release(
+            self,
+            socks: Optional[Iterable[WebSocketServerProtocol]] = None,
+    ):
+        """
+        Send the collected frames of `socks` (all if None and stop
+        collecting): a single frame as is, several as one batch frame.
+        Sockets with the same frames share the encoded batch.
+        """
+        outbox = self._outbox
+        if outbox is None:
+            return
+        if socks is None:
+            self._outbox = None
+            held = outbox
+        else:
+            held = {s: outbox.pop(s) for s in socks if s in outbox}
+        if not held:
+            return
+        groups: Dict[Tuple[Payload, ...], list] = defaultdict(list)
+        for sock, payloads in held.items():
+            groups[tuple(payloads)].append(sock)
+        sends = []
+        for payloads, group in groups.items():
+            if len(payloads) == 1:
+                payload = payloads[0]
+            else:
+                payload = Payload(rbatch(payloads))
+                metrics.BATCHED_MESSAGES.inc(
+                    'messages', len(payloads) * len(group))
+                metrics.BATCHED_MESSAGES.inc('frames', len(group))
+            sends.append(self._send_many(group, payload, hold=False))
+        await asyncio.gather(*sends)
+
+    async def broadcast(
+            self,
             data: str,
-    ) -> Tuple[int, Dict[str, str]]:
+            with_admin: bool = True,
+            variants: Optional[Dict[str, str]] = None,
+    ):
+        """
+        Send data to every socket in the room.
+
+        `variants` maps a capability to the data sent instead to the sockets
+        having it.
+        """
+        debug = self._debug_on()
+        socks = list(chain.from_iterable(self.users.values()))
+        if with_admin and self.admin is not None:
+            socks.extend(self.admin)
+        if debug:
+            names = [
+                self.user_names[uid]
+                for uid, user_socks in self.users.items() if user_socks
+            ]
+            if with_admin and self.admin:
+                names.append('admin')
+            self._debug(f'Broadcasting to {", ".join(names)} message '
+                        f'{trunc(data)}')
+        start = time.monotonic()
+        if variants:
+            groups = defaultdict(list)
+            for sock in socks:
+                caps = self.capabilities.get(sock, ())
+                groups[next(
+                    (v for cap, v in variants.items() if cap in caps),
+                    data,
+                )].append(sock)
+            results = {}
+            for res in await asyncio.gather(
+                *(self._send_many(s, d) for d, s in groups.items())
+            ):
+                results.update(res)
+        else:
+            results = await self._send_many(socks, data)
+        elapsed = time.monotonic() - start
+        metrics.BROADCAST_DURATION.observe('', elapsed)
+        metrics.BROADCAST_BYTES.observe('', len(data))
+        metrics.BROADCAST_SOCKETS.observe('', len(socks))
+        if debug:
+            self._debug(
+                f'Broadcast to {sum(results.values())}/{len(socks)} sockets '
+                f'took {elapsed * 1000:.1f}ms'
+            )
+
+    def _debug_sent(
+            self,
+            dbg_info: str,
+            dbg_appendix: str,
+            results: Dict[WebSocketServerProtocol, bool],
+            data: Union[str, Payload],
+    ):
         sent = {}
-        n_sent = 0
-        for _sock in socks:
+        for _sock, ok in results.items():
             dbg_sock = self._wsfmt(_sock)
-            try:
-                await _sock.send(data)
-                sent[dbg_sock] = 'OK'
-                n_sent += 1
-            except ConnectionClosed:
-                self._debug(f'Writing on closed {dbg_info} sock {dbg_sock}')
-                sent[dbg_sock] = 'NO'
-
-        return n_sent, sent
+            if not ok:
+                self._debug(f'Failed writing {dbg_info} sock {dbg_sock}')
+            sent[dbg_sock] = 'OK' if ok else 'NO'
+        self._debug(
+            f'Sent to {dbg_info} {dbg_appendix}: {sent} '
+            f'message {trunc(str(data))}'
+        )
 
     async def user_send(
             self,
             user_id: int,
-            data: str,
+            data: Union[str, Payload],
             sock: Optional[WebSocketServerProtocol] = None,
+            hold: bool = True,
     ) -> bool:
-        user_name = self.user_names[user_id]
-        if sock:
-            socks = [sock]
-            dbg_appendix = 'specific socket'
-        else:
-            socks = self.users[user_id]
-            dbg_appendix = 'all sockets'
-        n_sent, sent = await self._send_to_socks(user_name, socks, data)
-        self._debug(
-            f'Sent to {user_name} {dbg_appendix}: {sent} '
-            f'message {trunc(data)}'
-        )
-        return bool(n_sent)
+        """
+        Send to the user's sockets, true if any got it. Held frames are
+        reported as sent, `hold` false writes them out first for a real
+        result.
+        """
+        socks = [sock] if sock else list(self.users[user_id])
+        if not hold:
+            await self.release(socks)
+        results = await self._send_many(socks, data, hold=hold)
+        if self._debug_on():
+            self._debug_sent(
+                self.user_names[user_id],
+                'specific socket' if sock else 'all sockets',
+                results, data,
+            )
+        return any(results.values())
 
     async def admin_send(
             self,
-            data: str,
+            data: Union[str, Payload],
             sock: Optional[WebSocketServerProtocol] = None,
     ) -> bool:
-        if sock:
-            socks = [sock]
-            dbg_appendix = 'specific socket'
-        else:
-            socks = self.admin
-            dbg_appendix = 'all sockets'
-        n_sent, sent = await self._send_to_socks('admin', socks, data)
-        self._debug(
-            f'Sent to admin {dbg_appendix}: {sent} '
-            f'message {trunc(data)}'
-        )
-        return bool(n_sent)
+        socks = [sock] if sock else self.admin
+        results = await self._send_many(socks, data)
+        if self._debug_on():
+            self._debug_sent(
+                'admin',
+                'specific socket' if sock else 'all sockets',
+                results, data,
+            )
+        return any(results.values())
 
     async def kick(self, user_id: int):
         user = self.users[user_id]
         log.debug(f'Kicking user {user_id}')
         socks = list(user)
+        # Frames of the event come before the kick
+        await self.release(socks)
         for sock in socks:
-            await sock.send(rerr('kick'))
-            await sock.close(1000, 'kick')
+            await self._send(sock, rerr('kick'))
+            # Closing handshake in background, the game is not held by it
+            asyncio.ensure_future(sock.close(1000, 'kick'))
+
+
+class RoomCache:
+    """
+    Resident game rooms, least recently used first.
+
+    Rooms without sockets are flushed and evicted after `idle_timeout`
+    seconds. Above `max_rooms` resident rooms the least recently used idle
+    ones are evicted as well. Connected rooms are never evicted. Zero
+    disables the corresponding limit.
+    """
+    SWEEP_INTERVAL = 30
+
+    def __init__(self, idle_timeout: float = 0, max_rooms: int = 0):
+        self.idle_timeout = idle_timeout
+        self.max_rooms = max_rooms
+        self.evicted = 0
+        # Called with the game id of an evicted room
+        self.on_evict: Optional[Callable[[str], None]] = None
+        self._rooms: 'OrderedDict[str, GameRoom]' = OrderedDict()
+        self._sweeper: Optional[asyncio.Task] = None
+        self._sweeping = False
+
+    def __getitem__(self, game_id: str) -> GameRoom:
+        room = self._rooms[game_id]
+        self._rooms.move_to_end(game_id)
+        return room
+
+    def __setitem__(self, game_id: str, room: GameRoom):
+        self._rooms[game_id] = room
+        self._rooms.move_to_end(game_id)
+        if self.max_rooms and len(self._rooms) > self.max_rooms:
+            asyncio.ensure_future(self.sweep())
+
+    def __delitem__(self, game_id: str):
+        del self._rooms[game_id]
+
+    def __contains__(self, game_id: str) -> bool:
+        return game_id in self._rooms
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def get(self, game_id: str, default=None) -> Optional[GameRoom]:
+        return self._rooms.get(game_id, default)
+
+    def values(self):
+        return self._rooms.values()
+
+    def stats(self) -> dict:
+        return {
+            'resident': len(self._rooms),
+            'idle': sum(1 for r in self._rooms.values() if r.is_idle()),
+            'evicted': self.evicted,
+        }
+
+    def mailboxes(self) -> Dict[str, int]:
+        """ Queued game events, in total and of the busiest game """
+        depths = [room.queued for room in self._rooms.values()]
+        return {'total': sum(depths), 'max': max(depths, default=0)}
+
+    def sockets(self) -> Dict[str, int]:
+        """ Connected sockets, players and admins """
+        users = admins = 0
+        for room in self._rooms.values():
+            admins += len(room.admin)
+            for socks in room.users.values():
+                users += len(socks)
+        return {'user': users, 'admin': admins}
+
+    def start(self):
+        if (self.idle_timeout or self.max_rooms) and self._sweeper is None:
+            self._sweeper = asyncio.ensure_future(self._sweep_loop())
+
+    async def stop(self):
+        """ Stop sweeping and flush every resident room """
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for room in list(self._rooms.values()):
+            try:
+                await room.flush()
+            except Exception:
+                log.exception(f'Error flushing game {room.game_id}')
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.SWEEP_INTERVAL)
+            try:
+                await self.sweep()
+            except Exception:
+                log.exception('Error sweeping rooms')
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug(f'Rooms {self.stats()}')
+
+    async def _evict(self, game_id: str, room: GameRoom):
+        try:
+            await room.flush()
+        except Exception:
+            log.exception(f'Error flushing game {game_id}, not evicting')
+            return
+        # A socket may have joined while flushing
+        if room.is_idle() and self._rooms.get(game_id) is room:
+            del self._rooms[game_id]
+            self.evicted += 1
+            if self.on_evict is not None:
+                self.on_evict(game_id)
+            log.debug(f'Evicted idle game {game_id}')
+
+    async def sweep(self):
+        if self._sweeping:
+            return
+        self._sweeping = True
+        try:
+            now = time.monotonic()
+            idle = [
+                (game_id, room) for game_id, room in self._rooms.items()
+                if room.idle_since is not None
+            ]
+            evict = [
+                (game_id, room) for game_id, room in idle
+                if self.idle_timeout and
+                now - room.idle_since >= self.idle_timeout
+            ]
+            excess = len(self._rooms) - len(evict) - self.max_rooms
+            if self.max_rooms and excess > 0:
+                chosen = set(game_id for game_id, _ in evict)
+                lru = [
+                    (game_id, room) for game_id, room in idle
+                    if game_id not in chosen
+                ]
+                evict.extend(lru[:excess])
+            if not evict:
+                return
+            await asyncio.gather(
+                *(self._evict(game_id, room) for game_id, room in evict)
+            )
+            log.info(f'Evicted {len(evict)} idle games, {self.stats()}')
+        finally:
+            self._sweeping = False
 
 
-rooms: Dict[str, GameRoom] = dict()
+rooms = RoomCache()
@@ -0,0 +1,131 @@
+"""
+Process-wide timers, see Scheduler.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+log = logging.getLogger('onliapa.server.scheduler')
+
+Callback = Callable[[], Awaitable[None]]
+
+
+class Scheduler:
+    """
+    Keyed one-shot timers on the loop monotonic clock.
+
+    Deadlines are kept in a heap with a single loop timer armed for the
+    earliest one, so thousands of pending timers cost one heap entry each.
+    Scheduling an existing key replaces its timer. Cancelled entries stay
+    in the heap until they reach the top, or until they are the majority
+    and the heap is rebuilt.
+    """
+    COMPACT_MIN = 64
+    # The loop runs timers due within its clock resolution
+    RESOLUTION = time.get_clock_info('monotonic').resolution
+
+    def __init__(self):
+        # [deadline, seq, key, callback or None if cancelled]
+        self._heap: List[list] = []
+        self._entries: Dict[str, list] = {}
+        self._seq = itertools.count()
+        self._cancelled = 0
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._armed_at: Optional[float] = None
+        self.stats = {
+            'scheduled': 0,
+            'cancelled': 0,
+            'fired': 0,
+            'errors': 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def schedule(self, key: str, delay: float, callback: Callback) -> float:
+        """ Run `callback()` in `delay` seconds, returns the deadline """
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + max(0.0, delay)
+        self.cancel(key)
+        entry = [deadline, next(self._seq), key, callback]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        self.stats['scheduled'] += 1
+        if self._armed_at is None or deadline < self._armed_at:
+            self._arm(loop)
+        return deadline
+
+    def cancel(self, key: str) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[3] = None
+        self._cancelled += 1
+        self.stats['cancelled'] += 1
+        if (
+            self._cancelled > self.COMPACT_MIN and
+            self._cancelled * 2 > len(self._heap)
+        ):
+            self._heap = [e for e in self._heap if e[3] is not None]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+        return True
+
+    def time_left(self, key: str) -> Optional[float]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        return entry[0] - asyncio.get_event_loop().time()
+
+    def _arm(self, loop: asyncio.AbstractEventLoop):
+        heap = self._heap
+        while heap and heap[0][3] is None:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+        if self._handle is not None:
+            self._handle.cancel()
+        if not heap:
+            self._handle = self._armed_at = None
+            return
+        self._armed_at = heap[0][0]
+        self._handle = loop.call_at(self._armed_at, self._fire)
+
+    def _fire(self):
+        self._handle = self._armed_at = None
+        loop = asyncio.get_event_loop()
+        now = loop.time() + self.RESOLUTION
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            _, _, key, callback = heapq.heappop(heap)
+            if callback is None:
+                self._cancelled -= 1
+                continue
+            del self._entries[key]
+            self.stats['fired'] += 1
+            asyncio.ensure_future(self._run(key, callback))
+        self._arm(loop)
+
+    async def _run(self, key: str, callback: Callback):
+        try:
+            await callback()
+        except Exception:
+            self.stats['errors'] += 1
+            log.exception(f'Error in timer {key}')
+
+    def stop(self):
+        """ Drop every pending timer """
+        if self._handle is not None:
+            self._handle.cancel()
+        self._handle = self._armed_at = None
+        self._heap = []
+        self._entries = {}
+        self._cancelled = 0
+
+
+scheduler = Scheduler()
@@ -1,16 +1,21 @@
+import asyncio
 import logging
 import random
 import re
+import time
+import zlib
+from typing import Dict, Callable, List, Optional
 
 from websockets import WebSocketServerProtocol
 from websockets.exceptions import ConnectionClosed
 
 from onliapa.game.game import Game
 from onliapa.persister import persister
+from onliapa.server.cluster import Cluster
 from onliapa.server.errors import ProtocolError
 from onliapa.server.helpers import remote_addr
 from onliapa.server.messages import NewGameRequest
-from onliapa.server.room import rooms
+from onliapa.server.room import rooms, GameRoom
 from onliapa.server.protocol import rerr, recv_d, rmsg
 
 log = logging.getLogger('onliapa.server.server')
@@ -32,6 +37,110 @@ RE_ADMIN_PATH = Matcher(re.compile(r'^/ws/admin/([A-Za-z0-9]{8})/?$'))
 GAME_ID_LETTERS = 'abcdefghijklmnopqrstuvwxyz0123456789'
 GAME_ID_LEN = 8
 
+# Games owned by this process in multi-process mode, see supervisor
+shard_index = 0
+shard_count = 1
+# Clustered rooms, games of other nodes are relayed
+cluster: Optional[Cluster] = None
+
+# game_id -> load in progress, awaited by every connection to that game
+_loading: Dict[str, asyncio.Future] = {}
+load_stats = {
+    'loads': 0,
+    'coalesced': 0,
+    'failed': 0,
+}
+warm_stats = {
+    'loaded': 0,
+    'failed': 0,
+    'seconds': 0.0,
+}
+
+
+async def _load_room(game_id: str, pr: persister.Persister) -> GameRoom:
+    try:
+        game = await load_game(game_id=game_id, pr=pr)
+    except Exception:
+        load_stats['failed'] += 1
+        raise
+    rooms[game_id] = game.room
+    log.info(f'Loaded game {game_id} from persister')
+    return game.room
+
+
+async def get_room(game_id: str, pr: persister.Persister) -> GameRoom:
+    """ Resident room or single-flight load shared by concurrent joins """
+    try:
+        return rooms[game_id]
+    except KeyError:
+        pass
+    loading = _loading.get(game_id)
+    if loading is None:
+        loading = asyncio.ensure_future(_load_room(game_id, pr))
+        _loading[game_id] = loading
+        loading.add_done_callback(lambda _: _loading.pop(game_id, None))
+        load_stats['loads'] += 1
+    else:
+        load_stats['coalesced'] += 1
+        log.debug(f'Joining in-flight load of game {game_id}')
+    # Shielded, a closed connection must not cancel the load for the others
+    return await asyncio.shield(loading)
+
+
+async def warm_rooms(
+        pr: persister.Persister,
+        max_games: int,
+        budget: float,
+        batch_size: int = 100,
+) -> int:
+    """
+    Preload the most recently saved games of this shard, in batches of one
+    round trip each, until `max_games` are resident or `budget` seconds
+    are spent. Returns the number of games loaded.
+    """
+    start = time.monotonic()
+    if rooms.max_rooms:
+        max_games = min(max_games, rooms.max_rooms)
+    try:
+        # Other shards' games are in the index too
+        keys: List[str] = [
+            key for key in await pr.recent_games(max_games * shard_count)
+            if shard_of(key, shard_count) == shard_index and key not in rooms
+        ][:max_games]
+    except persister.CommunicationError as err:
+        log.error(f'Warm start: error reading active games: {err}')
+        return 0
+    loaded = 0
+    for i in range(0, len(keys), batch_size):
+        if time.monotonic() - start >= budget:
+            log.info(f'Warm start: budget of {budget}s spent')
+            break
+        try:
+            states = await pr.load_games(keys[i: i + batch_size])
+        except persister.CommunicationError as err:
+            log.error(f'Warm start: error loading games: {err}')
+            break
+        for game_id, state in states.items():
+            if game_id in rooms:
+                continue
+            try:
+                game = Game.load_state(
+                    state, make_state_saver(game_id=game_id, pr=pr))
+            except (ValueError, KeyError, TypeError) as err:
+                # Left for a regular load to report and clear
+                warm_stats['failed'] += 1
+                log.warning(f'Warm start: skipping game {game_id}: '
+                            f'{err.__class__.__name__} {err}')
+                continue
+            game.room.unattended()
+            rooms[game_id] = game.room
+            loaded += 1
+    warm_stats['loaded'] += loaded
+    warm_stats['seconds'] = time.monotonic() - start
+    log.info(f'Warm start: loaded {loaded} of {len(keys)} recent games in '
+             f'{warm_stats["seconds"]:.3f}s')
+    return loaded
+
 
 async def serve_game(
     ws: WebSocketServerProtocol,
@@ -40,19 +149,21 @@ async def serve_game(
     pr: persister.Persister
 ):
     ip = remote_addr(ws)
-    try:
-        room = rooms[game_id]
-    except KeyError:
-        try:
-            game = await load_game(game_id=game_id, pr=pr)
-            rooms[game_id] = game.room
-            room = rooms[game_id]
-            log.info(f'Loaded game {game_id} from persister')
-        except persister.GameDoesNotExist:
-            log.info(f'{ip} is trying to join non-existent game {game_id}')
-            await ws.send(rerr('wrong-game', 'Wrong game'))
-            await ws.close()
+    if cluster is not None and game_id not in rooms:
+        owner = await cluster.claim(game_id)
+        if owner is not None:
+            log.info(f'{ip} joins game {game_id} owned by node {owner}')
+            await cluster.serve_remote(ws, game_id, owner, admin)
             return
+    try:
+        room = await get_room(game_id, pr)
+    except persister.GameDoesNotExist:
+        log.info(f'{ip} is trying to join non-existent game {game_id}')
+        if cluster is not None:
+            await cluster.release(game_id)
+        await ws.send(rerr('wrong-game', 'Wrong game'))
+        await ws.close()
+        return
     if admin:
         await room.serve_admin(ws)
     else:
@@ -60,23 +171,32 @@ async def serve_game(
     await ws.close()
 
 
+def shard_of(game_id: str, shards: int) -> int:
+    """ Owner of the game, stable across processes unlike hash() """
+    return zlib.crc32(game_id.encode()) % shards
+
+
 def new_game_id() -> str:
+    """ Unused game id owned by this shard """
     while True:
         game_id = ''.join(
             random.choice(GAME_ID_LETTERS)
             for _ in range(GAME_ID_LEN)
         )
-        if game_id not in rooms:
+        if (
+            shard_of(game_id, shard_count) == shard_index and
+            game_id not in rooms and
+            game_id not in _loading
+        ):
             return game_id
 
 
 def make_state_saver(game_id: str, pr: persister.Persister):
-    async def state_saver(state: str):
-        try:
-            await pr.save_game(game_id, state=state)
-            log.debug(f'Written game {game_id} state')
-        except persister.CommunicationError as err:
-            log.error(f'Error while saving game {game_id}: {err}')
+    def state_saver(dump: Callable[[bool], dict]):
+        # Fenced by the lease, a dropped game belongs to another node
+        if cluster is not None and game_id not in cluster.owned:
+            return
+        pr.save_game_deferred(game_id, dump)
     return state_saver
 
 
@@ -85,6 +205,9 @@ async def create_game(ws: WebSocketServerProtocol, pr: persister.Persister):
     request: NewGameRequest = await recv_d(ws, NewGameRequest, 'new-game')
 
     game_id = new_game_id()
+    if cluster is not None:
+        while await cluster.claim(game_id) is not None:
+            game_id = new_game_id()
 
     game = Game(
         game_id=game_id,
@@ -93,6 +216,8 @@ async def create_game(ws: WebSocketServerProtocol, pr: persister.Persister):
         hat_words_per_user=request.hat_words_per_user,
         state_saver=make_state_saver(game_id=game_id, pr=pr),
     )
+    # Until the admin connects
+    game.room.unattended()
     rooms[game_id] = game.room
     log.info(f'Created game {game_id} named \"{request.game_name}\" for {ip}')
     await ws.send(rmsg('new-game-id', game_id))
@@ -115,6 +240,8 @@ async def _serve(
     path: str
 ):
     ip = remote_addr(ws)
+    # Query parameters are read by auth
+    path = path.split('?', 1)[0]
     if RE_GAME_PATH.match(path):
         game_id = RE_GAME_PATH.matches.group(1)
         log.info(f'New connection from {ip} to game {game_id}')
@@ -0,0 +1,387 @@
+"""
+Multi-process mode: the supervisor accepts connections and hands each one
+to the worker process owning its game, see server.shard_of().
+"""
+import array
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import re
+import signal
+import socket
+from functools import partial
+from typing import Callable, List, Optional, Tuple
+
+import websockets
+from websockets.extensions.permessage_deflate import \
+    enable_server_permessage_deflate
+from websockets.legacy.server import WebSocketServer, WebSocketServerProtocol
+
+from onliapa.server.server import RE_GAME_PATH, RE_ADMIN_PATH, shard_of
+
+log = logging.getLogger('onliapa.server.supervisor')
+
+RE_REQUEST_LINE = re.compile(rb'^[A-Z]+ (\S+) HTTP/1\.[01]\r\n')
+REQUEST_LINE_MAX = 4096
+
+WorkerMain = Callable[[int, int, socket.socket], None]
+
+
+def send_fd(channel: socket.socket, fd: int):
+    channel.sendmsg(
+        [b'\0'],
+        [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', [fd]))],
+    )
+
+
+def recv_fds(channel: socket.socket) -> List[int]:
+    """ File descriptors of all pending messages of a non-blocking channel """
+    fds = array.array('i')
+    while True:
+        try:
+            data, ancdata, _, _ = channel.recvmsg(
+                1, socket.CMSG_LEN(fds.itemsize))
+        except BlockingIOError:
+            return list(fds)
+        if not data:
+            # Descriptors received before EOF would leak otherwise
+            for fd in fds:
+                socket.socket(fileno=fd).close()
+            raise ConnectionError('Supervisor channel closed')
+        for level, kind, cmsg in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg[:len(cmsg) - len(cmsg) % fds.itemsize])
+
+
+def route_path(path: str) -> Optional[str]:
+    """ Game id of a game or admin connection path """
+    for matcher in (RE_GAME_PATH, RE_ADMIN_PATH):
+        if matcher.match(path):
+            return matcher.matches.group(1)
+    return None
+
+
+class Supervisor:
+    """
+    Starts `workers` processes running `worker_main(shard_index,
+    shard_count, channel)` and restarts them if they exit. Accepted
+    connections are passed over the worker channel: game and admin ones to
+    the owner of the game, others (new game) round-robin, the worker
+    creates games of its own shard.
+
+    Workers are forked by a spawner process started before the supervisor
+    loop and logging thread exist, restarted workers get the same clean
+    state as the first ones.
+    """
+    PEEK_TIMEOUT = 5.0
+    PEEK_RETRY = 0.005
+    CHECK_INTERVAL = 1.0
+    SPAWN_TIMEOUT = 10.0
+
+    def __init__(self, workers: int, worker_main: WorkerMain):
+        self.workers = workers
+        self.worker_main = worker_main
+        self._spawner: Optional[multiprocessing.Process] = None
+        self._control: Optional[socket.socket] = None
+        self._pids: List[Optional[int]] = [None] * workers
+        self._channels: List[Optional[socket.socket]] = [None] * workers
+        self._next = itertools.cycle(range(workers))
+        self._listener: Optional[socket.socket] = None
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {
+            'routed': [0] * workers,
+            'restarts': 0,
+            'rejected': 0,
+        }
+
+    def start_workers(self):
+        """ Fork workers, before the supervisor loop creates any resources """
+        ctx = multiprocessing.get_context('fork')
+        control, spawner_end = socket.socketpair(
+            socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._spawner = ctx.Process(
+            target=self._run_spawner,
+            args=(spawner_end, control),
+            name='onliapa-spawner',
+        )
+        self._spawner.start()
+        spawner_end.close()
+        self._control = control
+        control.settimeout(self.SPAWN_TIMEOUT)
+        for i in range(self.workers):
+            control.send(str(i).encode())
+            self._add_worker(i)
+        # Restarts are requested from the supervisor loop
+        control.setblocking(False)
+
+    async def _restart_worker(self, index: int):
+        loop = asyncio.get_event_loop()
+        replied = loop.create_future()
+
+        def on_readable():
+            if not replied.done():
+                replied.set_result(None)
+
+        self._control.send(str(index).encode())
+        loop.add_reader(self._control.fileno(), on_readable)
+        try:
+            await asyncio.wait_for(replied, self.SPAWN_TIMEOUT)
+        finally:
+            loop.remove_reader(self._control.fileno())
+        self._add_worker(index)
+
+    def _add_worker(self, index: int):
+        """ Spawner reply to a worker request: its pid and channel """
+        fds = array.array('i')
+        data, ancdata, _, _ = self._control.recvmsg(
+            32, socket.CMSG_LEN(fds.itemsize))
+        for level, kind, cmsg in ancdata:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds.frombytes(cmsg[:len(cmsg) - len(cmsg) % fds.itemsize])
+        if not data or len(fds) != 1:
+            for fd in fds:
+                socket.socket(fileno=fd).close()
+            raise ConnectionError('Worker spawner failed')
+        channel = socket.socket(fileno=fds[0])
+        channel.setblocking(False)
+        self._pids[index] = int(data)
+        self._channels[index] = channel
+        log.info(f'Started worker {index} pid {self._pids[index]}')
+
+    def _run_spawner(self, control: socket.socket, supervisor_end):
+        supervisor_end.close()
+        # Ctrl-C reaches the whole process group, the supervisor stops us
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        ctx = multiprocessing.get_context('fork')
+        while True:
+            data = control.recv(32)
+            if not data:
+                # Supervisor gone, exited workers are joined at exit
+                return
+            # Joins exited workers
+            multiprocessing.active_children()
+            index = int(data)
+            parent, child = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            process = ctx.Process(
+                target=self._run_worker,
+                args=(index, child, (control, parent)),
+                name=f'onliapa-worker-{index}',
+            )
+            process.start()
+            child.close()
+            control.sendmsg(
+                [str(process.pid).encode()],
+                [(socket.SOL_SOCKET, socket.SCM_RIGHTS,
+                  array.array('i', [parent.fileno()]))],
+            )
+            parent.close()
+
+    def _run_worker(
+            self,
+            index: int,
+            channel: socket.socket,
+            spawner_socks: Tuple[socket.socket, ...],
+    ):
+        # The spawner sockets must not stay open in the worker: the
+        # channel EOF the supervisor watches for would never come
+        for sock in spawner_socks:
+            sock.close()
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.worker_main(index, self.workers, channel)
+
+    @staticmethod
+    def _exited(channel: socket.socket) -> bool:
+        """ Workers never write to the channel, it reads only at exit """
+        try:
+            return channel.recv(1, socket.MSG_PEEK) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    def _stop_spawner(self):
+        self._control.close()
+        self._control = None
+        if self._spawner.is_alive():
+            self._spawner.terminate()
+
+    async def _check_workers(self):
+        while True:
+            await asyncio.sleep(self.CHECK_INTERVAL)
+            for i, channel in enumerate(self._channels):
+                if channel is None or not self._exited(channel):
+                    continue
+                log.error(f'Worker {i} pid {self._pids[i]} exited, '
+                          f'restarting')
+                # Connections passed but not received are closed with it
+                channel.close()
+                self._channels[i] = None
+                if self._control is None:
+                    continue
+                self.stats['restarts'] += 1
+                try:
+                    await self._restart_worker(i)
+                except (OSError, asyncio.TimeoutError) as err:
+                    # Serving the other shards goes on
+                    log.critical(f'Worker spawner failed ({err!r}), no '
+                                 f'more restarts')
+                    self._stop_spawner()
+
+    async def serve(self, host: str, port: int, backlog: int = 1024):
+        loop = asyncio.get_event_loop()
+        family, kind, proto, _, address = socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+        listener = socket.socket(family, kind, proto)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(address)
+        listener.listen(backlog)
+        listener.setblocking(False)
+        self._listener = listener
+        self._tasks = [
+            asyncio.ensure_future(self._accept(loop)),
+            asyncio.ensure_future(self._check_workers()),
+        ]
+
+    async def _accept(self, loop: asyncio.AbstractEventLoop):
+        while True:
+            conn, _ = await loop.sock_accept(self._listener)
+            asyncio.ensure_future(self._route(loop, conn))
+
+    async def _peek_path(
+            self,
+            loop: asyncio.AbstractEventLoop,
+            conn: socket.socket,
+    ) -> Optional[str]:
+        """
+        Path of the HTTP request line. Peeked, the worker reads the request
+        again from the start.
+        """
+        deadline = loop.time() + self.PEEK_TIMEOUT
+        while loop.time() < deadline:
+            try:
+                data = conn.recv(REQUEST_LINE_MAX, socket.MSG_PEEK)
+            except BlockingIOError:
+                data = None
+            if data == b'':
+                return None
+            if data:
+                match = RE_REQUEST_LINE.match(data)
+                if match:
+                    return match.group(1).decode('latin-1')
+                if b'\r\n' in data or len(data) >= REQUEST_LINE_MAX:
+                    return None
+            # Peeked data stays readable, poll instead of add_reader
+            await asyncio.sleep(self.PEEK_RETRY)
+        return None
+
+    async def _route(
+            self,
+            loop: asyncio.AbstractEventLoop,
+            conn: socket.socket,
+    ):
+        try:
+            path = await self._peek_path(loop, conn)
+            if path is None:
+                self.stats['rejected'] += 1
+                return
+            game_id = route_path(path)
+            if game_id is not None:
+                index = shard_of(game_id, self.workers)
+            else:
+                index = next(self._next)
+            channel = self._channels[index]
+            if channel is None:
+                log.warning(f'Worker {index} is down, dropping connection')
+                self.stats['rejected'] += 1
+                return
+            send_fd(channel, conn.fileno())
+            self.stats['routed'][index] += 1
+        except OSError as err:
+            log.warning(f'Failed to route connection: {err}')
+            self.stats['rejected'] += 1
+        finally:
+            conn.close()
+
+    async def stop(self, timeout: float = 10.0):
+        for task in self._tasks:
+            task.cancel()
+        if self._listener is not None:
+            self._listener.close()
+        for pid, channel in zip(self._pids, self._channels):
+            if channel is not None and not self._exited(channel):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+        loop = asyncio.get_event_loop()
+        deadline = loop.time() + timeout
+        for channel in self._channels:
+            while (
+                channel is not None and
+                not self._exited(channel) and
+                loop.time() < deadline
+            ):
+                await asyncio.sleep(0.05)
+        for channel in self._channels:
+            if channel is not None:
+                channel.close()
+        if self._control is not None:
+            # The spawner exits on EOF
+            self._control.close()
+            self._control = None
+        if self._spawner is not None:
+            await loop.run_in_executor(None, self._spawner.join, timeout)
+
+
+async def serve_channel(
+        channel: socket.socket,
+        ws_handler,
+        on_close: Callable[[], None],
+        **kwargs,
+) -> WebSocketServer:
+    """
+    Worker side: serve websocket connections passed by the supervisor.
+    `on_close` is called when the supervisor channel is closed.
+    """
+    loop = asyncio.get_event_loop()
+    # Never connected to, gives the server its usual lifecycle. Empty
+    # address autobinds to an abstract name on Linux
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind('')
+    listener.listen()
+    ws_server = await websockets.serve(ws_handler, sock=listener, **kwargs)
+    # Protocols of passed connections, built the way serve() builds them
+    options = dict(kwargs)
+    if options.pop('compression', 'deflate') == 'deflate':
+        options['extensions'] = enable_server_permessage_deflate(
+            options.get('extensions'))
+    factory = partial(
+        WebSocketServerProtocol, ws_handler, ws_server, **options)
+
+    def connected(task: asyncio.Future):
+        if not task.cancelled() and task.exception() is not None:
+            log.debug(f'Failed to set up passed connection: '
+                      f'{task.exception()}')
+
+    def on_readable():
+        try:
+            fds = recv_fds(channel)
+        except ConnectionError as err:
+            log.error(f'{err}, stopping worker')
+            loop.remove_reader(channel.fileno())
+            on_close()
+            return
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            sock.setblocking(False)
+            task = asyncio.ensure_future(
+                loop.connect_accepted_socket(factory, sock))
+            task.add_done_callback(connected)
+
+    channel.setblocking(False)
+    loop.add_reader(channel.fileno(), on_readable)
+    return ws_server
@@ -3,14 +3,23 @@
 import argparse
 import asyncio
 import logging
+import signal
+import socket
 import sys
 from functools import partial
+from typing import Optional
 
 import websockets
 
-from onliapa.persister.persister import Persister
-from onliapa.server import helpers as server_helpers
-from onliapa.server.server import serve
+from onliapa.persister.persister import Persister, CommunicationError
+from onliapa.server import auth, compression, helpers as server_helpers, \
+    metrics, protocol, server
+from onliapa.server.room import EventEmitter, GameRoom, rooms
+from onliapa.server.cluster import Cluster
+from onliapa.server.logs import start_queue_logging
+from onliapa.server.scheduler import scheduler
+from onliapa.server.server import serve, get_room, warm_rooms
+from onliapa.server.supervisor import Supervisor, serve_channel
 
 log = logging.getLogger('onliapa')
 
@@ -20,11 +29,87 @@ parser.add_argument('-p', '--listen-port', type=int, help='port', default=6613)
 parser.add_argument('-r', '--redis-url', type=str, help='redis url',
                     default='redis://localhost')
 parser.add_argument('-d', '--debug', action='store_true')
+parser.add_argument('--debug-sample', type=int, default=1,
+                    help='log one of N debug messages of each call site')
 parser.add_argument('-f', '--forward-enable', action='store_true')
+parser.add_argument('--redis-pool-min', type=int, default=1,
+                    help='minimum redis pool size')
+parser.add_argument('--redis-pool-max', type=int, default=10,
+                    help='maximum redis pool size')
+parser.add_argument('--redis-health-interval', type=float, default=30,
+                    help='redis health check interval, seconds (0 to disable)')
+parser.add_argument('--save-debounce', type=float, default=1.0,
+                    help='coalesce game saves within the window, seconds')
+parser.add_argument('--send-timeout', type=float, default=5.0,
+                    help='per-socket send timeout, seconds')
+parser.add_argument('--send-max-misses', type=int, default=3,
+                    help='send timeouts in a row before socket eviction')
+parser.add_argument('--json-backend', choices=('json', 'orjson'),
+                    default='json',
+                    help='JSON serializer for outgoing messages')
+parser.add_argument('--resume-secret',
+                    help='session resume token key, shared by the cluster '
+                         'nodes (random by default, tokens are then lost on '
+                         'restart)')
+parser.add_argument('--resume-ttl', type=int, default=3600 * 24,
+                    help='session resume token lifetime, seconds')
+parser.add_argument('--compression', choices=('on', 'off'), default='on',
+                    help='permessage-deflate for clients supporting it')
+parser.add_argument('--compression-window-bits', type=int,
+                    choices=range(8, 16), metavar='{8..15}',
+                    help='compression window, log2 of bytes (default 15)')
+parser.add_argument('--compression-mem-level', type=int,
+                    choices=range(1, 10), metavar='{1..9}',
+                    help='compressor memory level (default 8)')
+parser.add_argument('--compression-min-size', type=int, default=0,
+                    help='messages under this many bytes are sent '
+                         'uncompressed')
+parser.add_argument('--room-idle-timeout', type=float, default=600,
+                    help='evict games without connections after, seconds '
+                         '(0 to keep forever)')
+parser.add_argument('--room-max', type=int, default=0,
+                    help='maximum resident games, least recently used idle '
+                         'games are evicted above it (0 for no limit)')
+parser.add_argument('--warm-games', type=int, default=0,
+                    help='preload this many recently active games before '
+                         'accepting connections (0 to disable)')
+parser.add_argument('--warm-budget', type=float, default=5.0,
+                    help='stop preloading games after, seconds')
+parser.add_argument('--warm-batch', type=int, default=100,
+                    help='games fetched per redis round trip when '
+                         'preloading')
+parser.add_argument('--mailbox-size', type=int, default=256,
+                    help='queued messages per game before backpressure')
+parser.add_argument('--mailbox-shed', action='store_true',
+                    help='drop messages to a full game mailbox instead of '
+                         'pausing the sender socket')
+parser.add_argument('--cluster', action='store_true',
+                    help='share games with other nodes through redis')
+parser.add_argument('--cluster-lease', type=float, default=10.0,
+                    help='game ownership lease, seconds')
+parser.add_argument('-w', '--workers', type=int, default=1,
+                    help='worker processes, games are sharded between them')
+parser.add_argument('--metrics-port', type=int, default=0,
+                    help='serve prometheus metrics on /metrics, worker N '
+                         'listens on port + N (0 to disable)')
+parser.add_argument('--metrics-host', default='127.0.0.1',
+                    help='metrics listen IP')
 args = parser.parse_args()
 
 # Global settings
 server_helpers.fwd_permitted = args.forward_enable
+GameRoom.SEND_TIMEOUT = args.send_timeout
+GameRoom.SEND_MAX_MISSES = args.send_max_misses
+EventEmitter.MAILBOX_SIZE = args.mailbox_size
+EventEmitter.SHED = args.mailbox_shed
+if args.resume_secret:
+    auth.RESUME_SECRET = args.resume_secret.encode()
+auth.RESUME_TTL = args.resume_ttl
+try:
+    protocol.set_json_backend(args.json_backend)
+except ImportError as err:
+    print(f'JSON backend {args.json_backend} is not available: {err}')
+    sys.exit(1)
 
 # Logging
 log_level = logging.DEBUG if args.debug else logging.INFO
@@ -32,35 +117,205 @@ log.setLevel(log_level)
 handler = logging.StreamHandler(stream=sys.stdout)
 handler.setLevel(log_level)
 formatter = logging.Formatter(
-    '%(asctime)s [%(module)s] %(levelname)s - %(message)s',
+    '%(asctime)s [%(module)s] %(levelname)s - %(message)s'
+    if args.workers <= 1 else
+    '%(asctime)s %(processName)s [%(module)s] %(levelname)s - %(message)s',
 )
 handler.setFormatter(formatter)
 log.addHandler(handler)
 
+
+def start_logging():
+    """ Write logs from a background thread, once per process """
+    return start_queue_logging(log, handler, debug_sample=args.debug_sample)
+
+
 # Persister
-persister = Persister(args.redis_url)
+def make_persister() -> Persister:
+    return Persister(
+        args.redis_url,
+        pool_minsize=args.redis_pool_min,
+        pool_maxsize=args.redis_pool_max,
+        health_check_interval=args.redis_health_interval,
+        save_debounce=args.save_debounce,
+    )
 
-# Server
-serve_ = partial(serve, persister)
 
+def register_metrics(persister: Persister):
+    metrics.gauge('onliapa_rooms', 'Resident game rooms', lambda: len(rooms))
+    metrics.gauge('onliapa_rooms_idle', 'Resident game rooms without sockets',
+                  lambda: rooms.stats()['idle'])
+    metrics.gauge('onliapa_rooms_evicted_total', 'Evicted idle game rooms',
+                  lambda: rooms.evicted, kind='counter')
+    metrics.gauge('onliapa_sockets', 'Connected sockets', rooms.sockets,
+                  label='role')
+    metrics.gauge('onliapa_game_loads_total', 'Game loads from redis',
+                  lambda: server.load_stats, label='result', kind='counter')
+    metrics.gauge('onliapa_warm_start_games', 'Games preloaded at startup',
+                  lambda: {
+                      k: v for k, v in server.warm_stats.items()
+                      if k != 'seconds'
+                  }, label='result')
+    metrics.gauge('onliapa_warm_start_seconds', 'Startup preload duration',
+                  lambda: server.warm_stats['seconds'])
+    metrics.gauge('onliapa_saves_total', 'Write-behind game saves',
+                  lambda: persister.save_stats, label='result',
+                  kind='counter')
+    metrics.gauge('onliapa_redis_pool_connections', 'Redis pool connections',
+                  lambda: {
+                      k: v for k, v in persister.stats().items()
+                      if k in ('size', 'free')
+                  }, label='state')
+    metrics.gauge('onliapa_mailbox_depth', 'Queued game events',
+                  rooms.mailboxes, label='stat')
+    metrics.gauge('onliapa_round_timers', 'Pending round deadlines',
+                  lambda: len(scheduler))
+    metrics.gauge('onliapa_redis_healthy', 'Last redis health check passed',
+                  lambda: int(persister.healthy))
+    if server.cluster is not None:
+        metrics.gauge('onliapa_cluster_events_total', 'Cluster relay events',
+                      lambda: server.cluster.stats, label='event',
+                      kind='counter')
 
-async def start_server():
+
+async def start_metrics():
+    port = args.metrics_port + server.shard_index
     try:
-        await persister.ping()
-        log.info('Connected to redis')
+        await metrics.serve(args.metrics_host, port)
+        log.info(f'Metrics are served on {args.metrics_host}:{port}')
     except OSError as err:
+        log.critical(f'Failed to start metrics server: {err}')
+        sys.exit(1)
+
+
+async def start_server(
+        persister: Persister,
+        channel: Optional[socket.socket] = None,
+):
+    try:
+        await persister.connect()
+        await persister.ping()
+        log.info(f'Connected to redis, pool {persister.stats()}')
+    except CommunicationError as err:
         log.critical(f'Failed to connect to redis: {err}')
         sys.exit(1)
+    if server.cluster is not None:
+        try:
+            await server.cluster.connect()
+        except CommunicationError as err:
+            log.critical(f'Failed to join the cluster: {err}')
+            sys.exit(1)
+    rooms.idle_timeout = args.room_idle_timeout
+    rooms.max_rooms = args.room_max
+    rooms.on_evict = persister.forget
+    rooms.start()
+    if args.warm_games:
+        if server.cluster is not None:
+            # Preloading would claim games other nodes may be serving
+            log.warning('Warm start is not supported in cluster mode')
+        else:
+            await warm_rooms(
+                persister, args.warm_games, args.warm_budget, args.warm_batch)
+    if args.metrics_port:
+        register_metrics(persister)
+        await start_metrics()
+    serve_ = partial(serve, persister)
+    options = compression.serve_options(
+        enabled=args.compression == 'on',
+        window_bits=args.compression_window_bits,
+        mem_level=args.compression_mem_level,
+        min_size=args.compression_min_size,
+    )
+    if channel is not None:
+        await serve_channel(
+            channel, serve_, on_close=asyncio.get_event_loop().stop,
+            **options)
+        log.info(f'Worker {server.shard_index} of {server.shard_count} '
+                 f'is serving')
+        return
     try:
-        await websockets.serve(serve_, args.listen_host, args.listen_port)
+        await websockets.serve(
+            serve_, args.listen_host, args.listen_port, **options)
         log.info(f'Server is listening {args.listen_host}:{args.listen_port}')
     except OSError as err:
         log.critical(f'Failed to start server: {err}')
         sys.exit(1)
 
-asyncio.get_event_loop().run_until_complete(start_server())
 
-try:
-    asyncio.get_event_loop().run_forever()
-except KeyboardInterrupt:
-    print('Killed')
+def log_compression():
+    """ Compression ratio and CPU time per message tag """
+    for tag, stats in compression.report().items():
+        ratio = stats['ratio']
+        ratio = f' ({ratio:.1%})' if ratio is not None else ''
+        log.info(
+            f'Compression {tag}: {stats["bytes_in"]} -> '
+            f'{stats["bytes_out"]} bytes{ratio}, '
+            f'{stats["seconds"] * 1e3:.1f}ms cpu, '
+            f'{stats["skipped"]} under threshold'
+        )
+
+
+def run(channel: Optional[socket.socket] = None):
+    log_listener = start_logging()
+    loop = asyncio.get_event_loop()
+    persister = make_persister()
+    if args.cluster:
+        server.cluster = Cluster(
+            args.redis_url,
+            load_room=partial(get_room, pr=persister),
+            discard_save=persister.discard,
+            lease_ttl=args.cluster_lease,
+        )
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_until_complete(start_server(persister, channel))
+    except SystemExit:
+        # Startup failure logged, flush it
+        log_listener.stop()
+        raise
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        print('Killed')
+    finally:
+        # Let the shutdown save finish
+        loop.add_signal_handler(signal.SIGTERM, lambda: None)
+        loop.run_until_complete(rooms.stop())
+        loop.run_until_complete(persister.close())
+        if server.cluster is not None:
+            loop.run_until_complete(server.cluster.close())
+        log_compression()
+        log_listener.stop()
+
+
+def run_worker(shard_index: int, shard_count: int, channel: socket.socket):
+    server.shard_index = shard_index
+    server.shard_count = shard_count
+    run(channel)
+
+
+def run_supervisor():
+    supervisor = Supervisor(args.workers, run_worker)
+    supervisor.start_workers()
+    log_listener = start_logging()
+    loop = asyncio.get_event_loop()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    try:
+        loop.run_until_complete(
+            supervisor.serve(args.listen_host, args.listen_port))
+        log.info(f'Server is listening {args.listen_host}:{args.listen_port}'
+                 f' with {args.workers} workers')
+        loop.run_forever()
+    except OSError as err:
+        log.critical(f'Failed to start server: {err}')
+    except KeyboardInterrupt:
+        print('Killed')
+    finally:
+        loop.run_until_complete(supervisor.stop())
+        log_listener.stop()
+
+
+if args.workers > 1:
+    run_supervisor()
+else:
+    run()